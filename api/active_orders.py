@@ -0,0 +1,202 @@
+import time
+
+from decouple import config
+from django.db.models import Exists, IntegerField, OuterRef, Q, Value
+from django.utils import timezone
+
+# With ROBOT_ACTIVE_ORDER, Logics.validate_already_maker_or_taker trusts the
+# Robot.active_order pointer (kept up to date on every order and take order
+# change) instead of searching the orders of the robot.
+ROBOT_ACTIVE_ORDER = config("ROBOT_ACTIVE_ORDER", cast=bool, default=False)
+
+# Saving any of these order fields may change which robots are active in it
+ACTIVE_ORDER_FIELDS = {"status", "maker", "taker"}
+
+# Error codes of each way of being active in an order, by priority
+MAKER, TAKER, PRETAKER, FAILING_BUYER = 1000, 1001, 1002, 1003
+
+
+def active_statuses():
+    """Makers and takers of orders in these statuses can not make or take another"""
+    from api.models import Order
+
+    return [
+        Order.Status.WFB,
+        Order.Status.PUB,
+        Order.Status.PAU,
+        Order.Status.TAK,
+        Order.Status.WF2,
+        Order.Status.WFE,
+        Order.Status.WFI,
+        Order.Status.CHA,
+        Order.Status.FSE,
+        Order.Status.DIS,
+        Order.Status.WFR,
+    ]
+
+
+def failing_statuses():
+    """Buyers of orders in these statuses are still waiting for their payout"""
+    from api.models import Order
+
+    return [Order.Status.FAI, Order.Status.PAY]
+
+
+def find_active_order(user_id):
+    """
+    The order a user is active in, in a single query: a UNION of its
+    orders as maker, as taker, as pretaker and as buyer of a failing payout.
+    Returns (error code, order), or (None, None).
+    """
+    from api.models import Order, TakeOrder
+
+    def code(error_code):
+        return Value(error_code, output_field=IntegerField())
+
+    as_maker = Order.objects.filter(maker_id=user_id, status__in=active_statuses())
+    as_taker = Order.objects.filter(taker_id=user_id, status__in=active_statuses())
+    as_pretaker = Order.objects.filter(
+        id__in=TakeOrder.objects.filter(
+            taker_id=user_id, expires_at__gt=timezone.now()
+        ).values("order_id")
+    )
+    as_failing_buyer = Order.objects.filter(
+        Q(maker_id=user_id, type=Order.Types.BUY)
+        | Q(taker_id=user_id, type=Order.Types.SELL),
+        status__in=failing_statuses(),
+    )
+
+    order = (
+        as_maker.annotate(error_code=code(MAKER))
+        .union(
+            as_taker.annotate(error_code=code(TAKER)),
+            as_pretaker.annotate(error_code=code(PRETAKER)),
+            as_failing_buyer.annotate(error_code=code(FAILING_BUYER)),
+            all=True,
+        )
+        .order_by("error_code", "id")
+        .first()
+    )
+    if order is None:
+        return None, None
+    return order.error_code, order
+
+
+def has_active_order(user=OuterRef("pk")):
+    """
+    Condition of users active in any order, to filter users in bulk
+    (e.g. User.objects.exclude(has_active_order())).
+    """
+    from api.models import Order, TakeOrder
+
+    return (
+        Exists(Order.objects.filter(maker=user, status__in=active_statuses()))
+        | Exists(Order.objects.filter(taker=user, status__in=active_statuses()))
+        | Exists(TakeOrder.objects.filter(taker=user, expires_at__gt=timezone.now()))
+        | Exists(
+            Order.objects.filter(
+                Q(maker=user, type=Order.Types.BUY)
+                | Q(taker=user, type=Order.Types.SELL),
+                status__in=failing_statuses(),
+            )
+        )
+    )
+
+
+def active_error_code(order, user_id):
+    """How a user is active in an order (error code), None if it is not"""
+    from api.models import Order, TakeOrder
+
+    if order.status in active_statuses():
+        if order.maker_id == user_id:
+            return MAKER
+        if order.taker_id == user_id:
+            return TAKER
+
+    if order.status in failing_statuses():
+        is_buyer = (order.maker_id == user_id and order.type == Order.Types.BUY) or (
+            order.taker_id == user_id and order.type == Order.Types.SELL
+        )
+        if is_buyer:
+            return FAILING_BUYER
+
+    if TakeOrder.objects.filter(
+        order=order, taker_id=user_id, expires_at__gt=timezone.now()
+    ).exists():
+        return PRETAKER
+
+    return None
+
+
+def refresh_active_order(user_id):
+    """Searches the active order of a user and stores it as its pointer"""
+    from api.models import Robot
+
+    error_code, order = find_active_order(user_id)
+    Robot.objects.filter(user_id=user_id).update(active_order=order)
+    return error_code, order
+
+
+def get_active_order(user):
+    """
+    (error code, order) of the order a user is active in, or (None, None).
+    Uses the Robot.active_order pointer if ROBOT_ACTIVE_ORDER is enabled.
+    """
+    if not ROBOT_ACTIVE_ORDER or not hasattr(user, "robot"):
+        return find_active_order(user.id)
+
+    robot = user.robot
+    if robot.active_order_id is None:
+        return None, None
+
+    order = robot.active_order
+    error_code = active_error_code(order, user.id)
+    if error_code is not None:
+        return error_code, order
+
+    # Stale pointer, e.g. a take order whose time ran out
+    return refresh_active_order(user.id)
+
+
+def sync_active_order(order, user_id):
+    """Points the robot to the order if it is active in it, or stops pointing
+    to it (searching any other active order) if it no longer is"""
+    from api.models import Robot
+
+    if user_id is None:
+        return
+
+    if order.status in active_statuses() or order.status in failing_statuses():
+        error_code = active_error_code(order, user_id)
+    else:
+        error_code = None
+
+    if error_code in (MAKER, TAKER, FAILING_BUYER):
+        Robot.objects.filter(user_id=user_id).exclude(active_order=order).update(
+            active_order=order
+        )
+    elif Robot.objects.filter(user_id=user_id, active_order=order).update(
+        active_order=None
+    ):
+        refresh_active_order(user_id)
+
+
+def sync_order_active_orders(order):
+    """Keeps the pointers of the maker and the taker of an order up to date"""
+    sync_active_order(order, order.maker_id)
+    sync_active_order(order, order.taker_id)
+
+
+def sync_take_order_active_order(take_order, deleted=False):
+    """A pretaker is active in the order until its take order expires"""
+    from api.expiry import deadline
+    from api.models import Robot
+
+    if not deleted and deadline(take_order.expires_at) > time.time():
+        Robot.objects.filter(user_id=take_order.taker_id, active_order=None).update(
+            active_order_id=take_order.order_id
+        )
+    elif Robot.objects.filter(
+        user_id=take_order.taker_id, active_order_id=take_order.order_id
+    ).update(active_order=None):
+        refresh_active_order(take_order.taker_id)
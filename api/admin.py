@@ -3,13 +3,23 @@ from statistics import median
 from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth.models import Group, User
+from django.utils import timezone
 from django.utils.html import format_html
 from django_admin_relation_links import AdminChangeLinksMixin
 from rest_framework.authtoken.admin import TokenAdmin
 from rest_framework.authtoken.models import TokenProxy
 
 from api.logics import Logics
-from api.models import Currency, LNPayment, MarketTick, OnchainPayment, Order, Robot
+from api.models import (
+    Currency,
+    LNPayment,
+    MarketStats,
+    MarketTick,
+    NotificationDelivery,
+    OnchainPayment,
+    Order,
+    Robot,
+)
 from api.utils import objects_to_hyperlinks
 from api.tasks import send_notification
 
@@ -22,6 +32,7 @@ class RobotInline(admin.StackedInline):
     model = Robot
     can_delete = False
     show_change_link = True
+    raw_id_fields = ("active_order",)
 
 
 @admin.register(User)
@@ -512,7 +523,7 @@ class UserRobotAdmin(AdminChangeLinksMixin, admin.ModelAdmin):
         "num_disputes",
         "lost_disputes",
     )
-    raw_id_fields = ("user",)
+    raw_id_fields = ("user", "active_order")
     list_editable = ["earned_rewards"]
     list_display_links = ["id"]
     change_links = ["user"]
@@ -534,3 +545,52 @@ class MarketTickAdmin(admin.ModelAdmin):
     readonly_fields = ("timestamp", "price", "volume", "premium", "currency", "fee")
     list_filter = ["currency"]
     ordering = ("-timestamp",)
+
+
+@admin.register(MarketStats)
+class MarketStatsAdmin(admin.ModelAdmin):
+    list_display = ("num_ticks", "lifetime_volume", "last_day_premium", "last_tick_at")
+    readonly_fields = (
+        "num_ticks",
+        "lifetime_volume",
+        "last_day_premium",
+        "last_tick_at",
+    )
+
+
+@admin.register(NotificationDelivery)
+class NotificationDeliveryAdmin(AdminChangeLinksMixin, admin.ModelAdmin):
+    list_display = (
+        "id",
+        "created_at",
+        "channel",
+        "status",
+        "destination",
+        "attempts",
+        "next_attempt_at",
+        "last_error",
+        "robot_link",
+        "order_link",
+    )
+    change_links = ("robot", "order")
+    raw_id_fields = ("robot", "order")
+    list_display_links = ("id",)
+    list_filter = ("channel", "status")
+    search_fields = ["destination", "order__id"]
+    ordering = ("-created_at",)
+    actions = ["retry_deliveries"]
+
+    @admin.action(description="Retry deliveries now")
+    def retry_deliveries(self, request, queryset):
+        """
+        Queues dead-lettered (or postponed) deliveries again with a fresh
+        number of attempts.
+        """
+        num_retried = queryset.update(
+            status=NotificationDelivery.Status.PENDING,
+            attempts=0,
+            next_attempt_at=timezone.now(),
+        )
+        self.message_user(
+            request, f"{num_retried} deliveries queued again", messages.SUCCESS
+        )
@@ -0,0 +1,240 @@
+from datetime import datetime
+from datetime import timezone as datetime_timezone
+
+import numpy as np
+
+# Market ticks are analyzed as NumPy columns loaded with a single values_list
+# query, so statistics over the tick history never instantiate model objects.
+TICK_COLUMNS = ("timestamp", "currency", "price", "volume", "premium")
+
+# LN <-> BTC swaps are excluded from premium stats, they should not be mixed with FIAT
+BTC_CURRENCY = 1000
+
+PERIODS = {
+    "hour": 60 * 60,
+    "day": 24 * 60 * 60,
+    "week": 7 * 24 * 60 * 60,
+}
+
+
+class Ticks:
+    """Columns of a set of market ticks, sorted by timestamp"""
+
+    def __init__(self, timestamp, currency, price, volume, premium):
+        order = np.argsort(timestamp, kind="stable")
+        self.timestamp = np.asarray(timestamp, dtype=np.float64)[order]
+        self.currency = np.asarray(currency, dtype=np.int64)[order]
+        self.price = np.asarray(price, dtype=np.float64)[order]
+        self.volume = np.asarray(volume, dtype=np.float64)[order]
+        self.premium = np.asarray(premium, dtype=np.float64)[order]
+
+    @classmethod
+    def load(cls, queryset):
+        """Loads the tick columns of a MarketTick queryset in one query"""
+        rows = list(queryset.values_list(*TICK_COLUMNS))
+        n = len(rows)
+        if n == 0:
+            return cls(*([] for _ in TICK_COLUMNS))
+
+        timestamp, currency, price, volume, premium = zip(*rows)
+        return cls(
+            np.fromiter((t.timestamp() for t in timestamp), np.float64, n),
+            np.fromiter((c or 0 for c in currency), np.int64, n),
+            _floats(price, n),
+            _floats(volume, n),
+            _floats(premium, n),
+        )
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def filter(self, mask):
+        return Ticks(
+            self.timestamp[mask],
+            self.currency[mask],
+            self.price[mask],
+            self.volume[mask],
+            self.premium[mask],
+        )
+
+    def fiat(self):
+        """Ticks of FIAT currencies only"""
+        return self.filter(self.currency != BTC_CURRENCY)
+
+    def since(self, timestamp):
+        return self.filter(self.timestamp > timestamp.timestamp())
+
+    def avg_premium(self):
+        """Volume weighted median premium of the FIAT ticks and their total volume"""
+        fiat = self.fiat()
+        if len(fiat) == 0:
+            return 0.0, 0.0
+        return weighted_median(fiat.premium, fiat.volume), float(fiat.volume.sum())
+
+    def premium_by_currency(self):
+        """Volume weighted median premium of every currency"""
+        currencies, groups = np.unique(self.currency, return_inverse=True)
+        medians = group_weighted_quantile(groups, self.premium, self.volume, 0.5)
+        return dict(zip(currencies.tolist(), medians.tolist()))
+
+    def periods(self, period, quantiles=(0.25, 0.75)):
+        """
+        Aggregates the ticks per period and currency. Returns one row per
+        (period, currency) with the number of ticks, the volume, and the
+        volume weighted median price and premium (plus premium quantiles).
+        """
+        if len(self) == 0:
+            return []
+
+        seconds = PERIODS[period]
+        bucket = (self.timestamp // seconds).astype(np.int64)
+        # A single integer key per (period, currency) keeps grouping one dimensional
+        currencies = int(self.currency.max()) + 1
+        keys, groups = np.unique(
+            bucket * currencies + self.currency, return_inverse=True
+        )
+        num_groups = len(keys)
+
+        num_ticks = np.bincount(groups, minlength=num_groups)
+        volume = np.bincount(groups, weights=self.volume, minlength=num_groups)
+        price = group_weighted_quantile(groups, self.price, self.volume, 0.5)
+        premium, *premium_quantiles = group_weighted_quantile(
+            groups, self.premium, self.volume, [0.5, *quantiles]
+        )
+
+        unique_keys = zip((keys // currencies).tolist(), (keys % currencies).tolist())
+        rows = []
+        for i, (bucket_start, currency) in enumerate(unique_keys):
+            row = {
+                "period": datetime.fromtimestamp(
+                    bucket_start * seconds, tz=datetime_timezone.utc
+                ),
+                "currency": currency,
+                "num_ticks": int(num_ticks[i]),
+                "volume": round(float(volume[i]), 8),
+                "price": round(float(price[i]), 2),
+                "premium": round(float(premium[i]), 2),
+            }
+            for q, values in zip(quantiles, premium_quantiles):
+                row[f"premium_q{round(q * 100)}"] = round(float(values[i]), 2)
+            rows.append(row)
+
+        return rows
+
+    def rolling(self, window, step):
+        """
+        Rolling volume and weighted median premium of the FIAT ticks over a
+        time window (seconds), evaluated every step (seconds).
+        Returns (ends, volumes, premiums) arrays.
+        """
+        fiat = self.fiat()
+        if len(fiat) == 0:
+            return np.array([]), np.array([]), np.array([])
+
+        first = fiat.timestamp[0] + window
+        last = fiat.timestamp[-1]
+        ends = np.arange(first, max(first, last) + step, step)
+
+        # Window boundaries are found for all the evaluation points at once
+        starts_idx = np.searchsorted(fiat.timestamp, ends - window, side="right")
+        ends_idx = np.searchsorted(fiat.timestamp, ends, side="right")
+        cumulative_volume = np.concatenate([[0.0], np.cumsum(fiat.volume)])
+        volumes = cumulative_volume[ends_idx] - cumulative_volume[starts_idx]
+
+        premiums = np.array(
+            [
+                weighted_median(fiat.premium[i:j], fiat.volume[i:j]) if j > i else 0.0
+                for i, j in zip(starts_idx, ends_idx)
+            ]
+        )
+        return ends, volumes, premiums
+
+
+def _floats(values, n):
+    return np.fromiter(
+        (np.nan if v is None else float(v) for v in values), np.float64, n
+    )
+
+
+def weighted_quantile(values, weights, quantile):
+    """Weighted quantile with the same interpolation as api.utils.weighted_median"""
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == 0:
+        return 0.0
+    groups = np.zeros(len(values), dtype=np.int64)
+    return float(group_weighted_quantile(groups, values, weights, quantile)[0])
+
+
+def weighted_median(values, weights):
+    return weighted_quantile(values, weights, 0.5)
+
+
+def group_weighted_quantile(groups, values, weights, quantile):
+    """
+    Weighted quantile(s) of values within each group, vectorized over all groups.
+    groups must be integers in [0, num_groups). Returns one value per group, or
+    an array of shape (len(quantile), num_groups) if several quantiles are given.
+
+    Values are sorted by (group, value) and each group's cumulative weight is
+    normalized to [0, 1]. Adding the group number to those positions gives a
+    single increasing array, so one searchsorted finds the quantile of every group.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    weights = np.asarray(weights, dtype=np.float64)
+    quantiles = np.atleast_1d(np.asarray(quantile, dtype=np.float64))
+    if len(values) == 0:
+        return np.empty((len(quantiles), 0)) if np.ndim(quantile) else np.array([])
+
+    # Sort by value, then stable sort by group (radix sort for small group ids)
+    sorter = np.argsort(values)
+    sorted_groups = groups[sorter]
+    if sorted_groups.max() < np.iinfo(np.uint16).max:
+        sorted_groups = sorted_groups.astype(np.uint16)
+    sorter = sorter[np.argsort(sorted_groups, kind="stable")]
+    groups, values, weights = groups[sorter], values[sorter], weights[sorter]
+    num_groups = groups[-1] + 1
+    group_ids = np.arange(num_groups)
+
+    # Positions (cumulative weight centered on each sample) relative to the group
+    positions = np.cumsum(weights) - 0.5 * weights
+    starts = np.searchsorted(groups, group_ids, side="left")
+    ends = np.searchsorted(groups, group_ids, side="right") - 1
+    empty = starts > ends
+    starts, ends = np.minimum(starts, len(groups) - 1), np.maximum(ends, 0)
+    first, last = positions[starts], positions[ends]
+    span = (last - first)[groups]
+    positions = np.where(
+        span > 0, (positions - first[groups]) / np.where(span > 0, span, 1), 0.0
+    )
+    keys = groups + positions
+
+    results = []
+    for q in quantiles:
+        targets = group_ids + q
+        right = np.clip(np.searchsorted(keys, targets, side="left"), starts, ends)
+        left = np.clip(right - 1, starts, ends)
+
+        x0, x1 = keys[left], keys[right]
+        y0, y1 = values[left], values[right]
+        gap = np.where(x1 > x0, x1 - x0, 1)
+        fraction = np.clip(np.where(x1 > x0, (targets - x0) / gap, 0.0), 0, 1)
+        result = y0 + fraction * (y1 - y0)
+
+        # Groups whose positions do not reach the quantile (single samples) use their value
+        result = np.where(keys[right] >= targets, result, values[right])
+        results.append(np.where(empty, np.nan, result))
+
+    return np.array(results) if np.ndim(quantile) else results[0]
+
+
+def latest_ticks():
+    """Last tick of every currency in a single query"""
+    from api.models import MarketTick
+
+    return {
+        tick["currency"]: tick
+        for tick in MarketTick.objects.order_by("currency", "-timestamp")
+        .distinct("currency")
+        .values("currency", "price", "volume", "premium", "timestamp")
+    }
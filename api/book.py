@@ -0,0 +1,202 @@
+import json
+import logging
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django_redis import get_redis_connection
+
+logger = logging.getLogger("api.book")
+
+# The public order book is precomputed in Redis hashes, one per currency/type bucket:
+#   book:index:{currency}:{type} -> {order_id: book entry (JSON)}
+# Currency 0 and type 2 are the "ANY" buckets, so every book query is a single HVALS.
+BOOK_KEY = "book:index:{currency}:{type}"
+BOOK_BUILT_KEY = "book:index:built"
+ANY_CURRENCY = 0
+ANY_TYPE = 2
+
+# Saving any of these order fields may change its book entry
+BOOK_FIELDS = {
+    "status",
+    "currency",
+    "type",
+    "amount",
+    "has_range",
+    "min_amount",
+    "max_amount",
+    "payment_method",
+    "is_explicit",
+    "premium",
+    "satoshis",
+    "maker",
+    "taker",
+    "expires_at",
+    "escrow_duration",
+    "bond_size",
+    "latitude",
+    "longitude",
+    "password",
+}
+
+
+def book_keys(order):
+    """The book buckets an order belongs to"""
+    return [
+        BOOK_KEY.format(currency=currency, type=type)
+        for currency in (order.currency_id, ANY_CURRENCY)
+        for type in (order.type, ANY_TYPE)
+    ]
+
+
+def is_listed(order):
+    """Only public orders without password are listed in the book"""
+    from api.models import Order
+
+    return order.status == Order.Status.PUB and order.password is None
+
+
+def book_data(order):
+    """Public view of an order in the book. maker_status is added at read time"""
+    from api.logics import Logics
+    from api.serializers import ListOrderSerializer
+
+    data = ListOrderSerializer(order).data
+    data["maker_nick"] = str(order.maker)
+    data["maker_hash_id"] = str(order.maker.robot.hash_id)
+
+    data["satoshis_now"] = Logics.satoshis_now(order)
+    # Compute current premium for those orders that are explicitly priced.
+    price, premium = Logics.price_and_premium_now(order)
+    data["price"], data["premium"] = price, str(premium)
+    for key in (
+        "status",
+        "taker",
+    ):  # Non participants should not see the status or who is the taker
+        del data[key]
+
+    return data
+
+
+def book_entry(order):
+    return json.dumps(book_data(order), cls=DjangoJSONEncoder)
+
+
+def push_book_delta(delta):
+    """Pushes a book change to the WebSocket book subscribers"""
+    from api.consumers import BOOK_GROUP, push
+
+    push(BOOK_GROUP, {"type": "book.delta", "delta": delta})
+
+
+def update_book(order):
+    """Adds, refreshes or removes an order from the book index.
+    Never raises: the periodic rebuild_book() fixes any missed update."""
+    try:
+        from api.logics import Logics
+
+        redis = get_redis_connection("default")
+        pipe = redis.pipeline()
+        if is_listed(order):
+            data = book_data(order)
+            entry = json.dumps(data, cls=DjangoJSONEncoder)
+            for key in book_keys(order):
+                pipe.hset(key, order.id, entry)
+            added = any(pipe.execute())
+            data["maker_status"] = Logics.user_activity_status(order.maker.last_login)
+            push_book_delta(
+                {
+                    "action": "add" if added else "update",
+                    "order": json.loads(json.dumps(data, cls=DjangoJSONEncoder)),
+                }
+            )
+        else:
+            for key in book_keys(order):
+                pipe.hdel(key, order.id)
+            # Only push removals of orders that were actually in the book
+            if any(pipe.execute()):
+                push_book_delta({"action": "remove", "order_id": order.id})
+    except Exception as e:
+        logger.error(f"Could not update Order({order.id}) in the book index: {e}")
+
+
+def remove_from_book(order):
+    """Removes an order from the book index"""
+    try:
+        redis = get_redis_connection("default")
+        pipe = redis.pipeline()
+        for key in book_keys(order):
+            pipe.hdel(key, order.id)
+        if any(pipe.execute()):
+            push_book_delta({"action": "remove", "order_id": order.id})
+    except Exception as e:
+        logger.error(f"Could not remove Order({order.id}) from the book index: {e}")
+
+
+def rebuild_book():
+    """Rebuilds the whole book index from the database in one Redis transaction.
+    Run on every market price refresh, since prices and amounts in sats depend on it."""
+    from api.models import Order
+
+    orders = Order.objects.filter(
+        status=Order.Status.PUB, password=None
+    ).select_related("currency", "maker__robot")
+
+    buckets = {}
+    prices = {}
+    for order in orders:
+        data = book_data(order)
+        prices[order.id] = {
+            "price": data["price"],
+            "premium": data["premium"],
+            "satoshis_now": data["satoshis_now"],
+        }
+        entry = json.dumps(data, cls=DjangoJSONEncoder)
+        for key in book_keys(order):
+            buckets.setdefault(key, {})[order.id] = entry
+
+    redis = get_redis_connection("default")
+    pipe = redis.pipeline()
+    old_keys = list(redis.scan_iter(match=BOOK_KEY.format(currency="*", type="*")))
+    if old_keys:
+        pipe.delete(*old_keys)
+    for key, entries in buckets.items():
+        pipe.hset(key, mapping=entries)
+    pipe.set(BOOK_BUILT_KEY, 1)
+    pipe.execute()
+
+    if prices:
+        push_book_delta({"action": "reprice", "prices": prices})
+
+    return len(orders)
+
+
+def get_book(currency=ANY_CURRENCY, type=ANY_TYPE):
+    """Returns the public orders of a currency/type from the book index"""
+    from api.logics import Logics
+    from api.models import Order
+
+    redis = get_redis_connection("default")
+    if not redis.exists(BOOK_BUILT_KEY):
+        rebuild_book()
+
+    entries = [
+        json.loads(entry)
+        for entry in redis.hvals(BOOK_KEY.format(currency=currency, type=type))
+    ]
+    if not entries:
+        return []
+
+    # One query adds the makers' activity and drops any order that already left the book
+    last_logins = dict(
+        Order.objects.filter(
+            id__in=[entry["id"] for entry in entries], status=Order.Status.PUB
+        ).values_list("id", "maker__last_login")
+    )
+
+    book = []
+    for entry in sorted(entries, key=lambda entry: entry["id"]):
+        if entry["id"] not in last_logins:
+            continue
+        entry["maker_status"] = Logics.user_activity_status(last_logins[entry["id"]])
+        book.append(entry)
+
+    return book
@@ -0,0 +1,135 @@
+import json
+import logging
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.utils import timezone
+
+from api.models import Order, TakeOrder
+
+logger = logging.getLogger("api.consumers")
+
+BOOK_GROUP = "book"
+
+
+def order_group(order_id):
+    return f"order_{order_id}"
+
+
+def push(group, event):
+    """Sends an event to a channel layer group from sync code (views, tasks,
+    management commands). Never raises: clients also poll as a fallback."""
+    try:
+        async_to_sync(get_channel_layer().group_send)(group, event)
+    except Exception as e:
+        logger.error(f"Could not push {event['type']} to {group}: {e}")
+
+
+def push_order_status(order, old_status, new_status):
+    """Pushes an order status change to the order participants"""
+    push(
+        order_group(order.id),
+        {
+            "type": "order.status",
+            "order_id": order.id,
+            "old_status": old_status,
+            "status": new_status,
+            "status_message": Order.Status(new_status).label,
+        },
+    )
+
+
+class BookConsumer(AsyncWebsocketConsumer):
+    """
+    Pushes the public order book. On connect the full book is sent, then
+    deltas as orders are added, updated, removed or repriced:
+        {"action": "snapshot", "orders": [...]}
+        {"action": "add" | "update", "order": {...}}
+        {"action": "remove", "order_id": id}
+        {"action": "reprice", "prices": {id: {"price", "premium", "satoshis_now"}}}
+    """
+
+    @database_sync_to_async
+    def get_snapshot(self):
+        from api.book import get_book
+
+        return get_book()
+
+    async def connect(self):
+        await self.channel_layer.group_add(BOOK_GROUP, self.channel_name)
+        await self.accept()
+        orders = await self.get_snapshot()
+        await self.send(text_data=json.dumps({"action": "snapshot", "orders": orders}))
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(BOOK_GROUP, self.channel_name)
+
+    async def book_delta(self, event):
+        await self.send(text_data=json.dumps(event["delta"]))
+
+
+class OrderConsumer(AsyncWebsocketConsumer):
+    """
+    Pushes status changes of an order to its maker, taker and pretakers.
+    Clients fetch the order endpoint only when a new status is pushed.
+    """
+
+    @database_sync_to_async
+    def get_allowed_status(self):
+        """Returns the order status if the user participates in the order"""
+        order = Order.objects.filter(id=self.order_id).first()
+        if order is None:
+            return None
+
+        is_participant = order.maker == self.user or order.taker == self.user
+        is_pretaker = TakeOrder.objects.filter(
+            order=order, taker=self.user, expires_at__gt=timezone.now()
+        ).exists()
+        if not (is_participant or is_pretaker):
+            return None
+
+        return order.status
+
+    async def connect(self):
+        self.order_id = int(self.scope["url_route"]["kwargs"]["order_id"])
+        self.user = self.scope["user"]
+        self.group_name = order_group(self.order_id)
+
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        status = await self.get_allowed_status()
+        if status is None:
+            await self.close()
+            return
+
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        await self.send(
+            text_data=json.dumps(
+                {
+                    "order_id": self.order_id,
+                    "status": status,
+                    "status_message": Order.Status(status).label,
+                }
+            )
+        )
+
+    async def disconnect(self, close_code):
+        if hasattr(self, "group_name"):
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def order_status(self, event):
+        await self.send(
+            text_data=json.dumps(
+                {
+                    "order_id": event["order_id"],
+                    "old_status": event["old_status"],
+                    "status": event["status"],
+                    "status_message": event["status_message"],
+                }
+            )
+        )
@@ -0,0 +1,367 @@
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlparse
+
+from asgiref.sync import sync_to_async
+from decouple import config
+from django.db import transaction
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from api.models import NotificationDelivery, Robot
+from api.nostr import Nostr
+from api.utils import get_session
+
+logger = logging.getLogger("api.dispatcher")
+
+# With NOTIFICATION_DISPATCHER, notifications are written to the NotificationDelivery
+# outbox and the notification_dispatcher worker delivers them, instead of the
+# send_notification task calling Telegram and webhooks itself.
+NOTIFICATION_DISPATCHER = config("NOTIFICATION_DISPATCHER", cast=bool, default=False)
+# Deliveries in flight at once, and per channel
+NOTIFICATION_MAX_IN_FLIGHT = config("NOTIFICATION_MAX_IN_FLIGHT", cast=int, default=100)
+NOTIFICATION_TELEGRAM_CONCURRENCY = config(
+    "NOTIFICATION_TELEGRAM_CONCURRENCY", cast=int, default=10
+)
+NOTIFICATION_WEBHOOK_CONCURRENCY = config(
+    "NOTIFICATION_WEBHOOK_CONCURRENCY", cast=int, default=20
+)
+NOTIFICATION_NOSTR_CONCURRENCY = config(
+    "NOTIFICATION_NOSTR_CONCURRENCY", cast=int, default=10
+)
+NOTIFICATION_TELEGRAM_TIMEOUT = config(
+    "NOTIFICATION_TELEGRAM_TIMEOUT", cast=float, default=10
+)
+NOTIFICATION_WEBHOOK_TIMEOUT = config(
+    "NOTIFICATION_WEBHOOK_TIMEOUT", cast=float, default=30
+)
+# Failed deliveries are retried with exponential backoff, then dead-lettered
+NOTIFICATION_MAX_ATTEMPTS = config("NOTIFICATION_MAX_ATTEMPTS", cast=int, default=8)
+NOTIFICATION_RETRY_SECONDS = config("NOTIFICATION_RETRY_SECONDS", cast=float, default=5)
+NOTIFICATION_MAX_RETRY_SECONDS = config(
+    "NOTIFICATION_MAX_RETRY_SECONDS", cast=float, default=3600
+)
+# Consecutive failures that open the circuit of a destination, and for how long
+NOTIFICATION_BREAKER_FAILURES = config(
+    "NOTIFICATION_BREAKER_FAILURES", cast=int, default=5
+)
+NOTIFICATION_BREAKER_SECONDS = config(
+    "NOTIFICATION_BREAKER_SECONDS", cast=float, default=60
+)
+# Claimed deliveries are not claimed again for this long (e.g. by another worker)
+NOTIFICATION_LEASE_SECONDS = config("NOTIFICATION_LEASE_SECONDS", cast=int, default=300)
+NOTIFICATION_POLL_SECONDS = config("NOTIFICATION_POLL_SECONDS", cast=float, default=5)
+
+WAKEUP_KEY = "notifications:wakeup"
+TELEGRAM_HOST = "api.telegram.org"
+
+
+def queue_deliveries(deliveries):
+    """
+    Writes deliveries to the outbox and wakes up the dispatcher once the
+    transaction they are part of commits.
+    """
+    deliveries = [delivery for delivery in deliveries if delivery is not None]
+    if not deliveries:
+        return
+    NotificationDelivery.objects.bulk_create(deliveries)
+    transaction.on_commit(wake_dispatcher)
+
+
+def wake_dispatcher():
+    redis = get_redis_connection("default")
+    redis.rpush(WAKEUP_KEY, 1)
+    redis.ltrim(WAKEUP_KEY, 0, 0)
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, so failed deliveries do not retry in lockstep"""
+    delay = min(
+        NOTIFICATION_RETRY_SECONDS * 2 ** (attempts - 1),
+        NOTIFICATION_MAX_RETRY_SECONDS,
+    )
+    return delay * random.uniform(1, 1.25)
+
+
+class DeliveryError(Exception):
+    """
+    A delivery failed. Permanent errors (e.g. the chat was deleted) are
+    dead-lettered at once, the rest are retried, not before retry_after
+    seconds if the destination asked for it.
+    """
+
+    def __init__(self, message, permanent=False, retry_after=None):
+        super().__init__(message)
+        self.permanent = permanent
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Stops deliveries to a destination after NOTIFICATION_BREAKER_FAILURES
+    consecutive failures. Once NOTIFICATION_BREAKER_SECONDS have passed,
+    a single delivery probes the destination and closes the circuit again
+    if it succeeds.
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def reopens_at(self):
+        return self.opened_at + NOTIFICATION_BREAKER_SECONDS
+
+    def allow(self, now):
+        if self.opened_at is None:
+            return True
+        if now >= self.reopens_at and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def held_until(self, now):
+        """When a delivery the circuit did not allow is tried again"""
+        if now < self.reopens_at:
+            return self.reopens_at
+        # A probe is in flight, its outcome decides whether the circuit closes
+        return now + NOTIFICATION_BREAKER_SECONDS
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self, now):
+        self.failures += 1
+        self.probing = False
+        if self.failures >= NOTIFICATION_BREAKER_FAILURES:
+            self.opened_at = now
+
+
+class NotificationDispatcher:
+    """
+    Delivers the NotificationDelivery outbox concurrently, over pooled
+    connections, with a concurrency limit per channel, exponential backoff,
+    dead-lettering, and a circuit breaker per destination so one slow or
+    failing webhook does not hold up the other deliveries.
+    """
+
+    def __init__(self, session=None, nostr_client=None):
+        concurrency = {
+            NotificationDelivery.Channels.TELEGRAM: NOTIFICATION_TELEGRAM_CONCURRENCY,
+            NotificationDelivery.Channels.WEBHOOK: NOTIFICATION_WEBHOOK_CONCURRENCY,
+            NotificationDelivery.Channels.NOSTR: NOTIFICATION_NOSTR_CONCURRENCY,
+        }
+        self.limits = {
+            channel: asyncio.Semaphore(limit) for channel, limit in concurrency.items()
+        }
+        http_concurrency = (
+            NOTIFICATION_TELEGRAM_CONCURRENCY + NOTIFICATION_WEBHOOK_CONCURRENCY
+        )
+        self.session = session or get_session(pool_maxsize=http_concurrency)
+        # requests is blocking, HTTP calls run in their own threads
+        self.executor = ThreadPoolExecutor(max_workers=http_concurrency)
+        self.nostr = Nostr()
+        self.nostr_client = nostr_client
+        self.nostr_connecting = asyncio.Lock()
+        self.breakers = {}
+        self.in_flight = set()
+        self.redis = get_redis_connection("default")
+
+    def claim(self, limit, exclude=()):
+        """
+        Leases up to limit pending deliveries that are due, skipping those
+        leased by other dispatchers and the ids in exclude (in flight).
+        """
+        now = timezone.now()
+        with transaction.atomic():
+            ids = list(
+                NotificationDelivery.objects.select_for_update(skip_locked=True)
+                .filter(
+                    status=NotificationDelivery.Status.PENDING,
+                    next_attempt_at__lte=now,
+                )
+                .exclude(id__in=exclude)
+                .order_by("next_attempt_at")
+                .values_list("id", flat=True)[:limit]
+            )
+            NotificationDelivery.objects.filter(id__in=ids).update(
+                next_attempt_at=now + timedelta(seconds=NOTIFICATION_LEASE_SECONDS)
+            )
+        return list(
+            NotificationDelivery.objects.select_related("robot", "order").filter(
+                id__in=ids
+            )
+        )
+
+    def wait(self):
+        """Waits until a notification is queued or NOTIFICATION_POLL_SECONDS pass"""
+        if self.redis.blpop(WAKEUP_KEY, timeout=NOTIFICATION_POLL_SECONDS):
+            self.redis.delete(WAKEUP_KEY)
+
+    def breaker(self, delivery):
+        """Circuit breaker of the destination host of a delivery"""
+        if delivery.channel == NotificationDelivery.Channels.WEBHOOK:
+            host = urlparse(delivery.destination).hostname
+        elif delivery.channel == NotificationDelivery.Channels.TELEGRAM:
+            host = TELEGRAM_HOST
+        else:
+            host = "nostr"
+        return self.breakers.setdefault(host, CircuitBreaker())
+
+    @sync_to_async
+    def delivered(self, delivery):
+        NotificationDelivery.objects.filter(id=delivery.id).delete()
+
+    @sync_to_async
+    def postpone(self, delivery, until):
+        """Holds a delivery while its destination circuit is open, without counting an attempt"""
+        NotificationDelivery.objects.filter(id=delivery.id).update(
+            next_attempt_at=timezone.now() + timedelta(seconds=until - time.time())
+        )
+
+    @sync_to_async
+    def failed(self, delivery, error):
+        """Schedules the retry of a failed delivery, or dead-letters it"""
+        attempts = delivery.attempts + 1
+        permanent = isinstance(error, DeliveryError) and error.permanent
+        if permanent or attempts >= NOTIFICATION_MAX_ATTEMPTS:
+            logger.error(
+                f"Dead-lettering {delivery} after {attempts} attempts: {error}"
+            )
+            NotificationDelivery.objects.filter(id=delivery.id).update(
+                status=NotificationDelivery.Status.DEAD,
+                attempts=attempts,
+                last_error=str(error),
+            )
+            return
+
+        delay = retry_delay(attempts)
+        if isinstance(error, DeliveryError) and error.retry_after:
+            delay = max(delay, error.retry_after)
+        logger.warning(f"Could not deliver {delivery}: {error}")
+        NotificationDelivery.objects.filter(id=delivery.id).update(
+            attempts=attempts,
+            next_attempt_at=timezone.now() + timedelta(seconds=delay),
+            last_error=str(error),
+        )
+
+    async def post(self, url, timeout, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            lambda: self.session.post(url, timeout=timeout, **kwargs),
+        )
+
+    async def send_telegram(self, delivery):
+        bot_token = config("TELEGRAM_TOKEN")
+        response = await self.post(
+            f"https://{TELEGRAM_HOST}/bot{bot_token}/sendMessage",
+            NOTIFICATION_TELEGRAM_TIMEOUT,
+            json={"chat_id": delivery.destination, "text": delivery.payload["text"]},
+        )
+        if response.status_code == 429:
+            retry_after = response.json().get("parameters", {}).get("retry_after")
+            raise DeliveryError("Telegram rate limit", retry_after=retry_after)
+        if 400 <= response.status_code < 500:
+            # e.g. the chat does not exist or the user blocked the bot
+            raise DeliveryError(
+                f"Telegram rejected the message: {response.text}", permanent=True
+            )
+        response.raise_for_status()
+
+    async def send_webhook(self, delivery):
+        if not Robot.is_valid_onion_url(delivery.destination):
+            raise DeliveryError("Webhook URL is not a .onion address", permanent=True)
+
+        headers = {"Content-Type": "application/json"}
+        if delivery.robot is not None and delivery.robot.webhook_api_key:
+            headers["X-API-Key"] = delivery.robot.webhook_api_key
+
+        response = await self.post(
+            delivery.destination,
+            NOTIFICATION_WEBHOOK_TIMEOUT,
+            json=delivery.payload,
+            headers=headers,
+        )
+        if response.status_code in (408, 429):
+            raise DeliveryError(f"Webhook answered {response.status_code}")
+        if 400 <= response.status_code < 500:
+            raise DeliveryError(
+                f"Webhook rejected the notification: {response.status_code}",
+                permanent=True,
+            )
+        response.raise_for_status()
+
+    async def send_nostr(self, delivery):
+        if delivery.robot is None or delivery.order is None:
+            raise DeliveryError("Robot or order no longer exists", permanent=True)
+        event = await self.nostr.build_notification_event(
+            delivery.robot, delivery.order, delivery.payload["text"]
+        )
+        if event is None:
+            return
+
+        async with self.nostr_connecting:
+            if self.nostr_client is None:
+                self.nostr_client = await self.nostr.initialize_client()
+        output = await self.nostr_client.send_event(event)
+        if not output.success:
+            raise DeliveryError(f"Relays rejected the event: {output.failed}")
+
+    async def send(self, delivery):
+        if delivery.channel == NotificationDelivery.Channels.TELEGRAM:
+            await self.send_telegram(delivery)
+        elif delivery.channel == NotificationDelivery.Channels.WEBHOOK:
+            await self.send_webhook(delivery)
+        else:
+            await self.send_nostr(delivery)
+
+    async def deliver(self, delivery):
+        """Delivers a claimed delivery, returns whether it succeeded"""
+        breaker = self.breaker(delivery)
+        try:
+            async with self.limits[delivery.channel]:
+                now = time.time()
+                if not breaker.allow(now):
+                    await self.postpone(delivery, breaker.held_until(now))
+                    return False
+                try:
+                    await self.send(delivery)
+                except Exception as e:
+                    # A destination that rejects a delivery is still up
+                    if isinstance(e, DeliveryError) and e.permanent:
+                        breaker.success()
+                    else:
+                        breaker.failure(time.time())
+                    await self.failed(delivery, e)
+                    return False
+                breaker.success()
+                await self.delivered(delivery)
+                return True
+        finally:
+            self.in_flight.discard(delivery.id)
+
+    async def run(self):
+        tasks = set()
+        while True:
+            free = NOTIFICATION_MAX_IN_FLIGHT - len(tasks)
+            if free <= 0:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            deliveries = await sync_to_async(self.claim)(free, set(self.in_flight))
+            for delivery in deliveries:
+                self.in_flight.add(delivery.id)
+                task = asyncio.create_task(self.deliver(delivery))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+            if not deliveries:
+                await asyncio.to_thread(self.wait)
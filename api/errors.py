@@ -62,6 +62,8 @@ ERRORS = {
     1054: "Cannot open a dispute yet. You need to wait until 18 hours before expiry.",
     1055: "This public key is already in use by another active robot.",
     1056: "Your PGP public key was created too recently ({key_creation_date}). Keys must be at least 12 hours old. Please check your system clock and generate a new key.",
+    1057: "Invalid period. Valid periods are hour, day and week",
+    1058: "More than {max_ticks} market ticks have been found to aggregate. Please, narrow the date range",
     # 2000 - Bad statement
     2000: "The statement and chat logs are longer than 50,000 characters",
     2001: "The statement is too short. Make sure to be thorough.",
@@ -0,0 +1,195 @@
+import logging
+import time
+
+from decouple import config
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from api.shards import NUM_SHARDS, filter_shards, shard_of
+
+logger = logging.getLogger("api.expiry")
+
+# Orders and take orders waiting to expire are kept in Redis sorted sets scored
+# by their expires_at timestamp, so the next deadline and the batch of due ids are
+# single ZRANGE calls. Every save that changes an order status or expiry re-schedules it.
+# There is one sorted set per shard (api.shards), so clean_orders replicas only read
+# the orders of the shards they own.
+ORDERS_KEY = "expiry:orders"
+TAKE_ORDERS_KEY = "expiry:take_orders"
+# Pushed on every (re)schedule, so the scheduler wakes up to recompute its next deadline
+WAKEUP_KEY = "expiry:wakeup"
+
+EXPIRY_BATCH_SIZE = config("EXPIRY_BATCH_SIZE", cast=int, default=100)
+EXPIRY_RETRY_SECONDS = config("EXPIRY_RETRY_SECONDS", cast=int, default=5)
+
+# Saving any of these order fields may change when (or whether) it expires
+EXPIRY_FIELDS = {"status", "expires_at"}
+
+
+def no_expiry_statuses():
+    """Orders in these statuses are not sent to expire"""
+    from api.models import Order
+
+    return [
+        Order.Status.UCA,
+        Order.Status.EXP,
+        Order.Status.DIS,
+        Order.Status.CCA,
+        Order.Status.PAY,
+        Order.Status.SUC,
+        Order.Status.FAI,
+        Order.Status.MLD,
+        Order.Status.TLD,
+        Order.Status.WFR,
+    ]
+
+
+def expiry_statuses():
+    """Orders in these statuses are sent to expire when their time runs out"""
+    from api.models import Order
+
+    return [status for status in Order.Status if status not in no_expiry_statuses()]
+
+
+def deadline(expires_at):
+    if timezone.is_naive(expires_at):
+        expires_at = timezone.make_aware(expires_at)
+    return expires_at.timestamp()
+
+
+def shard_key(key, shard):
+    return f"{key}:{shard}"
+
+
+def schedule(key, id, expires_at, shard):
+    wakeup_key = shard_key(WAKEUP_KEY, shard)
+    redis = get_redis_connection("default")
+    pipe = redis.pipeline()
+    pipe.zadd(shard_key(key, shard), {id: deadline(expires_at)})
+    pipe.lpush(wakeup_key, 1)
+    pipe.ltrim(wakeup_key, 0, 0)
+    pipe.execute()
+
+
+def unschedule(key, id, shard):
+    get_redis_connection("default").zrem(shard_key(key, shard), id)
+
+
+def schedule_order(order):
+    """(Re)schedules the expiry of an order, or drops it if it can no longer expire.
+    Never raises: the scheduler reconciles with the database periodically."""
+    try:
+        if order.status in no_expiry_statuses() or order.expires_at is None:
+            unschedule(ORDERS_KEY, order.id, shard_of(order.id))
+        else:
+            schedule(ORDERS_KEY, order.id, order.expires_at, shard_of(order.id))
+    except Exception as e:
+        logger.error(f"Could not schedule the expiry of Order({order.id}): {e}")
+
+
+def unschedule_order(order):
+    try:
+        unschedule(ORDERS_KEY, order.id, shard_of(order.id))
+    except Exception as e:
+        logger.error(f"Could not unschedule the expiry of Order({order.id}): {e}")
+
+
+def schedule_take_order(take_order):
+    """Take orders are in the shard of their order, so one replica handles both"""
+    try:
+        shard = shard_of(take_order.order_id)
+        schedule(TAKE_ORDERS_KEY, take_order.id, take_order.expires_at, shard)
+    except Exception as e:
+        logger.error(
+            f"Could not schedule the expiry of TakeOrder({take_order.id}): {e}"
+        )
+
+
+def unschedule_take_order(take_order):
+    try:
+        unschedule(TAKE_ORDERS_KEY, take_order.id, shard_of(take_order.order_id))
+    except Exception as e:
+        logger.error(
+            f"Could not unschedule the expiry of TakeOrder({take_order.id}): {e}"
+        )
+
+
+def pop_due(key, shard, limit=EXPIRY_BATCH_SIZE):
+    """Removes and returns up to `limit` ids of a shard whose deadline has passed.
+    Ids are claimed one by one (ZREM returns 1 only to the first scheduler that
+    removes it), so two schedulers never expire the same order twice.
+    Re-saving an order while it expires schedules it again."""
+    key = shard_key(key, shard)
+    redis = get_redis_connection("default")
+    ids = redis.zrangebyscore(key, "-inf", time.time(), start=0, num=limit)
+    if not ids:
+        return []
+
+    pipe = redis.pipeline()
+    for id in ids:
+        pipe.zrem(key, id)
+    claimed = pipe.execute()
+    return [int(id) for id, removed in zip(ids, claimed) if removed]
+
+
+def retry(key, shard, ids):
+    """Schedules ids whose expiry failed to be retried in EXPIRY_RETRY_SECONDS"""
+    if ids:
+        retry_at = time.time() + EXPIRY_RETRY_SECONDS
+        get_redis_connection("default").zadd(
+            shard_key(key, shard), {id: retry_at for id in ids}
+        )
+
+
+def next_deadline(shards=range(NUM_SHARDS)):
+    """Earliest deadline of the scheduled orders and take orders of some shards,
+    None if idle"""
+    redis = get_redis_connection("default")
+    pipe = redis.pipeline()
+    for shard in shards:
+        pipe.zrange(shard_key(ORDERS_KEY, shard), 0, 0, withscores=True)
+        pipe.zrange(shard_key(TAKE_ORDERS_KEY, shard), 0, 0, withscores=True)
+    deadlines = [entries[0][1] for entries in pipe.execute() if entries]
+    return min(deadlines) if deadlines else None
+
+
+def wait_for_next_deadline(max_wait, shards=range(NUM_SHARDS)):
+    """Blocks until the next deadline, a new schedule or max_wait seconds"""
+    if not shards:
+        time.sleep(max_wait)
+        return
+
+    redis = get_redis_connection("default")
+    next_at = next_deadline(shards)
+    timeout = max_wait if next_at is None else min(max_wait, next_at - time.time())
+    if timeout <= 0:
+        return
+    # BLPOP accepts sub-second timeouts, wakes up right away on a new schedule
+    wakeup_keys = [shard_key(WAKEUP_KEY, shard) for shard in shards]
+    redis.blpop(wakeup_keys, timeout=max(timeout, 0.001))
+
+
+def rebuild_expiry(shards=range(NUM_SHARDS)):
+    """Adds every expirable order and take order of some shards in the database to
+    the schedules (uses the status, expires_at index), healing any missed schedule.
+    Entries that should not be there are dropped when due, after checking them in
+    the database. Returns the number of scheduled orders and take orders."""
+    from api.models import Order, TakeOrder
+
+    orders = filter_shards(
+        Order.objects.filter(status__in=expiry_statuses()), "id", shards
+    ).values_list("id", "expires_at")
+    take_orders = filter_shards(
+        TakeOrder.objects.all(), "order_id", shards
+    ).values_list("id", "expires_at", "order_id")
+
+    redis = get_redis_connection("default")
+    pipe = redis.pipeline()
+    for id, expires_at in orders:
+        pipe.zadd(shard_key(ORDERS_KEY, shard_of(id)), {id: deadline(expires_at)})
+    for id, expires_at, order_id in take_orders:
+        shard = shard_of(order_id)
+        pipe.zadd(shard_key(TAKE_ORDERS_KEY, shard), {id: deadline(expires_at)})
+    pipe.execute()
+
+    return len(orders), len(take_orders)
@@ -4,6 +4,7 @@ import random
 import secrets
 import struct
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import grpc
@@ -34,6 +35,7 @@ CLN_GRPC_HOST = config("CLN_GRPC_HOST", cast=str, default="localhost:9999")
 CLN_GRPC_HOLD_HOST = config("CLN_GRPC_HOLD_HOST", cast=str, default="localhost:9998")
 DISABLE_ONCHAIN = config("DISABLE_ONCHAIN", cast=bool, default=True)
 MAX_SWAP_AMOUNT = config("MAX_SWAP_AMOUNT", cast=int, default=500000)
+LOOKUP_INVOICE_CONCURRENCY = config("LOOKUP_INVOICE_CONCURRENCY", cast=int, default=16)
 
 
 class CLNNode:
@@ -49,6 +51,9 @@ class CLNNode:
     hold_channel = grpc.secure_channel(CLN_GRPC_HOLD_HOST, creds)
     node_channel = grpc.secure_channel(CLN_GRPC_HOST, creds)
 
+    # The holdinvoice plugin has no server-streaming RPC, hold invoices are polled
+    streams_hold_invoices = False
+
     payment_failure_context = {
         -1: "Catchall nonspecific error.",
         201: "Already paid with this hash using different amount or destination.",
@@ -435,6 +440,26 @@ class CLNNode:
 
         return status, expiry_height
 
+    @classmethod
+    def lookup_invoice_statuses(cls, lnpayments):
+        """
+        Looks up many hold invoices at once. Lookups run concurrently over the
+        shared channel, at most LOOKUP_INVOICE_CONCURRENCY at a time.
+        Returns a dict {payment_hash: (status, expiry_height)}
+        """
+        lnpayments = list(lnpayments)
+        if not lnpayments:
+            return {}
+
+        max_workers = min(LOOKUP_INVOICE_CONCURRENCY, len(lnpayments))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(cls.lookup_invoice_status, lnpayments)
+
+            return {
+                lnpayment.payment_hash: result
+                for lnpayment, result in zip(lnpayments, results)
+            }
+
     @classmethod
     def resetmc(cls):
         # don't think an equivalent exists for cln, maybe deleting gossip_store file?
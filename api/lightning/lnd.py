@@ -4,6 +4,7 @@ import secrets
 import struct
 import time
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import grpc
@@ -45,6 +46,7 @@ except Exception:
 LND_GRPC_HOST = config("LND_GRPC_HOST")
 DISABLE_ONCHAIN = config("DISABLE_ONCHAIN", cast=bool, default=True)
 MAX_SWAP_AMOUNT = config("MAX_SWAP_AMOUNT", cast=int, default=500_000)
+LOOKUP_INVOICE_CONCURRENCY = config("LOOKUP_INVOICE_CONCURRENCY", cast=int, default=16)
 
 
 # Logger function used to build tests/mocks/lnd.py
@@ -69,6 +71,9 @@ class LNDNode:
     combined_creds = grpc.composite_channel_credentials(ssl_creds, auth_creds)
     channel = grpc.secure_channel(LND_GRPC_HOST, combined_creds)
 
+    # SubscribeSingleInvoice streams every hold invoice state change
+    streams_hold_invoices = True
+
     payment_failure_context = {
         0: "Payment isn't failed (yet)",
         1: "There are more routes to try, but the payment timeout was exceeded.",
@@ -309,14 +314,14 @@ class LNDNode:
             return True
 
     @classmethod
-    def lookup_invoice_status(cls, lnpayment):
+    def invoice_status_from_response(cls, response):
         """
-        Returns the status (as LNpayment.Status) of the given payment_hash
-        If unchanged, returns the previous status
+        Returns the status (as LNpayment.Status) and the highest HTLC expiry
+        height of a lnrpc.Invoice, as returned by LookupInvoiceV2 or streamed
+        by SubscribeSingleInvoice
         """
         from api.models import LNPayment
 
-        status = lnpayment.status
         expiry_height = 0
 
         lnd_response_state_to_lnpayment_status = {
@@ -326,6 +331,29 @@ class LNDNode:
             3: LNPayment.Status.LOCKED,  # ACCEPTED
         }
 
+        status = lnd_response_state_to_lnpayment_status[response.state]
+
+        # get expiry height
+        if hasattr(response, "htlcs"):
+            try:
+                for htlc in response.htlcs:
+                    expiry_height = max(expiry_height, htlc.expiry_height)
+            except Exception:
+                pass
+
+        return status, expiry_height
+
+    @classmethod
+    def lookup_invoice_status(cls, lnpayment):
+        """
+        Returns the status (as LNpayment.Status) of the given payment_hash
+        If unchanged, returns the previous status
+        """
+        from api.models import LNPayment
+
+        status = lnpayment.status
+        expiry_height = 0
+
         try:
             # this is similar to LNNnode.validate_hold_invoice_locked
             request = invoices_pb2.LookupInvoiceMsg(
@@ -335,15 +363,7 @@ class LNDNode:
             response = invoicesstub.LookupInvoiceV2(request)
             log("invoices_pb2_grpc.LookupInvoiceV2", request, response)
 
-            status = lnd_response_state_to_lnpayment_status[response.state]
-
-            # get expiry height
-            if hasattr(response, "htlcs"):
-                try:
-                    for htlc in response.htlcs:
-                        expiry_height = max(expiry_height, htlc.expiry_height)
-                except Exception:
-                    pass
+            status, expiry_height = cls.invoice_status_from_response(response)
 
         except Exception as e:
             # If it fails at finding the invoice: it has been canceled.
@@ -362,6 +382,43 @@ class LNDNode:
 
         return status, expiry_height
 
+    @classmethod
+    def lookup_invoice_statuses(cls, lnpayments):
+        """
+        Looks up many hold invoices at once. Lookups run concurrently over the
+        shared channel, at most LOOKUP_INVOICE_CONCURRENCY at a time.
+        Returns a dict {payment_hash: (status, expiry_height)}
+        """
+        lnpayments = list(lnpayments)
+        if not lnpayments:
+            return {}
+
+        max_workers = min(LOOKUP_INVOICE_CONCURRENCY, len(lnpayments))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(cls.lookup_invoice_status, lnpayments)
+
+            return {
+                lnpayment.payment_hash: result
+                for lnpayment, result in zip(lnpayments, results)
+            }
+
+    @classmethod
+    def subscribe_hold_invoice(cls, payment_hash):
+        """
+        Opens a SubscribeSingleInvoice stream for a hold invoice. Unlike
+        SubscribeInvoices, LND pushes an update on every state change of the
+        invoice (OPEN, ACCEPTED, SETTLED and CANCELED). All streams are
+        multiplexed over the single HTTP/2 cls.channel.
+
+        Returns the gRPC call: iterate it to receive lnrpc.Invoice updates
+        (see invoice_status_from_response) and call .cancel() to close it.
+        """
+        request = invoices_pb2.SubscribeSingleInvoiceRequest(
+            r_hash=bytes.fromhex(payment_hash)
+        )
+        invoicesstub = invoices_pb2_grpc.InvoicesStub(cls.channel)
+        return invoicesstub.SubscribeSingleInvoice(request)
+
     # UNUSED
     # @classmethod
     # def resetmc(cls):
@@ -3,11 +3,12 @@ from datetime import timedelta
 
 from decouple import config, Csv
 from django.contrib.auth.models import User
-from django.db.models import Q, Sum
+from django.db.models import Sum
 from django.utils import timezone
 from django.utils.html import format_html
 from django.db import transaction
 
+from api.active_orders import get_active_order
 from api.lightning.node import LNNode
 from api.errors import new_error
 from api.models import (
@@ -46,64 +47,12 @@ GEOBLOCKED_COUNTRIES = config("GEOBLOCKED_COUNTRIES", cast=Csv(), default="")
 class Logics:
     @classmethod
     def validate_already_maker_or_taker(cls, user):
-        """Validates if a use is already not part of an active order"""
-
-        active_order_status = [
-            Order.Status.WFB,
-            Order.Status.PUB,
-            Order.Status.PAU,
-            Order.Status.TAK,
-            Order.Status.WF2,
-            Order.Status.WFE,
-            Order.Status.WFI,
-            Order.Status.CHA,
-            Order.Status.FSE,
-            Order.Status.DIS,
-            Order.Status.WFR,
-        ]
-        """Checks if the user is already partipant of an active order"""
-        queryset_maker = Order.objects.filter(
-            maker=user, status__in=active_order_status
-        )
-        if queryset_maker.exists():
-            return (
-                False,
-                new_error(1000),
-                queryset_maker[0],
-            )
-
-        queryset_taker = Order.objects.filter(
-            taker=user, status__in=active_order_status
-        )
-        queryset_pretaker = TakeOrder.objects.filter(
-            taker=user, expires_at__gt=timezone.now()
-        )
-        if queryset_taker.exists():
-            return (
-                False,
-                new_error(1001),
-                queryset_taker[0],
-            )
-        elif queryset_pretaker.exists():
-            return (
-                False,
-                new_error(1002),
-                queryset_pretaker[0].order,
-            )
-
-        # Edge case when the user is in an order that is failing payment and he is the buyer
-        queryset = Order.objects.filter(
-            Q(maker=user) | Q(taker=user),
-            status__in=[Order.Status.FAI, Order.Status.PAY],
-        )
-        if queryset.exists():
-            order = queryset[0]
-            if cls.is_buyer(order, user):
-                return (
-                    False,
-                    new_error(1003),
-                    order,
-                )
+        """Validates if a use is already not part of an active order.
+        As maker (1000), taker (1001), pretaker (1002) or buyer of an order
+        that is failing payment (1003). A single query (see api.active_orders)."""
+        error_code, order = get_active_order(user)
+        if error_code is not None:
+            return False, new_error(error_code), order
 
         return True, None, None
 
@@ -206,22 +155,27 @@ class Logics:
             )
             return True, None
 
-    def is_buyer(order, user):
-        is_maker = order.maker == user
-        is_taker = order.taker == user
-        is_pretaker = TakeOrder.objects.filter(
+    def is_pretaker(order, user):
+        return TakeOrder.objects.filter(
             taker=user, order=order, expires_at__gt=timezone.now()
         ).exists()
+
+    @classmethod
+    def is_buyer(cls, order, user):
+        is_maker = order.maker == user
+        is_taker = order.taker == user
+        # Only look up take orders if the user is not already a participant
+        is_pretaker = not (is_maker or is_taker) and cls.is_pretaker(order, user)
         return (is_maker and order.type == Order.Types.BUY) or (
             (is_pretaker or is_taker) and order.type == Order.Types.SELL
         )
 
-    def is_seller(order, user):
+    @classmethod
+    def is_seller(cls, order, user):
         is_maker = order.maker == user
         is_taker = order.taker == user
-        is_pretaker = TakeOrder.objects.filter(
-            taker=user, order=order, expires_at__gt=timezone.now()
-        ).exists()
+        # Only look up take orders if the user is not already a participant
+        is_pretaker = not (is_maker or is_taker) and cls.is_pretaker(order, user)
         return (is_maker and order.type == Order.Types.SELL) or (
             (is_pretaker or is_taker) and order.type == Order.Types.BUY
         )
@@ -678,7 +632,7 @@ class Logics:
         ):  # Not enough onchain balance to commit for this swap.
             return False
 
-        suggested_mining_fee_rate = get_minning_fee("suggested", preliminary_amount)
+        suggested_mining_fee_rate = get_minning_fee("suggested")
 
         # Hardcap mining fee suggested at 1000 sats/vbyte
         if suggested_mining_fee_rate > 1000:
@@ -832,7 +786,7 @@ class Logics:
         num_satoshis = cls.payout_amount(order, user)[1]["invoice_amount"]
         if mining_fee_rate:
             # not a valid mining fee
-            min_mining_fee_rate = get_minning_fee("minimum", num_satoshis)
+            min_mining_fee_rate = get_minning_fee("minimum")
 
             min_mining_fee_rate = max(2, min_mining_fee_rate)
 
@@ -1223,6 +1177,7 @@ class Logics:
 
     @classmethod
     def publish_order(cls, order):
+        old_status = order.status
         order.status = Order.Status.PUB
         order.expires_at = order.created_at + timedelta(
             seconds=order.t_to_expire(Order.Status.PUB)
@@ -1240,6 +1195,7 @@ class Logics:
         order.payout_tx = None
 
         order.save()  # update all fields
+        order.log_status_transition(old_status, order.status)
 
         nostr_send_order_event.delay(order_id=order.id)
 
@@ -1358,6 +1314,7 @@ class Logics:
         order.expires_at = timezone.now() + timedelta(
             seconds=order.t_to_expire(Order.Status.WF2)
         )
+        old_status = order.status
         order.status = Order.Status.WF2
         order.save(
             update_fields=[
@@ -1370,6 +1327,7 @@ class Logics:
                 "expires_at",
             ]
         )
+        order.log_status_transition(old_status, order.status)
 
         order.taker_bond.status = LNPayment.Status.LOCKED
         order.taker_bond.save(update_fields=["status"])
@@ -4,11 +4,26 @@ from django.core.management.base import BaseCommand
 from django.utils import timezone
 from decouple import config
 
+from api.expiry import (
+    EXPIRY_BATCH_SIZE,
+    ORDERS_KEY,
+    TAKE_ORDERS_KEY,
+    expiry_statuses,
+    no_expiry_statuses,
+    pop_due,
+    rebuild_expiry,
+    retry,
+    schedule_order,
+    schedule_take_order,
+    wait_for_next_deadline,
+)
 from api.logics import Logics
 from api.models import Order, TakeOrder
+from api.shards import WORKER_HEARTBEAT_SECONDS, ShardLeases, filter_shards
 
 
 LNVENDOR = config("LNVENDOR", cast=str, default="LND")
+EXPIRY_RECONCILE_SECONDS = config("EXPIRY_RECONCILE_SECONDS", cast=int, default=300)
 
 
 def invoice_lookup_error(exc_string: str) -> bool:
@@ -28,99 +43,195 @@ def invoice_lookup_error(exc_string: str) -> bool:
 class Command(BaseCommand):
     help = "Follows all active orders and make them expire if needed."
 
-    do_nothing = [
-        Order.Status.UCA,
-        Order.Status.EXP,
-        Order.Status.DIS,
-        Order.Status.CCA,
-        Order.Status.PAY,
-        Order.Status.SUC,
-        Order.Status.FAI,
-        Order.Status.MLD,
-        Order.Status.TLD,
-        Order.Status.WFR,
-    ]
+    do_nothing = no_expiry_statuses()
 
-    def clean_orders(self):
-        """Continuously checks order expiration times. If order
-        has expires, it calls the logics module for expiration handling."""
-
-        queryset = Order.objects.exclude(status__in=self.do_nothing)
-        queryset = queryset.filter(
-            expires_at__lt=timezone.now()
-        )  # expires at lower than now
-
-        debug = {}
-        debug["num_expired_orders"] = len(queryset)
-        debug["expired_orders"] = []
-        debug["failed_order_expiry"] = []
-        debug["reason_failure"] = []
-
-        for idx, order in enumerate(queryset):
-            context = str(order) + " was " + Order.Status(order.status).label
-            try:
-                if Logics.order_expires(order):  # Order send to expire here
-                    debug["expired_orders"].append({idx: context})
-
-                    # expire all related take orders
-                    take_orders_queryset = TakeOrder.objects.filter(
-                        order=order, expires_at__gt=timezone.now()
-                    )
-                    for idx, take_order in enumerate(take_orders_queryset):
-                        Logics.take_order_expires(take_order)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Replicas run with WORKER_SHARDING only expire the orders of their shards
+        self.leases = ShardLeases("clean_orders")
 
-            # It should not happen, but if it cannot locate the hold invoice
-            # it probably was cancelled by another thread, make it expire anyway.
-            except Exception as e:
-                debug["failed_order_expiry"].append({idx: context})
-                debug["reason_failure"].append({idx: str(e)})
+    def due_orders(self, shard):
+        """Batch of orders of a shard whose time ran out. Popped from the expiry
+        schedule, or from the (status, expires_at) index if the schedule is
+        unreachable. Returns the orders and whether they came from the schedule."""
+        try:
+            ids = pop_due(ORDERS_KEY, shard)
+        except Exception as e:
+            self.stdout.write(f"Expiry schedule unavailable: {e}")
+            queryset = Order.objects.filter(
+                status__in=expiry_statuses(), expires_at__lt=timezone.now()
+            )
+            queryset = filter_shards(queryset, "id", [shard])
+            return list(queryset[:EXPIRY_BATCH_SIZE]), False
+
+        orders = []
+        # Orders deleted or moved to a status that does not expire are dropped
+        for order in Order.objects.filter(id__in=ids, status__in=expiry_statuses()):
+            if order.expires_at > timezone.now():
+                schedule_order(order)  # Expiry was extended since it was scheduled
+            else:
+                orders.append(order)
+        return orders, True
+
+    def due_take_orders(self, shard):
+        try:
+            ids = pop_due(TAKE_ORDERS_KEY, shard)
+        except Exception as e:
+            self.stdout.write(f"Expiry schedule unavailable: {e}")
+            queryset = TakeOrder.objects.filter(expires_at__lt=timezone.now())
+            queryset = filter_shards(queryset, "order_id", [shard])
+            return list(queryset[:EXPIRY_BATCH_SIZE]), False
+
+        take_orders = []
+        for take_order in TakeOrder.objects.filter(id__in=ids):
+            if take_order.expires_at > timezone.now():
+                schedule_take_order(take_order)
+            else:
+                take_orders.append(take_order)
+        return take_orders, True
+
+    def retry(self, key, shard, ids):
+        try:
+            retry(key, shard, ids)
+        except Exception as e:
+            self.stdout.write(f"Could not reschedule expiry of {ids}: {e}")
 
-                if invoice_lookup_error(str(e)):
-                    self.stdout.write(str(e))
-                    order.update_status(Order.Status.EXP)
-                    debug["expired_orders"].append({idx: context})
+    def clean_orders(self):
+        """Expires every order and take order of the owned shards whose time
+        has run out."""
+        for shard in sorted(self.leases.keep_alive()):
+            # Leases are renewed between batches, a shard lost meanwhile is skipped
+            if shard in self.leases.keep_alive():
+                self.clean_shard(shard)
+
+    def clean_shard(self, shard):
+        """Due orders are popped from the expiry schedule in batches of
+        EXPIRY_BATCH_SIZE, so each pass only touches orders that are due.
+        If an order fails to expire it is retried in EXPIRY_RETRY_SECONDS."""
+
+        from_schedule = True
+        while from_schedule:
+            orders, from_schedule = self.due_orders(shard)
+            if not orders:
+                break
+
+            debug = {}
+            debug["num_expired_orders"] = len(orders)
+            debug["expired_orders"] = []
+            debug["failed_order_expiry"] = []
+            debug["reason_failure"] = []
+            failed = []
+
+            for idx, order in enumerate(orders):
+                context = str(order) + " was " + Order.Status(order.status).label
+                try:
+                    if Logics.order_expires(order):  # Order send to expire here
+                        debug["expired_orders"].append({idx: context})
+
+                        # expire all related take orders
+                        take_orders_queryset = TakeOrder.objects.filter(
+                            order=order, expires_at__gt=timezone.now()
+                        )
+                        for take_order in take_orders_queryset:
+                            Logics.take_order_expires(take_order)
+
+                # It should not happen, but if it cannot locate the hold invoice
+                # it probably was cancelled by another thread, make it expire anyway.
+                except Exception as e:
+                    debug["failed_order_expiry"].append({idx: context})
+                    debug["reason_failure"].append({idx: str(e)})
+
+                    if invoice_lookup_error(str(e)):
+                        self.stdout.write(str(e))
+                        order.update_status(Order.Status.EXP)
+                        debug["expired_orders"].append({idx: context})
+                    else:
+                        failed.append(order.id)
+
+            if from_schedule:
+                self.retry(ORDERS_KEY, shard, failed)
 
-        if debug["num_expired_orders"] > 0:
             self.stdout.write(str(timezone.now()))
             self.stdout.write(str(debug))
 
-        take_orders_queryset = TakeOrder.objects.filter(expires_at__lt=timezone.now())
-        debug["num_expired_take_orders"] = len(take_orders_queryset)
-        debug["expired_take_orders"] = []
-        debug["failed_take_order_expiry"] = []
-        debug["reason_take_failure"] = []
-
-        for idx, take_order in enumerate(take_orders_queryset):
-            context = str(take_order) + " was expired"
-            try:
-                Logics.take_order_expires(take_order)
-                take_order.delete()
-                debug["expired_take_orders"].append({idx: context})
-
-            # It should not happen, but if it cannot locate the hold invoice
-            # it probably was cancelled by another thread, make it expire anyway.
-            except Exception as e:
-                debug["failed_take_order_expiry"].append({idx: context})
-                debug["reason_take_failure"].append({idx: str(e)})
-
-                if invoice_lookup_error(str(e)):
-                    self.stdout.write(str(e))
+        from_schedule = True
+        while from_schedule:
+            take_orders, from_schedule = self.due_take_orders(shard)
+            if not take_orders:
+                break
+
+            debug = {}
+            debug["num_expired_take_orders"] = len(take_orders)
+            debug["expired_take_orders"] = []
+            debug["failed_take_order_expiry"] = []
+            debug["reason_take_failure"] = []
+            failed = []
+
+            for idx, take_order in enumerate(take_orders):
+                context = str(take_order) + " was expired"
+                try:
+                    Logics.take_order_expires(take_order)
+                    take_order.delete()
                     debug["expired_take_orders"].append({idx: context})
 
-        if debug["num_expired_take_orders"] > 0:
+                # It should not happen, but if it cannot locate the hold invoice
+                # it probably was cancelled by another thread, make it expire anyway.
+                except Exception as e:
+                    debug["failed_take_order_expiry"].append({idx: context})
+                    debug["reason_take_failure"].append({idx: str(e)})
+
+                    if invoice_lookup_error(str(e)):
+                        self.stdout.write(str(e))
+                        debug["expired_take_orders"].append({idx: context})
+                    else:
+                        failed.append(take_order.id)
+
+            if from_schedule:
+                self.retry(TAKE_ORDERS_KEY, shard, failed)
+
             self.stdout.write(str(timezone.now()))
             self.stdout.write(str(debug))
 
+    def reconcile(self):
+        """Heals the expiry schedule from the database (e.g. after a Redis restart)"""
+        try:
+            num_orders, num_take_orders = rebuild_expiry(self.leases.shards)
+            self.stdout.write(
+                f"Expiry schedule: {num_orders} orders and {num_take_orders} take orders"
+            )
+        except Exception as e:
+            self.stdout.write(f"Could not rebuild expiry schedule: {e}")
+
     def handle(self, *args, **options):
         """Never mind database locked error, keep going, print them out.
         Not an issue with PostgresQL"""
         try:
+            reconciled_at = time.monotonic()
+            self.leases.heartbeat()
+            self.reconcile()
             while True:
                 self.clean_orders()
-                time.sleep(5)
+
+                if time.monotonic() - reconciled_at > EXPIRY_RECONCILE_SECONDS:
+                    reconciled_at = time.monotonic()
+                    self.reconcile()
+
+                # Sleeps until the next order is due or a new one is scheduled
+                try:
+                    # Wakes up at least every heartbeat, to keep the leases
+                    wait_for_next_deadline(
+                        max_wait=WORKER_HEARTBEAT_SECONDS,
+                        shards=sorted(self.leases.shards),
+                    )
+                except Exception as e:
+                    self.stdout.write(f"Expiry schedule unavailable: {e}")
+                    time.sleep(5)
 
         except Exception as e:
             if "database is locked" in str(e):
                 self.stdout.write("database is locked")
 
             self.stdout.write(str(e))
+
+        finally:
+            self.leases.release()
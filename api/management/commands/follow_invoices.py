@@ -1,15 +1,40 @@
+import queue
+import threading
 import time
 from datetime import timedelta
 
 from decouple import config
 from django.core.management.base import BaseCommand
+from django.db.models import BigIntegerField, Value
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 
 from api.lightning.node import LNNode
 from api.logics import Logics
 from api.models import LNPayment, OnchainPayment, Order
+from api.shards import ShardLeases, filter_shards
 from api.tasks import follow_send_payment, send_notification
 
+HOLD_INVOICE_STREAMING = config("HOLD_INVOICE_STREAMING", cast=bool, default=True)
+HOLD_INVOICE_RECONCILE_SECONDS = config(
+    "HOLD_INVOICE_RECONCILE_SECONDS", cast=int, default=60
+)
+
+# Payments are sharded by the id of their order, so a single replica moves each
+# order forward. Payments without an order fall in shard 0.
+LNPAYMENT_ORDER = Coalesce(
+    "order_made__id",
+    "order_taken__id",
+    "order_escrow__id",
+    "order_paid_LN__id",
+    "take_order__order__id",
+    Value(0),
+    output_field=BigIntegerField(),
+)
+ONCHAINPAYMENT_ORDER = Coalesce(
+    "order_paid_TX__id", Value(0), output_field=BigIntegerField()
+)
+
 
 def is_same_status(a: LNPayment.Status, b: LNPayment.Status) -> bool:
     """
@@ -25,12 +50,26 @@ class Command(BaseCommand):
     help = "Follows all active hold invoices, sends out payments"
     rest = 5  # seconds between consecutive checks for invoice updates
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Replicas run with WORKER_SHARDING only follow the payments of their shards
+        self.leases = ShardLeases("follow_invoices")
+
     def handle(self, *args, **options):
         """Infinite loop to check invoices and retry payments.
         ever mind database locked error, keep going, print out"""
+        try:
+            self.follow_invoices()
+        finally:
+            self.leases.release()
+
+    def follow_invoices(self):
+        if HOLD_INVOICE_STREAMING and LNNode.streams_hold_invoices:
+            self.stream_hold_invoices()
 
         while True:
             time.sleep(self.rest)
+            self.leases.keep_alive()
 
             try:
                 self.follow_hold_invoices()
@@ -41,6 +80,115 @@ class Command(BaseCommand):
             except Exception as e:
                 self.stderr.write(str(e))
 
+    def stream_hold_invoices(self):
+        """Infinite loop that follows hold invoices as they are pushed by the node.
+
+        Every generated (INVGEN) hold invoice gets its own subscription stream, read
+        by a daemon thread that only forwards updates into a queue. Updates are
+        applied from this thread, so all database work stays single threaded.
+        Streams are closed as soon as the invoice leaves INVGEN. The polling
+        follow_hold_invoices() still runs every HOLD_INVOICE_RECONCILE_SECONDS
+        to catch anything a dropped stream could have missed (and old LOCKED invoices).
+        """
+        self.subscriptions = {}  # payment_hash -> gRPC call
+        self.subscriptions_lock = threading.Lock()
+        self.updates = queue.Queue()
+        self.dropped = set()  # payment_hash of streams of shards no longer owned
+        last_reconcile = 0
+
+        while True:
+            self.leases.keep_alive()
+            try:
+                self.subscribe_hold_invoices()
+            except Exception as e:
+                self.stderr.write(str(e))
+
+            # Apply pushed updates as they arrive, for up to `rest` seconds
+            deadline = time.time() + self.rest
+            while (timeout := deadline - time.time()) > 0:
+                try:
+                    payment_hash, new_status, expiry_height = self.updates.get(
+                        timeout=timeout
+                    )
+                except queue.Empty:
+                    self.dropped.clear()
+                    break
+                # Updates of streams closed after their shard was lost are dropped
+                if payment_hash in self.dropped:
+                    continue
+                try:
+                    lnpayment = self.update_hold_invoice(
+                        payment_hash, new_status, expiry_height
+                    )
+                    if lnpayment:
+                        self.stdout.write(
+                            f"{timezone.now()} Hold invoice {payment_hash} is now {LNPayment.Status(new_status).label}"
+                        )
+                except Exception as e:
+                    self.stderr.write(str(e))
+
+            if time.time() - last_reconcile > HOLD_INVOICE_RECONCILE_SECONDS:
+                last_reconcile = time.time()
+                try:
+                    self.follow_hold_invoices()
+                except Exception as e:
+                    self.stderr.write(str(e))
+            try:
+                self.send_payments()
+            except Exception as e:
+                self.stderr.write(str(e))
+
+    def subscribe_hold_invoices(self):
+        """Opens a stream for every generated hold invoice that has none yet.
+        Streams of invoices whose shard is no longer owned are closed."""
+        queryset = LNPayment.objects.filter(
+            type=LNPayment.Types.HOLD,
+            status=LNPayment.Status.INVGEN,
+        )
+        queryset = filter_shards(queryset, LNPAYMENT_ORDER, self.leases.shards)
+        payment_hashes = set(queryset.values_list("payment_hash", flat=True))
+
+        if self.leases.sharding:
+            with self.subscriptions_lock:
+                for payment_hash, call in self.subscriptions.items():
+                    if payment_hash not in payment_hashes:
+                        self.dropped.add(payment_hash)
+                        call.cancel()
+
+        for payment_hash in payment_hashes:
+            with self.subscriptions_lock:
+                if payment_hash in self.subscriptions:
+                    continue
+                call = LNNode.subscribe_hold_invoice(payment_hash)
+                self.subscriptions[payment_hash] = call
+                self.dropped.discard(payment_hash)
+
+            threading.Thread(
+                target=self.read_hold_invoice_stream,
+                args=(payment_hash, call),
+                daemon=True,
+            ).start()
+
+    def read_hold_invoice_stream(self, payment_hash, call):
+        """Forwards the updates of one hold invoice stream until it leaves INVGEN.
+        If the stream breaks, the invoice is subscribed again on the next loop."""
+        try:
+            for response in call:
+                new_status, expiry_height = LNNode.invoice_status_from_response(
+                    response
+                )
+                self.updates.put((payment_hash, new_status, expiry_height))
+                if new_status != LNPayment.Status.INVGEN:
+                    call.cancel()
+                    break
+        except Exception as e:
+            # Cancelling the call from this thread ends the iteration with an error
+            if not call.cancelled():
+                self.stderr.write(f"Hold invoice stream {payment_hash}: {str(e)}")
+        finally:
+            with self.subscriptions_lock:
+                self.subscriptions.pop(payment_hash, None)
+
     def is_same_status(a: LNPayment.Status, b: LNPayment.Status) -> bool:
         """
         Returns whether the state of two lnpayments is the same.
@@ -59,58 +207,55 @@ class Command(BaseCommand):
         We are very interested on the other two states (CANCELLED and ACCEPTED).
         Therefore, this thread (follow_invoices) will iterate over all LNpayments in
         INVGEN / LOCKED status and do InvoiceLookupV2 every X seconds to update their status.
+
+        SubscribeSingleInvoice does stream every state of a single invoice. If the node
+        supports it, stream_hold_invoices() follows INVGEN invoices that way and this
+        lookup only runs every HOLD_INVOICE_RECONCILE_SECONDS as a reconciliation.
         """
 
         # time it for debugging
         t0 = time.time()
 
-        queryset = LNPayment.objects.filter(
-            type=LNPayment.Types.HOLD,
-            status__in=[LNPayment.Status.INVGEN, LNPayment.Status.LOCKED],
-        )
-
-        generated_invoices = queryset.filter(
-            status=LNPayment.Status.INVGEN,
-        )
-
-        old_locked_invoices = queryset.filter(
-            status=LNPayment.Status.LOCKED,
-            created_at__lt=timezone.now() - timedelta(hours=48),
-        )
-
-        invoices_to_lookup = generated_invoices | old_locked_invoices
+        invoices_to_lookup = self.hold_invoices_to_lookup()
 
         debug = {}
         debug["num_active_invoices"] = len(invoices_to_lookup)
         debug["invoices"] = []
-        at_least_one_changed = False
-
-        for idx, hold_lnpayment in enumerate(invoices_to_lookup):
-            old_status = hold_lnpayment.status
-
-            new_status, expiry_height = LNNode.lookup_invoice_status(hold_lnpayment)
 
-            # Only save the hold_payments that change (otherwise this function does not scale)
-            changed = not old_status == new_status
+        # Concurrent lookups, returns {payment_hash: (status, expiry_height)}
+        lookups = LNNode.lookup_invoice_statuses(invoices_to_lookup)
+
+        # Only save the hold_payments that change (otherwise this function does not scale)
+        changed_invoices = [
+            hold_lnpayment
+            for hold_lnpayment in invoices_to_lookup
+            if not hold_lnpayment.status == lookups[hold_lnpayment.payment_hash][0]
+        ]
+        at_least_one_changed = len(changed_invoices) > 0
+
+        # there might be a few miliseconds to a full second delay when looking up many
+        # invoices. We make sure the lnpayment status has not been changed already by
+        # re-reading them from DB (in a single query).
+        lnpayments = LNPayment.objects.in_bulk(
+            [hold_lnpayment.payment_hash for hold_lnpayment in changed_invoices]
+        )
+        updated_lnpayments = []
 
-            if changed:
-                # there might be a few miliseconds to a full second delay when looping over many
-                # invoices. We make sure the lnpayment status has not been changed already by re-reading
-                # from DB.
-                lnpayment = LNPayment.objects.get(
-                    payment_hash=hold_lnpayment.payment_hash
-                )  # re-read
-                if is_same_status(lnpayment.status, new_status):
+        try:
+            for idx, hold_lnpayment in enumerate(changed_invoices):
+                new_status, expiry_height = lookups[hold_lnpayment.payment_hash]
+                lnpayment = lnpayments.get(hold_lnpayment.payment_hash)
+                if lnpayment is None or is_same_status(lnpayment.status, new_status):
                     continue
 
                 # if these are still different, we update the lnpayment with its new status.
                 lnpayment.status = new_status
                 lnpayment.expiry_height = expiry_height
                 self.update_order_status(lnpayment)
-                lnpayment.save(update_fields=["status", "expiry_height"])
+                updated_lnpayments.append(lnpayment)
 
                 # Report for debugging
-                old = LNPayment.Status(old_status).label
+                old = LNPayment.Status(hold_lnpayment.status).label
                 new = LNPayment.Status(lnpayment.status).label
                 debug["invoices"].append(
                     {
@@ -121,8 +266,12 @@ class Command(BaseCommand):
                         }
                     }
                 )
-
-            at_least_one_changed = at_least_one_changed or changed
+        finally:
+            # Orders have already been moved forward, the new status must be saved
+            # even if handling a later invoice fails.
+            LNPayment.objects.bulk_update(
+                updated_lnpayments, ["status", "expiry_height"]
+            )
 
         debug["time"] = time.time() - t0
 
@@ -130,6 +279,42 @@ class Command(BaseCommand):
             self.stdout.write(str(timezone.now()))
             self.stdout.write(str(debug))
 
+    def hold_invoices_to_lookup(self):
+        """Generated hold invoices, and locked ones older than 48 hours"""
+        queryset = LNPayment.objects.filter(
+            type=LNPayment.Types.HOLD,
+            status__in=[LNPayment.Status.INVGEN, LNPayment.Status.LOCKED],
+        )
+
+        generated_invoices = queryset.filter(
+            status=LNPayment.Status.INVGEN,
+        )
+
+        old_locked_invoices = queryset.filter(
+            status=LNPayment.Status.LOCKED,
+            created_at__lt=timezone.now() - timedelta(hours=48),
+        )
+
+        return filter_shards(
+            generated_invoices | old_locked_invoices,
+            LNPAYMENT_ORDER,
+            self.leases.shards,
+        )
+
+    def update_hold_invoice(self, payment_hash, new_status, expiry_height):
+        """Saves the new status of a hold invoice and moves its order forward.
+        Returns the updated lnpayment, or None if the status had already changed."""
+        lnpayment = LNPayment.objects.get(payment_hash=payment_hash)  # re-read
+        if is_same_status(lnpayment.status, new_status):
+            return None
+
+        # if these are still different, we update the lnpayment with its new status.
+        lnpayment.status = new_status
+        lnpayment.expiry_height = expiry_height
+        self.update_order_status(lnpayment)
+        lnpayment.save(update_fields=["status", "expiry_height"])
+        return lnpayment
+
     def send_payments(self):
         """
         Checks for invoices and onchain payments that are due to be paid.
@@ -144,6 +329,20 @@ class Command(BaseCommand):
         Checks if any payment is due for retry, and tries to pay it.
         """
 
+        for lnpayment in self.ln_payments_to_pay():
+            # Checks that this onchain payment is part of an order with a settled escrow
+            if not hasattr(lnpayment, "order_paid_LN"):
+                self.stderr.write(f"Ln payment {str(lnpayment)} has no parent order!")
+                continue
+            order = lnpayment.order_paid_LN
+            if (
+                order.trade_escrow.status == LNPayment.Status.SETLED
+                and order.is_swap is False
+            ):
+                follow_send_payment.delay(lnpayment.payment_hash)
+
+    def ln_payments_to_pay(self):
+        """New, retried and stuck payouts"""
         queryset = LNPayment.objects.filter(
             type=LNPayment.Types.NORM,
             status__in=[LNPayment.Status.FAILRO, LNPayment.Status.FLIGHT],
@@ -172,25 +371,18 @@ class Command(BaseCommand):
             last_routing_time__lt=(timezone.now() - timedelta(minutes=3)),
         )
 
-        invoices_to_pay = stuck_invoices | retry_invoices | new_invoices_to_pay
-
-        for lnpayment in invoices_to_pay:
-            # Checks that this onchain payment is part of an order with a settled escrow
-            if not hasattr(lnpayment, "order_paid_LN"):
-                self.stderr.write(f"Ln payment {str(lnpayment)} has no parent order!")
-                continue
-            order = lnpayment.order_paid_LN
-            if (
-                order.trade_escrow.status == LNPayment.Status.SETLED
-                and order.is_swap is False
-            ):
-                follow_send_payment.delay(lnpayment.payment_hash)
+        return filter_shards(
+            stuck_invoices | retry_invoices | new_invoices_to_pay,
+            LNPAYMENT_ORDER,
+            self.leases.shards,
+        )
 
     def send_onchain_payments(self):
         queryset = OnchainPayment.objects.filter(
             status=OnchainPayment.Status.QUEUE,
             broadcasted=False,
         )
+        queryset = filter_shards(queryset, ONCHAINPAYMENT_ORDER, self.leases.shards)
 
         for onchainpayment in queryset:
             # Checks that this onchain payment is part of an order with a settled escrow
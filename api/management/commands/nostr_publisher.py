@@ -0,0 +1,13 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from api.nostr import NostrPublisher
+
+
+class Command(BaseCommand):
+    help = "Publishes the queued nostr events over a persistent relay connection"
+
+    def handle(self, *args, **options):
+        self.stdout.write("Publishing queued nostr events")
+        asyncio.run(NostrPublisher().run())
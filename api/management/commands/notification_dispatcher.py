@@ -0,0 +1,13 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from api.dispatcher import NotificationDispatcher
+
+
+class Command(BaseCommand):
+    help = "Delivers the notification outbox to Telegram, webhooks and nostr"
+
+    def handle(self, *args, **options):
+        self.stdout.write("Delivering queued notifications")
+        asyncio.run(NotificationDispatcher().run())
@@ -0,0 +1,82 @@
+from datetime import timedelta
+from decimal import Decimal
+
+import numpy as np
+from django.db import migrations, models
+from django.db.models import Count, Max, Sum
+
+
+def weighted_median_premium(ticks):
+    """
+    Volume weighted median premium of the FIAT ticks, computed here rather
+    than with api.utils so the migration does not change along with the app.
+    """
+    # LN <-> BTC swaps (currency 1000) are not mixed with FIAT premiums
+    rows = ticks.exclude(currency=1000).values_list("premium", "volume")
+    if not rows:
+        return 0.0
+    premiums, volumes = (np.array(column, dtype=float) for column in zip(*rows))
+
+    sorter = np.argsort(premiums)
+    premiums, volumes = premiums[sorter], volumes[sorter]
+    quantiles = np.cumsum(volumes) - 0.5 * volumes
+    quantiles -= quantiles[0]
+    if quantiles[-1] == 0:
+        # A single tick, or ticks without volume
+        return float(np.median(premiums))
+    quantiles /= quantiles[-1]
+    return float(np.interp(0.5, quantiles, premiums))
+
+
+def backfill_market_stats(apps, schema_editor):
+    MarketTick = apps.get_model("api", "MarketTick")
+    MarketStats = apps.get_model("api", "MarketStats")
+
+    totals = MarketTick.objects.aggregate(
+        lifetime_volume=Sum("volume"),
+        num_ticks=Count("id"),
+        last_tick_at=Max("timestamp"),
+    )
+
+    last_day_premium = 0
+    if totals["last_tick_at"] is not None:
+        # Premium of the last day with contracts, as log_a_tick would have left it
+        last_day = totals["last_tick_at"] - timedelta(days=1)
+        last_day_premium = weighted_median_premium(
+            MarketTick.objects.filter(timestamp__gt=last_day)
+        )
+
+    MarketStats.objects.update_or_create(
+        id=1,
+        defaults={
+            "lifetime_volume": totals["lifetime_volume"] or Decimal(0),
+            "num_ticks": totals["num_ticks"],
+            "last_day_premium": round(Decimal(last_day_premium), 2),
+            "last_tick_at": totals["last_tick_at"],
+        },
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0057_robot_webhook_enabled_alter_order_escrow_duration'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarketStats',
+            fields=[
+                ('id', models.PositiveSmallIntegerField(default=1, editable=False, primary_key=True, serialize=False)),
+                ('lifetime_volume', models.DecimalField(decimal_places=8, default=Decimal('0'), max_digits=18)),
+                ('num_ticks', models.PositiveBigIntegerField(default=0)),
+                ('last_day_premium', models.DecimalField(decimal_places=2, default=Decimal('0'), max_digits=5)),
+                ('last_tick_at', models.DateTimeField(default=None, null=True)),
+            ],
+            options={
+                'verbose_name': 'Market stats',
+                'verbose_name_plural': 'Market stats',
+            },
+        ),
+        migrations.RunPython(backfill_market_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0058_market_stats'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['status', 'expires_at'], name='order_status_expires_idx'),
+        ),
+        migrations.AlterField(
+            model_name='takeorder',
+            name='expires_at',
+            field=models.DateTimeField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0059_order_status_expires_idx_takeorder_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['maker', 'status'], name='order_maker_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['taker', 'status'], name='order_taker_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lnpayment',
+            index=models.Index(fields=['type', 'status'], name='lnpayment_type_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='lnpayment',
+            index=models.Index(condition=models.Q(('type', 0), ('status__in', [7, 9])), fields=['status', 'in_flight', 'routing_attempts', 'last_routing_time'], name='lnpayment_pending_payout_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='takeorder',
+            index=models.Index(fields=['taker', 'expires_at'], name='takeorder_taker_expires_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='notification',
+            index=models.Index(fields=['robot', 'created_at'], name='notification_robot_created_idx'),
+        ),
+    ]
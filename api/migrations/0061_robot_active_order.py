@@ -0,0 +1,52 @@
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Q
+from django.utils import timezone
+
+# Order.Status and Order.Types values at the time of this migration
+ACTIVE_STATUSES = [0, 1, 2, 3, 6, 7, 8, 9, 10, 11, 16]
+FAILING_STATUSES = [13, 15]
+BUY, SELL = 0, 1
+
+
+def backfill_active_order(apps, schema_editor):
+    Order = apps.get_model("api", "Order")
+    TakeOrder = apps.get_model("api", "TakeOrder")
+    Robot = apps.get_model("api", "Robot")
+
+    # Lowest priority first, so the pointer ends at the same order as
+    # api.active_orders.find_active_order
+    failing_buyers = Order.objects.filter(status__in=FAILING_STATUSES).filter(
+        Q(type=BUY) | Q(type=SELL, taker__isnull=False)
+    )
+    for order in failing_buyers.order_by("-id"):
+        user_id = order.maker_id if order.type == BUY else order.taker_id
+        Robot.objects.filter(user_id=user_id).update(active_order=order)
+
+    take_orders = TakeOrder.objects.filter(expires_at__gt=timezone.now())
+    for take_order in take_orders.order_by("-order_id"):
+        Robot.objects.filter(user_id=take_order.taker_id).update(
+            active_order_id=take_order.order_id
+        )
+
+    active_orders = Order.objects.filter(status__in=ACTIVE_STATUSES)
+    for order in active_orders.filter(taker__isnull=False).order_by("-id"):
+        Robot.objects.filter(user_id=order.taker_id).update(active_order=order)
+    for order in active_orders.order_by("-id"):
+        Robot.objects.filter(user_id=order.maker_id).update(active_order=order)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0060_hot_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='robot',
+            name='active_order',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.order'),
+        ),
+        migrations.RunPython(backfill_active_order, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0061_robot_active_order'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NotificationDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('channel', models.PositiveSmallIntegerField(choices=[(0, 'Telegram'), (1, 'Webhook'), (2, 'Nostr')], default=None)),
+                ('status', models.PositiveSmallIntegerField(choices=[(0, 'Pending'), (1, 'Dead letter')], default=0)),
+                ('destination', models.CharField(default=None, max_length=2000)),
+                ('payload', models.JSONField(default=dict)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('order', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='api.order')),
+                ('robot', models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.CASCADE, to='api.robot')),
+            ],
+            options={
+                'indexes': [models.Index(condition=models.Q(('status', 0)), fields=['next_attempt_at'], name='delivery_pending_due_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0062_notificationdelivery'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='robot',
+            name='telegram_token',
+            field=models.CharField(blank=True, db_index=True, max_length=20, null=True),
+        ),
+    ]
@@ -1,19 +1,23 @@
 from .currency import Currency
 from .ln_payment import LNPayment
+from .market_stats import MarketStats
 from .market_tick import MarketTick
 from .onchain_payment import OnchainPayment
 from .order import Order
 from .robot import Robot
 from .notification import Notification
+from .notification_delivery import NotificationDelivery
 from .take_order import TakeOrder
 
 __all__ = [
     "Currency",
     "LNPayment",
+    "MarketStats",
     "MarketTick",
     "OnchainPayment",
     "Order",
     "Robot",
     "Notification",
+    "NotificationDelivery",
     "TakeOrder",
 ]
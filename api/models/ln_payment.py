@@ -133,6 +133,17 @@ class LNPayment(models.Model):
     class Meta:
         verbose_name = "Lightning payment"
         verbose_name_plural = "Lightning payments"
+        indexes = [
+            # Hold invoices followed by follow_invoices
+            models.Index(fields=["type", "status"], name="lnpayment_type_status_idx"),
+            # Payouts due to be (re)tried by follow_invoices.send_ln_payments
+            # (type NORM, status FLIGHT or FAILRO)
+            models.Index(
+                fields=["status", "in_flight", "routing_attempts", "last_routing_time"],
+                condition=models.Q(type=0, status__in=[7, 9]),
+                name="lnpayment_pending_payout_idx",
+            ),
+        ]
 
     @property
     def hash(self):
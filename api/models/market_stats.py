@@ -0,0 +1,53 @@
+from decimal import Decimal
+
+from django.db import models
+from django.db.models import F
+from django.utils import timezone
+
+
+class MarketStats(models.Model):
+    """
+    Single row of running market statistics, updated with every new
+    MarketTick so that /api/info/ does not need to scan the tick history.
+    """
+
+    id = models.PositiveSmallIntegerField(primary_key=True, default=1, editable=False)
+
+    # Sum of the volume (BTC) of every tick ever logged
+    lifetime_volume = models.DecimalField(
+        max_digits=18, decimal_places=8, default=Decimal(0)
+    )
+    num_ticks = models.PositiveBigIntegerField(default=0)
+
+    # Volume weighted median premium of the last day, as of the last tick.
+    # Served as fallback when there are no ticks in the last day.
+    last_day_premium = models.DecimalField(
+        max_digits=5, decimal_places=2, default=Decimal(0)
+    )
+    last_tick_at = models.DateTimeField(null=True, default=None)
+
+    @classmethod
+    def get(cls):
+        stats, _ = cls.objects.get_or_create(id=1)
+        return stats
+
+    @classmethod
+    def add_tick(cls, tick, last_day_premium=None):
+        """Adds a new tick to the running statistics in a single atomic UPDATE"""
+        volume = Decimal(str(tick.volume or 0)).quantize(Decimal("1e-8"))
+        cls.get()
+        fields = {
+            "lifetime_volume": F("lifetime_volume") + volume,
+            "num_ticks": F("num_ticks") + 1,
+            "last_tick_at": tick.timestamp or timezone.now(),
+        }
+        if last_day_premium is not None:
+            fields["last_day_premium"] = round(Decimal(last_day_premium), 2)
+        cls.objects.filter(id=1).update(**fields)
+
+    def __str__(self):
+        return f"Market stats: {self.num_ticks} ticks"
+
+    class Meta:
+        verbose_name = "Market stats"
+        verbose_name_plural = "Market stats"
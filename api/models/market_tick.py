@@ -1,5 +1,6 @@
 import uuid
 
+from datetime import timedelta
 from decimal import Decimal
 from decouple import config
 from django.core.validators import MaxValueValidator, MinValueValidator
@@ -79,8 +80,29 @@ class MarketTick(models.Model):
                 fee=config("FEE", cast=float, default=0),
             )
 
+            MarketTick.update_stats(market_tick)
+
             return market_tick
 
+    def update_stats(market_tick):
+        """
+        Adds a new tick to the running MarketStats. The last day premium
+        is only recomputed for FIAT ticks (BTC swaps are not mixed in).
+        """
+        from api.models import MarketStats
+        from api.utils import compute_avg_premium
+
+        last_day_premium = None
+        if market_tick.currency_id != 1000:
+            last_day_premium, _ = compute_avg_premium(
+                MarketTick.objects.filter(
+                    timestamp__gt=market_tick.timestamp - timedelta(days=1),
+                    timestamp__lte=market_tick.timestamp,
+                )
+            )
+
+        MarketStats.add_tick(market_tick, last_day_premium)
+
     def __str__(self):
         return f"Tick: {str(self.id)[:8]}"
 
@@ -31,5 +31,13 @@ class Notification(models.Model):
     title = models.CharField(max_length=240, null=False, default=None)
     description = models.CharField(max_length=240, default=None, blank=True)
 
+    class Meta:
+        indexes = [
+            # Latest notifications of a robot (NotificationsView)
+            models.Index(
+                fields=["robot", "created_at"], name="notification_robot_created_idx"
+            ),
+        ]
+
     def __str__(self):
         return f"{self.title} {self.description}"
@@ -0,0 +1,59 @@
+from api.models import Order, Robot
+from django.db import models
+from django.utils import timezone
+
+
+class NotificationDelivery(models.Model):
+    """
+    Outbox of the notifications to deliver to Telegram, webhooks and nostr.
+    Written in the same transaction as the Notification and delivered
+    asynchronously by the notification_dispatcher worker, which deletes
+    each delivery once it succeeds.
+    """
+
+    class Channels(models.IntegerChoices):
+        TELEGRAM = 0, "Telegram"
+        WEBHOOK = 1, "Webhook"
+        NOSTR = 2, "Nostr"
+
+    class Status(models.IntegerChoices):
+        PENDING = 0, "Pending"
+        DEAD = 1, "Dead letter"
+
+    created_at = models.DateTimeField(default=timezone.now)
+
+    channel = models.PositiveSmallIntegerField(
+        choices=Channels.choices, null=False, default=None
+    )
+    status = models.PositiveSmallIntegerField(
+        choices=Status.choices, null=False, default=Status.PENDING
+    )
+
+    # Robot and order are None for coordinator notifications (e.g. new disputes)
+    robot = models.ForeignKey(
+        Robot, on_delete=models.CASCADE, null=True, default=None, blank=True
+    )
+    order = models.ForeignKey(
+        Order, on_delete=models.CASCADE, null=True, default=None, blank=True
+    )
+
+    # Telegram chat id, webhook URL or nostr pubkey
+    destination = models.CharField(max_length=2000, null=False, default=None)
+    payload = models.JSONField(default=dict)
+
+    attempts = models.PositiveSmallIntegerField(null=False, default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default="")
+
+    class Meta:
+        indexes = [
+            # Pending deliveries that are due (NotificationDispatcher.claim)
+            models.Index(
+                fields=["next_attempt_at"],
+                condition=models.Q(status=0),
+                name="delivery_pending_due_idx",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.get_channel_display()} {self.destination} ({self.get_status_display()})"
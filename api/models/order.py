@@ -7,7 +7,7 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
-from django.db.models.signals import pre_delete
+from django.db.models.signals import post_delete, post_save, pre_delete
 from django.dispatch import receiver
 from django.utils import timezone
 from api.tasks import send_notification
@@ -299,6 +299,17 @@ class Order(models.Model):
         editable=False,
     )
 
+    class Meta:
+        indexes = [
+            # Due orders are found by status and expiry (see api.expiry.rebuild_expiry)
+            models.Index(
+                fields=["status", "expires_at"], name="order_status_expires_idx"
+            ),
+            # Active orders of a robot (Logics.validate_already_maker_or_taker)
+            models.Index(fields=["maker", "status"], name="order_maker_status_idx"),
+            models.Index(fields=["taker", "status"], name="order_taker_status_idx"),
+        ]
+
     def __str__(self):
         if self.has_range and self.amount is None:
             amt = str(float(self.min_amount)) + "-" + str(float(self.max_amount))
@@ -386,15 +397,27 @@ class Order(models.Model):
             old_status = self.status
             self.status = new_status
             self.log_status_transition(old_status, new_status)
+
+            # queryset.update() sends no post_save signal
+            from api.active_orders import sync_order_active_orders
+            from api.book import update_book
+            from api.expiry import schedule_order
+
+            update_book(self)
+            schedule_order(self)
+            sync_order_active_orders(self)
             return True
 
         return False
 
     def log_status_transition(self, old_status, new_status):
         if old_status != new_status:
+            from api.consumers import push_order_status
+
             self.log(
                 f"Order state went from {old_status}: <i>{Order.Status(old_status).label}</i> to {new_status}: <i>{Order.Status(new_status).label}</i>"
             )
+            push_order_status(self, old_status, new_status)
 
 
 @receiver(pre_delete, sender=Order)
@@ -411,3 +434,43 @@ def delete_lnpayment_at_order_deletion(sender, instance, **kwargs):
             lnpayment.delete()
         except Exception:
             pass
+
+
+@receiver(post_save, sender=Order)
+def update_book_at_order_save(sender, instance, update_fields=None, **kwargs):
+    from api.book import BOOK_FIELDS, update_book
+
+    # Skip saves that cannot change the book, e.g. order.log()
+    if update_fields is not None and BOOK_FIELDS.isdisjoint(update_fields):
+        return
+
+    update_book(instance)
+
+
+@receiver(post_save, sender=Order)
+def schedule_expiry_at_order_save(sender, instance, update_fields=None, **kwargs):
+    from api.expiry import EXPIRY_FIELDS, schedule_order
+
+    if update_fields is not None and EXPIRY_FIELDS.isdisjoint(update_fields):
+        return
+
+    schedule_order(instance)
+
+
+@receiver(post_save, sender=Order)
+def sync_active_orders_at_order_save(sender, instance, update_fields=None, **kwargs):
+    from api.active_orders import ACTIVE_ORDER_FIELDS, sync_order_active_orders
+
+    if update_fields is not None and ACTIVE_ORDER_FIELDS.isdisjoint(update_fields):
+        return
+
+    sync_order_active_orders(instance)
+
+
+@receiver(post_delete, sender=Order)
+def remove_from_book_at_order_deletion(sender, instance, **kwargs):
+    from api.book import remove_from_book
+    from api.expiry import unschedule_order
+
+    remove_from_book(instance)
+    unschedule_order(instance)
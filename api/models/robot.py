@@ -36,7 +36,9 @@ class Robot(models.Model):
     total_contracts = models.PositiveIntegerField(null=False, default=0)
 
     # Used to deep link telegram chat in case telegram notifications are enabled
-    telegram_token = models.CharField(max_length=20, null=True, blank=True)
+    telegram_token = models.CharField(
+        max_length=20, null=True, blank=True, db_index=True
+    )
     telegram_chat_id = models.BigIntegerField(null=True, default=None, blank=True)
     telegram_enabled = models.BooleanField(default=False, null=False)
     telegram_lang_code = models.CharField(max_length=10, null=True, blank=True)
@@ -76,6 +78,17 @@ class Robot(models.Model):
     # Penalty expiration (only used then taking/cancelling repeatedly orders in the book before comitting bond)
     penalty_expiration = models.DateTimeField(null=True, default=None, blank=True)
 
+    # Order the robot is active in, as maker, taker, pretaker or buyer of a
+    # failing payout (see api.active_orders)
+    active_order = models.ForeignKey(
+        "api.Order",
+        related_name="+",
+        on_delete=models.SET_NULL,
+        null=True,
+        default=None,
+        blank=True,
+    )
+
     # Platform rate
     platform_rating = models.PositiveIntegerField(null=True, default=None, blank=True)
 
@@ -1,6 +1,8 @@
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.contrib.auth.models import User
 from django.db import models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.conf import settings
 
 
@@ -22,7 +24,7 @@ class TakeOrder(models.Model):
         default=None,
         blank=False,
     )
-    expires_at = models.DateTimeField()
+    expires_at = models.DateTimeField(db_index=True)
     taker_bond = models.OneToOneField(
         "api.LNPayment",
         related_name="take_order",
@@ -40,5 +42,31 @@ class TakeOrder(models.Model):
     # timestamp of last_satoshis
     last_satoshis_time = models.DateTimeField(null=True, default=None, blank=True)
 
+    class Meta:
+        indexes = [
+            # Active take orders of a robot (Logics.validate_already_maker_or_taker)
+            models.Index(
+                fields=["taker", "expires_at"], name="takeorder_taker_expires_idx"
+            ),
+        ]
+
     def __str__(self):
         return f"Order {self.order.id} taken by Robot({self.taker.robot.id},{self.taker.username}) for {self.amount} fiat units"
+
+
+@receiver(post_save, sender=TakeOrder)
+def schedule_expiry_at_take_order_save(sender, instance, **kwargs):
+    from api.active_orders import sync_take_order_active_order
+    from api.expiry import schedule_take_order
+
+    schedule_take_order(instance)
+    sync_take_order_active_order(instance)
+
+
+@receiver(post_delete, sender=TakeOrder)
+def unschedule_expiry_at_take_order_deletion(sender, instance, **kwargs):
+    from api.active_orders import sync_take_order_active_order
+    from api.expiry import unschedule_take_order
+
+    unschedule_take_order(instance)
+    sync_take_order_active_order(instance, deleted=True)
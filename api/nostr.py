@@ -1,9 +1,15 @@
 import pygeohash
+import asyncio
 import hashlib
+import json
+import logging
+import time
 import uuid
+from functools import lru_cache
 
 from secp256k1 import PrivateKey
 from asgiref.sync import sync_to_async
+from django_redis import get_redis_connection
 from nostr_sdk import (
     Keys,
     Client,
@@ -17,24 +23,74 @@ from nostr_sdk import (
 from api.models import Order
 from decouple import config
 
+logger = logging.getLogger("api.nostr")
+
+# With NOSTR_PUBLISHER, the nostr tasks queue their events in Redis and the
+# nostr_publisher worker publishes them over a single, persistent relay connection.
+NOSTR_PUBLISHER = config("NOSTR_PUBLISHER", cast=bool, default=False)
+NOSTR_BATCH_SIZE = config("NOSTR_BATCH_SIZE", cast=int, default=50)
+# While the queue is this long, tasks defer their events (backpressure)
+NOSTR_QUEUE_MAX = config("NOSTR_QUEUE_MAX", cast=int, default=10_000)
+NOSTR_MAX_ATTEMPTS = config("NOSTR_MAX_ATTEMPTS", cast=int, default=5)
+NOSTR_RETRY_SECONDS = config("NOSTR_RETRY_SECONDS", cast=float, default=2)
+# Tasks deferred by a full queue try again after this many seconds, times the attempt
+NOSTR_DEFER_SECONDS = config("NOSTR_DEFER_SECONDS", cast=int, default=30)
+
+QUEUE_KEY = "nostr:queue"
+RETRY_KEY = "nostr:retry"
+# Events popped by the publisher, until they are published or scheduled for retry
+PROCESSING_KEY = "nostr:processing"
+# Orders with an event already queued, so bursts of changes are published once
+PENDING_ORDERS_KEY = "nostr:pending_orders"
+
+
+@lru_cache(maxsize=1)
+def parse_keys(nsec):
+    return Keys.parse(nsec)
+
+
+def enqueue_order_event(order_id):
+    """
+    Queues the publication of the current state of an order. Returns False
+    if the queue is full, then the caller should try again later.
+    """
+    redis = get_redis_connection("default")
+    # The queued event publishes the state of the order when it is popped
+    if redis.sismember(PENDING_ORDERS_KEY, order_id):
+        return True
+    if redis.llen(QUEUE_KEY) >= NOSTR_QUEUE_MAX:
+        return False
+    if redis.sadd(PENDING_ORDERS_KEY, order_id):
+        redis.rpush(QUEUE_KEY, json.dumps({"order_id": order_id}))
+    return True
+
+
+def enqueue_notification_event(robot_id, order_id, text):
+    """Queues a notification event, returns False if the queue is full"""
+    redis = get_redis_connection("default")
+    if redis.llen(QUEUE_KEY) >= NOSTR_QUEUE_MAX:
+        return False
+    redis.rpush(
+        QUEUE_KEY,
+        json.dumps({"robot_id": robot_id, "order_id": order_id, "text": text}),
+    )
+    return True
+
 
 class Nostr:
     """Simple nostr events manager to be used as a cache system for clients"""
 
-    async def send_order_event(self, order):
-        """Creates the event and sends it to the coordinator relay"""
+    async def build_order_event(self, order):
+        """Creates the signed order event, None if the order is not published"""
 
         # Publish only public orders
         if order.password is not None:
-            return
+            return None
 
         if config("NOSTR_NSEC", cast=str, default="") == "":
-            return
+            return None
 
-        print("Sending nostr ORDER event")
-
-        keys = Keys.parse(config("NOSTR_NSEC", cast=str))
-        client = await self.initialize_client()
+        keys = parse_keys(config("NOSTR_NSEC", cast=str))
 
         robot_name = await self.get_user_name(order)
         robot_hash_id = await self.get_robot_hash_id(order)
@@ -43,23 +99,30 @@ class Nostr:
         content = order.description if order.description is not None else ""
 
         # Keys implements AsyncNostrSigner directly in nostr-sdk 0.45.0
-        event = await (
+        return await (
             EventBuilder(Kind(38383), content)
             .tags(self.generate_tags(order, robot_name, robot_hash_id, currency))
             .finalize_async(keys)
         )
-        await client.send_event(event)
-        print(f"Nostr ORDER event sent: {event.as_json()}")
 
-    async def send_notification_event(self, robot, order, text):
-        """Creates the notification event and sends it to the coordinator relay"""
-        if config("NOSTR_NSEC", cast=str, default="") == "":
+    async def send_order_event(self, order):
+        """Creates the event and sends it to the coordinator relay"""
+        event = await self.build_order_event(order)
+        if event is None:
             return
 
-        print("Sending nostr NOTIFICATION event")
+        print("Sending nostr ORDER event")
 
-        keys = Keys.parse(config("NOSTR_NSEC", cast=str))
         client = await self.initialize_client()
+        await client.send_event(event)
+        print(f"Nostr ORDER event sent: {event.as_json()}")
+
+    async def build_notification_event(self, robot, order, text):
+        """Creates the gift wrapped notification, None if nostr is disabled"""
+        if config("NOSTR_NSEC", cast=str, default="") == "":
+            return None
+
+        keys = parse_keys(config("NOSTR_NSEC", cast=str))
 
         rumor_extra_tags = [
             Tag.parse(
@@ -72,12 +135,22 @@ class Nostr:
         ]
 
         # Keys implements AsyncNostrSigner directly in nostr-sdk 0.45.0
-        gift_wrap = await nip17_make_private_msg_async(
+        return await nip17_make_private_msg_async(
             keys,
             PublicKey.parse(robot.nostr_pubkey),
             text,
             rumor_extra_tags=rumor_extra_tags,
         )
+
+    async def send_notification_event(self, robot, order, text):
+        """Creates the notification event and sends it to the coordinator relay"""
+        gift_wrap = await self.build_notification_event(robot, order, text)
+        if gift_wrap is None:
+            return
+
+        print("Sending nostr NOTIFICATION event")
+
+        client = await self.initialize_client()
         await client.send_event(gift_wrap)
         print("Nostr NOTIFICATION event sent")
 
@@ -172,3 +245,142 @@ class Nostr:
             return signature.hex()
         except Exception:
             return ""
+
+
+class NostrPublisher:
+    """
+    Publishes the queued nostr events in batches over a single, persistent
+    relay connection. Failed publications are retried with exponential
+    backoff, up to NOSTR_MAX_ATTEMPTS times. Popped events are kept in a
+    processing list until handled, so a crashed publisher loses none.
+    """
+
+    def __init__(self, client=None):
+        self.nostr = Nostr()
+        self.client = client
+        self.redis = get_redis_connection("default")
+
+    async def connect(self):
+        if self.client is None:
+            self.client = await self.nostr.initialize_client()
+
+    def requeue_due_retries(self):
+        """Moves the retries that are due back to the queue"""
+        for item in self.redis.zrangebyscore(RETRY_KEY, "-inf", time.time()):
+            # Only the publisher that removes it requeues it
+            if self.redis.zrem(RETRY_KEY, item):
+                self.redis.rpush(QUEUE_KEY, item)
+
+    def recover(self):
+        """
+        Queues again the events a stopped publisher had popped but not
+        published. Only one publisher runs, so they are all orphaned.
+        """
+        while self.redis.lmove(PROCESSING_KEY, QUEUE_KEY, "RIGHT", "LEFT"):
+            pass
+
+    def pop_batch(self, timeout=1):
+        """
+        Moves up to NOSTR_BATCH_SIZE queued events to the processing list,
+        waiting up to timeout seconds. They stay there until acknowledged.
+        """
+        self.requeue_due_retries()
+        first = self.redis.blmove(QUEUE_KEY, PROCESSING_KEY, timeout, "LEFT", "RIGHT")
+        if first is None:
+            return []
+
+        pipe = self.redis.pipeline()
+        for _ in range(NOSTR_BATCH_SIZE - 1):
+            pipe.lmove(QUEUE_KEY, PROCESSING_KEY, "LEFT", "RIGHT")
+        items = [first] + [item for item in pipe.execute() if item is not None]
+        batch = [json.loads(item) for item in items]
+
+        # Order changes from now on queue a new event
+        order_ids = [item["order_id"] for item in batch if "robot_id" not in item]
+        if order_ids:
+            self.redis.srem(PENDING_ORDERS_KEY, *order_ids)
+        return batch
+
+    def ack(self, batch):
+        """Removes the events of a batch, published or scheduled for retry, from the processing list"""
+        # Events are stored as the json.dumps of their dict, so they serialize the same
+        pipe = self.redis.pipeline()
+        for item in batch:
+            pipe.lrem(PROCESSING_KEY, 1, json.dumps(item))
+        pipe.execute()
+
+    def retry(self, item, error):
+        attempts = item.get("attempts", 0) + 1
+        if attempts >= NOSTR_MAX_ATTEMPTS:
+            logger.error(
+                f"Dropping nostr event {item} after {attempts} attempts: {error}"
+            )
+            return
+        logger.warning(f"Could not publish nostr event {item}: {error}")
+        delay = NOSTR_RETRY_SECONDS * 2 ** (attempts - 1)
+        self.redis.zadd(
+            RETRY_KEY, {json.dumps({**item, "attempts": attempts}): time.time() + delay}
+        )
+
+    @sync_to_async
+    def load(self, item):
+        """Current order (and robot) of a queued event, None if deleted"""
+        from api.models import Robot
+
+        order = (
+            Order.objects.select_related("maker__robot", "currency")
+            .filter(id=item["order_id"])
+            .first()
+        )
+        if "robot_id" not in item:
+            return order, None
+        return order, Robot.objects.filter(id=item["robot_id"]).first()
+
+    async def build_event(self, item):
+        order, robot = await self.load(item)
+        if order is None:
+            return None
+        if "robot_id" not in item:
+            return await self.nostr.build_order_event(order)
+        if robot is None:
+            return None
+        return await self.nostr.build_notification_event(robot, order, item["text"])
+
+    async def publish_batch(self, batch):
+        """Builds and publishes the events of a batch concurrently. Returns the number published"""
+        events = await asyncio.gather(
+            *(self.build_event(item) for item in batch), return_exceptions=True
+        )
+
+        to_send = []
+        for item, event in zip(batch, events):
+            if isinstance(event, Exception):
+                # Not retried, the event can not be built
+                logger.error(f"Could not build nostr event {item}: {event}")
+            elif event is not None:
+                to_send.append((item, event))
+
+        outputs = await asyncio.gather(
+            *(self.client.send_event(event) for _, event in to_send),
+            return_exceptions=True,
+        )
+
+        published = 0
+        for (item, _), output in zip(to_send, outputs):
+            if isinstance(output, Exception):
+                self.retry(item, output)
+            elif not output.success:
+                self.retry(item, output.failed)
+            else:
+                published += 1
+
+        await asyncio.to_thread(self.ack, batch)
+        return published
+
+    async def run(self):
+        await asyncio.to_thread(self.recover)
+        await self.connect()
+        while True:
+            batch = await asyncio.to_thread(self.pop_batch)
+            if batch:
+                await self.publish_batch(batch)
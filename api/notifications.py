@@ -5,10 +5,13 @@ from datetime import datetime, timezone
 from secrets import token_urlsafe
 
 from decouple import config
+from django.db import transaction
 from api.models import (
     Order,
     Notification,
+    NotificationDelivery,
 )
+from api.dispatcher import NOTIFICATION_DISPATCHER, queue_deliveries
 from api.utils import get_session
 from api.tasks import nostr_send_notification_event
 
@@ -45,6 +48,15 @@ class Notifications:
         self, order, robot, title, description="", event_type="notification"
     ):
         """Save a message for a user and sends it to Telegram, Nostr, and/or Webhook"""
+        if NOTIFICATION_DISPATCHER:
+            # The notification and its deliveries are saved together (outbox)
+            with transaction.atomic():
+                self.save_message(order, robot, title, description)
+                queue_deliveries(
+                    self.deliveries(order, robot, title, description, event_type)
+                )
+            return
+
         self.save_message(order, robot, title, description)
         if robot.nostr_pubkey:
             nostr_send_notification_event.delay(
@@ -55,6 +67,46 @@ class Notifications:
         if robot.webhook_enabled:
             self.send_webhook_message(order, robot, title, description, event_type)
 
+    def deliveries(
+        self, order, robot, title, description="", event_type="notification"
+    ):
+        """Outbox deliveries of a message to the channels enabled by the robot"""
+        deliveries = []
+        if robot.nostr_pubkey:
+            deliveries.append(
+                NotificationDelivery(
+                    channel=NotificationDelivery.Channels.NOSTR,
+                    robot=robot,
+                    order=order,
+                    destination=robot.nostr_pubkey,
+                    payload={"text": title},
+                )
+            )
+        if robot.telegram_enabled:
+            deliveries.append(
+                NotificationDelivery(
+                    channel=NotificationDelivery.Channels.TELEGRAM,
+                    robot=robot,
+                    order=order,
+                    destination=str(robot.telegram_chat_id),
+                    payload={"text": f"{title} {description}"},
+                )
+            )
+        if robot.webhook_enabled:
+            deliveries.append(
+                NotificationDelivery(
+                    channel=NotificationDelivery.Channels.WEBHOOK,
+                    robot=robot,
+                    order=order,
+                    destination=robot.webhook_url,
+                    # Built once, so retries carry the same event_id
+                    payload=self.webhook_payload(
+                        order, robot, title, description, event_type
+                    ),
+                )
+            )
+        return deliveries
+
     def save_message(self, order, robot, title, description=""):
         """Save a message for a user"""
         Notification.objects.create(
@@ -64,8 +116,20 @@ class Notifications:
     def send_telegram_message(self, chat_id, title, description=""):
         """sends a message to a user with telegram notifications enabled"""
 
-        bot_token = config("TELEGRAM_TOKEN")
         text = f"{title} {description}"
+        if NOTIFICATION_DISPATCHER:
+            queue_deliveries(
+                [
+                    NotificationDelivery(
+                        channel=NotificationDelivery.Channels.TELEGRAM,
+                        destination=str(chat_id),
+                        payload={"text": text},
+                    )
+                ]
+            )
+            return
+
+        bot_token = config("TELEGRAM_TOKEN")
         message_url = f"https://api.telegram.org/bot{bot_token}/sendMessage?chat_id={chat_id}&text={text}"
         # if it fails, it should keep trying
         while True:
@@ -87,25 +151,7 @@ class Notifications:
                 f"Webhook URL rejected: not a .onion address for robot {robot.id}"
             )
             return
-        payload = {
-            "event_type": event_type,
-            "event_id": str(uuid.uuid4()),
-            "timestamp": datetime.now(timezone.utc).isoformat(),
-            "robot_hash_id": robot.hash_id,
-            "order": {
-                "id": order.id,
-                "type": "BUY" if order.type == Order.Types.BUY else "SELL",
-                "status": order.status,
-            },
-            "message": {
-                "title": title,
-                "description": description,
-            },
-            "metadata": {
-                "coordinator": config("COORDINATOR_ALIAS", cast=str, default="Unknown"),
-                "platform_version": config("VERSION", cast=str, default="Unknown"),
-            },
-        }
+        payload = self.webhook_payload(order, robot, title, description, event_type)
 
         headers = {
             "Content-Type": "application/json",
@@ -126,6 +172,30 @@ class Notifications:
         except Exception as e:
             logger.error(f"Webhook failed for robot {robot.id}: {e}")
 
+    def webhook_payload(
+        self, order, robot, title, description="", event_type="notification"
+    ):
+        """Body of a webhook notification"""
+        return {
+            "event_type": event_type,
+            "event_id": str(uuid.uuid4()),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "robot_hash_id": robot.hash_id,
+            "order": {
+                "id": order.id,
+                "type": "BUY" if order.type == Order.Types.BUY else "SELL",
+                "status": order.status,
+            },
+            "message": {
+                "title": title,
+                "description": description,
+            },
+            "metadata": {
+                "coordinator": config("COORDINATOR_ALIAS", cast=str, default="Unknown"),
+                "platform_version": config("VERSION", cast=str, default="Unknown"),
+            },
+        }
+
     def send_webhook_test(self, robot):
         """Sends a test webhook notification when webhook is first configured"""
         from api.models import Robot
@@ -173,15 +243,19 @@ class Notifications:
             logger.error(f"Webhook test failed for robot {robot.id}: {e}")
             return False
 
-    def welcome(self, user):
-        """User enabled Telegram Notifications"""
+    def welcome_title(self, user):
+        """Greeting of a user that enabled Telegram Notifications"""
         lang = user.robot.telegram_lang_code
 
         if lang == "es":
-            title = f"🔔 Hola {user.username}, te enviaré notificaciones sobre tus órdenes en RoboSats."
-        else:
-            title = f"🔔 Hey {user.username}, I will send you notifications about your RoboSats orders."
-        self.send_telegram_message(user.robot.telegram_chat_id, title)
+            return f"🔔 Hola {user.username}, te enviaré notificaciones sobre tus órdenes en RoboSats."
+        return f"🔔 Hey {user.username}, I will send you notifications about your RoboSats orders."
+
+    def welcome(self, user):
+        """User enabled Telegram Notifications"""
+        self.send_telegram_message(
+            user.robot.telegram_chat_id, self.welcome_title(user)
+        )
         user.robot.telegram_welcomed = True
         user.robot.save(update_fields=["telegram_welcomed"])
         return
@@ -313,10 +387,15 @@ class Notifications:
         from chat.models import Message
 
         TIMEGAP = config("CHAT_NOTIFICATION_TIMEGAP", cast=int, default=5)
-        if chat_message.index > 1:
-            previous_message = Message.objects.get(
-                chatroom=chat_message.chatroom, index=(chat_message.index - 1)
+        # Indices may have gaps (e.g. a message that failed to be stored)
+        previous_message = (
+            Message.objects.filter(
+                chatroom=chat_message.chatroom, index__lt=chat_message.index
             )
+            .order_by("-index")
+            .first()
+        )
+        if previous_message is not None:
             notification_reason = f"(You receive this notification only because more than {TIMEGAP} minutes have passed since the last in-chat message)"
             if previous_message.created_at > timezone.now() - timedelta(
                 minutes=TIMEGAP
@@ -815,8 +815,35 @@ class TickViewSchema:
                 required=False,
                 type=str,
             ),
+            OpenApiParameter(
+                name="period",
+                location=OpenApiParameter.QUERY,
+                description="Aggregate the ticks per `hour`, `day` or `week` and currency. "
+                "Each row has the number of ticks, the volume, the volume weighted median price and premium, "
+                "and the 25th and 75th percentiles of the premium. Up to 200000 ticks are aggregated, "
+                "results are cached for 5 minutes.",
+                required=False,
+                type=str,
+                enum=["hour", "day", "week"],
+            ),
         ],
         "examples": [
+            OpenApiExample(
+                "Ticks aggregated per day",
+                value=[
+                    {
+                        "period": "2022-09-13T00:00:00Z",
+                        "currency": 1,
+                        "num_ticks": 12,
+                        "volume": 0.08563412,
+                        "price": 21948.89,
+                        "premium": 3.5,
+                        "premium_q25": 2.1,
+                        "premium_q75": 5.2,
+                    }
+                ],
+                status_codes=[200],
+            ),
             OpenApiExample(
                 "Too many ticks",
                 value={
@@ -824,7 +851,7 @@ class TickViewSchema:
                     "bad_request": "More than 5000 market ticks have been found. Try narrowing the date range.",
                 },
                 status_codes=[400],
-            )
+            ),
         ],
     }
 
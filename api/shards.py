@@ -0,0 +1,159 @@
+import logging
+import os
+import socket
+import time
+import uuid
+import zlib
+
+from decouple import config
+from django.db.models.functions import Mod
+from django_redis import get_redis_connection
+
+logger = logging.getLogger("api.shards")
+
+# Background workers (clean_orders, follow_invoices) split orders and payments
+# into WORKER_SHARDS shards. With WORKER_SHARDING enabled, every replica of a
+# worker claims a fair share of the shards with Redis leases that it renews on
+# every heartbeat. Leases of a replica that stops heartbeating expire after
+# WORKER_LEASE_SECONDS and are claimed by the remaining replicas.
+# WORKER_SHARDS must be the same for every process of the coordinator.
+WORKER_SHARDING = config("WORKER_SHARDING", cast=bool, default=False)
+NUM_SHARDS = config("WORKER_SHARDS", cast=int, default=16)
+WORKER_LEASE_SECONDS = config("WORKER_LEASE_SECONDS", cast=int, default=30)
+WORKER_HEARTBEAT_SECONDS = config("WORKER_HEARTBEAT_SECONDS", cast=int, default=10)
+
+# Only the replica holding a lease may renew or release it
+RENEW_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def shard_of(id):
+    """Shard of an order id (or of any other string key, e.g. a payment hash)"""
+    if isinstance(id, int):
+        return id % NUM_SHARDS
+    return zlib.crc32(str(id).encode()) % NUM_SHARDS
+
+
+def filter_shards(queryset, expression, shards):
+    """Rows of queryset whose integer `expression` (e.g. "id") falls in shards"""
+    if len(shards) == NUM_SHARDS:
+        return queryset
+    return queryset.alias(shard=Mod(expression, NUM_SHARDS)).filter(
+        shard__in=list(shards)
+    )
+
+
+class ShardLeases:
+    """
+    Shards owned by one replica of a worker. Without WORKER_SHARDING the
+    replica owns every shard and no lease is taken.
+    """
+
+    def __init__(self, worker, sharding=None):
+        self.worker = worker
+        self.sharding = WORKER_SHARDING if sharding is None else sharding
+        self.member = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.shards = set() if self.sharding else set(range(NUM_SHARDS))
+        self.last_heartbeat = 0
+
+    @property
+    def members_key(self):
+        return f"shards:{self.worker}:members"
+
+    def lease_key(self, shard):
+        return f"shards:{self.worker}:lease:{shard}"
+
+    def owns(self, id):
+        return shard_of(id) in self.shards
+
+    def keep_alive(self):
+        """Heartbeats if the last heartbeat is WORKER_HEARTBEAT_SECONDS old"""
+        if time.monotonic() - self.last_heartbeat >= WORKER_HEARTBEAT_SECONDS:
+            self.heartbeat()
+        return self.shards
+
+    def heartbeat(self):
+        """
+        Renews the leases held, drops those lost and rebalances: replicas
+        holding more than their fair share release the extra shards, replicas
+        holding less claim free ones. Returns the owned shards.
+        """
+        if not self.sharding:
+            return self.shards
+
+        try:
+            self.shards = self.rebalance()
+        except Exception as e:
+            # Without renewing its leases, another replica may own them soon
+            logger.error(f"{self.worker} {self.member} could not heartbeat: {e}")
+            self.shards = set()
+        return self.shards
+
+    def rebalance(self):
+        redis = get_redis_connection("default")
+        now = time.time()
+        ttl = WORKER_LEASE_SECONDS * 1000
+        self.last_heartbeat = time.monotonic()
+
+        pipe = redis.pipeline()
+        pipe.zadd(self.members_key, {self.member: now})
+        pipe.zremrangebyscore(self.members_key, "-inf", now - WORKER_LEASE_SECONDS)
+        pipe.zrange(self.members_key, 0, -1)
+        members = sorted(member.decode() for member in pipe.execute()[2])
+
+        renew = redis.register_script(RENEW_SCRIPT)
+        held = {
+            shard
+            for shard in sorted(self.shards)
+            if renew(keys=[self.lease_key(shard)], args=[self.member, ttl])
+        }
+        lost = self.shards - held
+        if lost:
+            logger.warning(f"{self.worker} {self.member} lost shards {sorted(lost)}")
+
+        # Every live replica computes the same fair share from the members list
+        index = members.index(self.member) if self.member in members else 0
+        target = NUM_SHARDS // len(members) + (index < NUM_SHARDS % len(members))
+
+        if len(held) > target:
+            release = redis.register_script(RELEASE_SCRIPT)
+            for shard in sorted(held)[target:]:
+                release(keys=[self.lease_key(shard)], args=[self.member])
+                held.discard(shard)
+
+        for shard in range(NUM_SHARDS):
+            if len(held) >= target:
+                break
+            if shard not in held and redis.set(
+                self.lease_key(shard), self.member, nx=True, px=ttl
+            ):
+                held.add(shard)
+
+        if held != self.shards:
+            logger.info(f"{self.worker} {self.member} owns shards {sorted(held)}")
+        return held
+
+    def release(self):
+        """Releases every lease, so other replicas take over without waiting"""
+        if not self.sharding:
+            return
+
+        try:
+            redis = get_redis_connection("default")
+            release = redis.register_script(RELEASE_SCRIPT)
+            for shard in self.shards:
+                release(keys=[self.lease_key(shard)], args=[self.member])
+            redis.zrem(self.members_key, self.member)
+        except Exception as e:
+            logger.error(f"{self.worker} {self.member} could not release: {e}")
+        self.shards = set()
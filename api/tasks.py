@@ -4,22 +4,28 @@ from celery import shared_task
 from celery.exceptions import SoftTimeLimitExceeded
 
 
-@shared_task(name="users_cleansing", time_limit=600)
+@shared_task(name="users_cleansing", time_limit=600, soft_time_limit=570)
 def users_cleansing():
     """
-    Deletes users never used 12 hours after creation
+    Deletes users never used 12 hours after creation.
+    Candidates are filtered in the database and deleted by ascending id in
+    chunks, each in its own transaction. The last id reached is kept in
+    cache, so a run stopped by the time limit is resumed by the next one.
     """
     from datetime import timedelta
 
     from django.contrib.auth.models import User
+    from django.core.cache import cache
+    from django.db import transaction
     from django.db.models import Q
     from django.utils import timezone
 
-    from api.logics import Logics
+    from api.active_orders import has_active_order
+    from api.utils import delete_gpg_keys
 
-    import gnupg
-
-    gpg = gnupg.GPG(gnupghome=config("GNUPG_DIR", default=None))
+    chunk_size = config("USERS_CLEANSING_CHUNK", cast=int, default=1000)
+    cursor_key = "users_cleansing:cursor"
+    cursor = cache.get(cursor_key, 0)
 
     # Users who's last login has not been in the last 6 hours
     active_time_range = (timezone.now() - timedelta(hours=6), timezone.now())
@@ -27,50 +33,60 @@ def users_cleansing():
     queryset = queryset.filter(is_staff=False)  # Do not delete staff users
 
     # And do not have an active trade, any past contract or any reward.
-    deleted_users = []
-    for user in queryset:
-        # Try an except, due to unknown cause for users lacking robots.
-        try:
-            if (
-                user.robot.earned_rewards > 0
-                or user.robot.claimed_rewards > 0
-                or user.robot.telegram_enabled is True
-                or user.robot.webhook_enabled is True
-            ):
-                continue
-            if not user.robot.total_contracts == 0:
-                continue
-            valid, _, _ = Logics.validate_already_maker_or_taker(user)
-            if valid:
-                deleted_users.append(str(user))
-                user.delete()
-                # Delete also gpg keys
-                private_fpr = {
-                    key["fingerprint"] for key in
-                    gpg.scan_keys_mem(str(user.robot.encrypted_private_key))
-                }
-                for fpr in private_fpr:
-                    try:
-                        gpg.delete_keys(
-                            fpr, secret=True, expect_passphrase=False
-                        )
-                    except Exception as e:
-                        print(str(e))
-                public_fpr = {
-                    key["fingerprint"] for key in
-                    gpg.scan_keys_mem(str(user.robot.public_key))
-                }
-                for fpr in public_fpr:
-                    try:
-                        gpg.delete_keys(fpr, secret=False)
-                    except Exception as e:
-                        print(str(e))
-        except Exception:
-            pass
+    queryset = queryset.filter(
+        robot__earned_rewards=0,
+        robot__claimed_rewards=0,
+        robot__telegram_enabled=False,
+        robot__webhook_enabled=False,
+        robot__total_contracts=0,
+    ).exclude(has_active_order())
+
+    num_deleted = 0
+    num_keys_deleted = 0
+    finished = False
+    try:
+        while not finished:
+            with transaction.atomic():
+                # Locked, so no user logs in or takes an order before it is deleted
+                chunk = list(
+                    queryset.filter(id__gt=cursor)
+                    .order_by("id")
+                    .select_for_update(of=("self",))
+                    .values_list(
+                        "id", "robot__public_key", "robot__encrypted_private_key"
+                    )[:chunk_size]
+                )
+                if chunk:
+                    ids = [id for id, _, _ in chunk]
+                    _, deleted = User.objects.filter(id__in=ids).delete()
+                    num_deleted += deleted.get("auth.User", 0)
+                    cursor = ids[-1]
+                else:
+                    finished = True
+                    cursor = 0
+            cache.set(cursor_key, cursor, None)
+
+            if chunk:
+                # Delete also gpg keys, secret keys first
+                try:
+                    num_keys_deleted += delete_gpg_keys(
+                        [enc_priv_key for _, _, enc_priv_key in chunk], secret=True
+                    )
+                    num_keys_deleted += delete_gpg_keys(
+                        [pub_key for _, pub_key, _ in chunk]
+                    )
+                except SoftTimeLimitExceeded:
+                    raise
+                except Exception as e:
+                    print(str(e))
+    except SoftTimeLimitExceeded:
+        pass
 
     results = {
-        "num_deleted": len(deleted_users),
-        "deleted_users": deleted_users,
+        "num_deleted": num_deleted,
+        "num_keys_deleted": num_keys_deleted,
+        "finished": finished,
+        "cursor": cursor,
     }
     return results
 
@@ -179,6 +195,9 @@ def payments_cleansing():
     from django.utils import timezone
 
     from api.models import LNPayment, OnchainPayment
+    from api.utils import delete_in_chunks
+
+    chunk_size = config("CLEANSING_CHUNK", cast=int, default=1000)
 
     # Orders that have expired more than -3 days ago
     # Usually expiry is 1 day for every finished order. So ~4 days until
@@ -189,44 +208,49 @@ def payments_cleansing():
         Q(order_made__expires_at__lt=finished_time)
         | Q(order_taken__expires_at__lt=finished_time),
     )
-
-    # And do not have an active trade, any past contract or any reward.
-    deleted_lnpayments = []
-    for lnpayment in queryset:
-        # Try and except. In case some payment is already missing.
-        try:
-            name = str(lnpayment)
-            lnpayment.delete()
-            deleted_lnpayments.append(name)
-        except Exception:
-            pass
+    deleted_lnpayments, lnpayments_chunks, lnpayments_seconds = delete_in_chunks(
+        queryset, chunk_size
+    )
 
     # same for onchain payments
     queryset = OnchainPayment.objects.filter(
         Q(status__in=[OnchainPayment.Status.CANCE, OnchainPayment.Status.CREAT]),
         Q(order_paid_TX__expires_at__lt=finished_time) | Q(order_paid_TX__isnull=True),
     )
-
-    # And do not have an active trade, any past contract or any reward.
-    deleted_onchainpayments = []
-    for onchainpayment in queryset:
-        # Try and except. In case some payment is already missing.
-        try:
-            name = str(onchainpayment)
-            onchainpayment.delete()
-            deleted_onchainpayments.append(name)
-        except Exception:
-            pass
+    deleted_onchainpayments, onchainpayments_chunks, onchainpayments_seconds = (
+        delete_in_chunks(queryset, chunk_size)
+    )
 
     results = {
-        "num_lnpayments_deleted": len(deleted_lnpayments),
-        "deleted_lnpayments": deleted_lnpayments,
-        "num_onchainpayments_deleted": len(deleted_onchainpayments),
-        "deleted_onchainpayments": deleted_onchainpayments,
+        "num_lnpayments_deleted": deleted_lnpayments.get("api.LNPayment", 0),
+        "lnpayments_chunks": lnpayments_chunks,
+        "lnpayments_seconds": lnpayments_seconds,
+        "num_onchainpayments_deleted": deleted_onchainpayments.get(
+            "api.OnchainPayment", 0
+        ),
+        "onchainpayments_chunks": onchainpayments_chunks,
+        "onchainpayments_seconds": onchainpayments_seconds,
     }
     return results
 
 
+@shared_task(
+    name="cache_mining_fee_rates",
+    ignore_result=True,
+    time_limit=60,
+    soft_time_limit=55,
+)
+def cache_mining_fee_rates(release_lock=False):
+    """Refreshes the mining fee rates cached for every worker"""
+    from .utils import refresh_mining_fee_rates
+
+    try:
+        refresh_mining_fee_rates(release_lock=release_lock)
+    except SoftTimeLimitExceeded:
+        print("SOFT LIMIT REACHED. Could not fetch current mining fee rates.")
+        return
+
+
 @shared_task(
     name="cache_external_market_prices",
     ignore_result=True,
@@ -236,11 +260,14 @@ def payments_cleansing():
 def cache_market():
     import math
 
+    from django.core.cache import cache
     from django.utils import timezone
 
+    from .book import rebuild_book
     from .models import Currency
     from .utils import get_exchange_rates
 
+    currency_keys = list(Currency.currency_dict.keys())
     currency_codes = list(Currency.currency_dict.values())
 
     try:
@@ -249,29 +276,38 @@ def cache_market():
         if not exchange_rates:
             return
 
+        now = timezone.now()
         results = {}
-        for i in range(
-            len(Currency.currency_dict.values())
-        ):  # currencies are indexed starting at 1 (USD)
-            rate = exchange_rates[i]
+        currencies = []
+        # currencies are indexed starting at 1 (USD)
+        for i, (currency_key, rate) in enumerate(zip(currency_keys, exchange_rates)):
             results[i] = {currency_codes[i], rate}
 
             # Do not update if no new rate was found
             if math.isnan(rate):
                 continue
 
-            # Create / Update database cached prices
-            currency_key = list(Currency.currency_dict.keys())[i]
-            Currency.objects.update_or_create(
-                id=int(currency_key),
-                currency=int(currency_key),
-                # if there is a Cached market prices matching that id, it updates it with defaults below
-                defaults={
-                    "exchange_rate": float(rate),
-                    "timestamp": timezone.now(),
-                },
+            currencies.append(
+                Currency(
+                    id=int(currency_key),
+                    currency=int(currency_key),
+                    exchange_rate=float(rate),
+                    timestamp=now,
+                )
             )
 
+        # Create / Update database cached prices in a single upsert
+        Currency.objects.bulk_create(
+            currencies,
+            update_conflicts=True,
+            unique_fields=["id"],
+            update_fields=["exchange_rate", "timestamp"],
+        )
+
+        # Book prices and amounts in sats follow the new exchange rates
+        rebuild_book()
+        cache.delete_many(["price", "info"])
+
         return results
 
     except SoftTimeLimitExceeded:
@@ -279,11 +315,17 @@ def cache_market():
         return
 
 
-@shared_task(name="", ignore_result=True, time_limit=120)
-def nostr_send_order_event(order_id=None):
+@shared_task(bind=True, name="", ignore_result=True, time_limit=120)
+def nostr_send_order_event(self, order_id=None):
     if order_id:
         from api.models import Order
-        from api.nostr import Nostr
+        from api.nostr import NOSTR_PUBLISHER, Nostr, enqueue_order_event
+
+        # Published by the nostr_publisher worker
+        if NOSTR_PUBLISHER:
+            if not enqueue_order_event(order_id):
+                defer_nostr_event(self, f"order {order_id}")
+            return
 
         order = Order.objects.get(id=order_id)
 
@@ -293,11 +335,17 @@ def nostr_send_order_event(order_id=None):
     return
 
 
-@shared_task(name="", ignore_result=True, time_limit=120)
-def nostr_send_notification_event(robot_id=None, order_id=None, text=None):
+@shared_task(bind=True, name="", ignore_result=True, time_limit=120)
+def nostr_send_notification_event(self, robot_id=None, order_id=None, text=None):
     if order_id:
         from api.models import Robot, Order
-        from api.nostr import Nostr
+        from api.nostr import NOSTR_PUBLISHER, Nostr, enqueue_notification_event
+
+        # Published by the nostr_publisher worker
+        if NOSTR_PUBLISHER:
+            if not enqueue_notification_event(robot_id, order_id, text):
+                defer_nostr_event(self, f"notification of order {order_id}")
+            return
 
         robot = Robot.objects.get(id=robot_id)
         order = Order.objects.get(id=order_id)
@@ -308,6 +356,20 @@ def nostr_send_notification_event(robot_id=None, order_id=None, text=None):
     return
 
 
+def defer_nostr_event(task, description):
+    """
+    The nostr queue is full: the task runs again later instead of opening
+    another relay connection, and the event is dropped after NOSTR_MAX_ATTEMPTS.
+    """
+    from api.nostr import NOSTR_DEFER_SECONDS, NOSTR_MAX_ATTEMPTS
+
+    attempts = task.request.retries + 1
+    if attempts >= NOSTR_MAX_ATTEMPTS:
+        print(f"Dropping nostr event of {description}, the queue is still full")
+        return
+    raise task.retry(countdown=NOSTR_DEFER_SECONDS * attempts, max_retries=None)
+
+
 @shared_task(name="send_notification", ignore_result=True, time_limit=120)
 def send_notification(order_id=None, chat_message_id=None, message=None):
     if order_id:
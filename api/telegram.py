@@ -0,0 +1,145 @@
+import asyncio
+import logging
+
+from asgiref.sync import sync_to_async
+from decouple import config
+from django_redis import get_redis_connection
+
+from api.models import Robot
+from api.notifications import Notifications
+from api.utils import get_session
+
+logger = logging.getLogger("api.telegram")
+
+# Seconds Telegram holds a getUpdates request open waiting for new updates
+TELEGRAM_POLL_TIMEOUT = config("TELEGRAM_POLL_TIMEOUT", cast=int, default=50)
+TELEGRAM_RETRY_SECONDS = config("TELEGRAM_RETRY_SECONDS", cast=float, default=5)
+
+# Last handled update_id, so restarts neither replay nor drop updates
+OFFSET_KEY = "telegram_watcher:offset"
+
+NO_TOKEN_TEXT = 'You must enable the notifications bot using the RoboSats client. Click on your "Robot robot" -> "Enable Telegram" and follow the link or scan the QR code.'
+
+
+def parse_start(update):
+    """(chat id, language code, token) of a /start message, None for any other update"""
+    message = update.get("message") or {}
+    text = message.get("text")
+    if not text or not text.startswith("/start"):
+        return None
+    parts = text.split(" ")
+    token = parts[-1] if len(parts) >= 2 else None
+    sender = message.get("from") or {}
+    if "id" not in sender:
+        return None
+    return sender["id"], sender.get("language_code"), token
+
+
+class TelegramWatcher:
+    """
+    Long-polls Telegram getUpdates over a single session and enables the
+    notifications of the robots whose token is sent with /start, resolving
+    the tokens of each batch of updates in one query.
+    """
+
+    def __init__(self, session=None):
+        bot_token = config("TELEGRAM_TOKEN")
+        self.updates_url = f"https://api.telegram.org/bot{bot_token}/getUpdates"
+        self.session = session or get_session()
+        self.notifications = Notifications()
+        self.redis = get_redis_connection("default")
+
+    def get_offset(self):
+        offset = self.redis.get(OFFSET_KEY)
+        return int(offset) if offset is not None else 0
+
+    def set_offset(self, offset):
+        self.redis.set(OFFSET_KEY, offset)
+
+    def get_updates(self, offset):
+        """Waits up to TELEGRAM_POLL_TIMEOUT seconds for the updates after offset"""
+        response = self.session.get(
+            self.updates_url,
+            params={
+                "offset": offset + 1,
+                "timeout": TELEGRAM_POLL_TIMEOUT,
+                "allowed_updates": '["message"]',
+            },
+            timeout=TELEGRAM_POLL_TIMEOUT + 10,
+        )
+        response.raise_for_status()
+        return response.json().get("result", [])
+
+    def enable_robots(self, updates):
+        """
+        Enables Telegram notifications for the robots whose token was sent
+        in the updates. Returns the (chat id, text) replies to send.
+        """
+        starts = [start for start in map(parse_start, updates) if start is not None]
+        tokens = {token for _, _, token in starts if token}
+        robots = {
+            robot.telegram_token: robot
+            for robot in Robot.objects.select_related("user").filter(
+                telegram_token__in=tokens
+            )
+        }
+
+        replies = []
+        enabled = {}
+        for chat_id, lang_code, token in starts:
+            if token is None:
+                replies.append((chat_id, NO_TOKEN_TEXT))
+                continue
+            robot = robots.get(token)
+            if robot is None:
+                replies.append(
+                    (
+                        chat_id,
+                        f'Wops, invalid token! There is no Robot with telegram chat token "{token}"',
+                    )
+                )
+                continue
+            robot.telegram_chat_id = chat_id
+            robot.telegram_lang_code = lang_code
+            robot.telegram_enabled = True
+            robot.telegram_welcomed = True
+            enabled[robot.id] = robot
+            replies.append((chat_id, self.notifications.welcome_title(robot.user)))
+
+        Robot.objects.bulk_update(
+            enabled.values(),
+            [
+                "telegram_chat_id",
+                "telegram_lang_code",
+                "telegram_enabled",
+                "telegram_welcomed",
+            ],
+        )
+        return replies
+
+    async def reply(self, chat_id, text):
+        try:
+            await asyncio.to_thread(
+                self.notifications.send_telegram_message, chat_id, text
+            )
+        except Exception as e:
+            logger.error(f"Could not reply to telegram chat {chat_id}: {e}")
+
+    async def handle_updates(self, updates):
+        replies = await sync_to_async(self.enable_robots)(updates)
+        await asyncio.gather(*(self.reply(chat_id, text) for chat_id, text in replies))
+        # Confirmed once handled, Telegram drops the updates up to this offset
+        await asyncio.to_thread(self.set_offset, updates[-1]["update_id"])
+
+    async def run(self):
+        offset = await asyncio.to_thread(self.get_offset)
+        while True:
+            try:
+                updates = await asyncio.to_thread(self.get_updates, offset)
+                if updates:
+                    await self.handle_updates(updates)
+                    offset = updates[-1]["update_id"]
+            except Exception as e:
+                # The same updates are fetched again, the offset did not move
+                logger.error(f"Error handling telegram updates: {e}")
+                await asyncio.sleep(TELEGRAM_RETRY_SECONDS)
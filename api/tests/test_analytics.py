@@ -0,0 +1,255 @@
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import skipUnless
+from unittest.mock import patch
+
+import numpy as np
+from decouple import config
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from api.analytics import (
+    BTC_CURRENCY,
+    PERIODS,
+    Ticks,
+    group_weighted_quantile,
+    weighted_median,
+    weighted_quantile,
+)
+from api.models import Currency, MarketTick
+from api.utils import weighted_median as reference_weighted_median
+
+RUN_BENCHMARKS = config("RUN_BENCHMARKS", default=False, cast=bool)
+
+
+def _synthetic_ticks(n, seed=0):
+    rng = np.random.default_rng(seed)
+    timestamp = 1.6e9 + np.sort(rng.random(n)) * 365 * PERIODS["day"]
+    currency = rng.choice([1, 2, 3, BTC_CURRENCY], n)
+    price = rng.normal(30_000, 1_000, n)
+    volume = rng.random(n) * 0.01
+    premium = rng.normal(3, 2, n)
+    return timestamp, currency, price, volume, premium
+
+
+def _looped_daily_premiums(columns):
+    """
+    Daily weighted median premium per currency, grouping rows in Python and
+    calling api.utils.weighted_median per group (the previous approach)
+    """
+    timestamp, currency, _, volume, premium = columns
+    groups = {}
+    for t, c, v, p in zip(
+        timestamp.tolist(), currency.tolist(), volume.tolist(), premium.tolist()
+    ):
+        premiums, volumes = groups.setdefault((int(t // 86400), c), ([], []))
+        premiums.append(p)
+        volumes.append(v)
+    return {
+        key: reference_weighted_median(premiums, sample_weight=volumes)
+        for key, (premiums, volumes) in groups.items()
+    }
+
+
+class TestWeightedQuantiles(TestCase):
+    def test_matches_reference_weighted_median(self):
+        rng = np.random.default_rng(1)
+        for _ in range(100):
+            n = rng.integers(2, 50)
+            values = rng.normal(size=n)
+            weights = rng.random(n) + 0.01
+            self.assertAlmostEqual(
+                weighted_median(values, weights),
+                float(reference_weighted_median(values, sample_weight=weights)),
+            )
+
+    def test_quantiles(self):
+        values = [1, 2, 3, 4, 5]
+        weights = [1, 1, 1, 1, 1]
+        self.assertEqual(weighted_quantile(values, weights, 0), 1)
+        self.assertEqual(weighted_quantile(values, weights, 0.5), 3)
+        self.assertEqual(weighted_quantile(values, weights, 1), 5)
+
+    def test_single_and_empty(self):
+        self.assertEqual(weighted_median([3.5], [0.01]), 3.5)
+        self.assertEqual(weighted_median([], []), 0.0)
+
+    def test_groups(self):
+        rng = np.random.default_rng(2)
+        groups = rng.integers(0, 5, 1000)
+        values = rng.normal(size=1000)
+        weights = rng.random(1000)
+
+        medians, q25 = group_weighted_quantile(groups, values, weights, [0.5, 0.25])
+
+        for group in range(5):
+            mask = groups == group
+            self.assertAlmostEqual(
+                medians[group], weighted_median(values[mask], weights[mask])
+            )
+            self.assertAlmostEqual(
+                q25[group], weighted_quantile(values[mask], weights[mask], 0.25)
+            )
+
+    def test_missing_group_is_nan(self):
+        result = group_weighted_quantile([0, 2, 2], [1.0, 2.0, 4.0], [1, 1, 1], 0.5)
+        self.assertEqual(result[0], 1.0)
+        self.assertTrue(np.isnan(result[1]))
+        self.assertEqual(result[2], 3.0)
+
+
+class TestTicks(TestCase):
+    def setUp(self):
+        self.ticks = Ticks(*_synthetic_ticks(10_000))
+
+    def test_avg_premium_excludes_btc(self):
+        fiat = self.ticks.currency != BTC_CURRENCY
+        premium, volume = self.ticks.avg_premium()
+
+        self.assertAlmostEqual(volume, self.ticks.volume[fiat].sum())
+        self.assertAlmostEqual(
+            premium,
+            weighted_median(self.ticks.premium[fiat], self.ticks.volume[fiat]),
+        )
+
+    def test_premium_by_currency(self):
+        premiums = self.ticks.premium_by_currency()
+
+        self.assertEqual(set(premiums), {1, 2, 3, BTC_CURRENCY})
+        mask = self.ticks.currency == 2
+        self.assertAlmostEqual(
+            premiums[2],
+            weighted_median(self.ticks.premium[mask], self.ticks.volume[mask]),
+        )
+
+    def test_periods(self):
+        rows = self.ticks.periods("week")
+
+        self.assertEqual(sum(row["num_ticks"] for row in rows), len(self.ticks))
+        row = rows[3]
+        week = PERIODS["week"]
+        mask = (self.ticks.timestamp // week == row["period"].timestamp() // week) & (
+            self.ticks.currency == row["currency"]
+        )
+        self.assertEqual(row["num_ticks"], mask.sum())
+        self.assertAlmostEqual(row["volume"], self.ticks.volume[mask].sum(), places=6)
+        premiums, volumes = self.ticks.premium[mask], self.ticks.volume[mask]
+        self.assertAlmostEqual(
+            row["premium"], round(weighted_median(premiums, volumes), 2)
+        )
+        self.assertAlmostEqual(
+            row["premium_q25"], round(weighted_quantile(premiums, volumes, 0.25), 2)
+        )
+
+    def test_periods_match_python_loop(self):
+        columns = _synthetic_ticks(20_000)
+        looped = _looped_daily_premiums(columns)
+        rows = Ticks(*columns).periods("day")
+
+        self.assertEqual(len(rows), len(looped))
+        for row in rows[:: len(rows) // 10]:
+            key = (int(row["period"].timestamp() // 86400), row["currency"])
+            self.assertAlmostEqual(row["premium"], round(float(looped[key]), 2))
+
+    def test_rolling(self):
+        day = PERIODS["day"]
+        ends, volumes, premiums = self.ticks.rolling(window=7 * day, step=day)
+
+        fiat = self.ticks.fiat()
+        mask = (fiat.timestamp > ends[10] - 7 * day) & (fiat.timestamp <= ends[10])
+        self.assertAlmostEqual(volumes[10], fiat.volume[mask].sum())
+        self.assertAlmostEqual(
+            premiums[10], weighted_median(fiat.premium[mask], fiat.volume[mask])
+        )
+
+    def test_load_from_database(self):
+        currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        for i, premium in enumerate(("1.00", "2.00", "9.00")):
+            MarketTick.objects.create(
+                price=Decimal("30000"),
+                volume=Decimal("0.01"),
+                premium=Decimal(premium),
+                currency=currency,
+                timestamp=timezone.now() - timedelta(hours=i),
+            )
+
+        ticks = Ticks.load(MarketTick.objects.all())
+
+        self.assertEqual(len(ticks), 3)
+        self.assertTrue(np.all(np.diff(ticks.timestamp) >= 0))
+        premium, volume = ticks.avg_premium()
+        self.assertAlmostEqual(premium, 2.0)
+        self.assertAlmostEqual(volume, 0.03)
+        self.assertEqual(len(Ticks.load(MarketTick.objects.none())), 0)
+
+    def test_tick_view_periods(self):
+        currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        MarketTick.objects.create(
+            price=Decimal("30000"),
+            volume=Decimal("0.01"),
+            premium=Decimal("2.00"),
+            currency=currency,
+        )
+        client = APIClient()
+        cache.delete("ticks:day:None:None")
+        self.addCleanup(cache.delete, "ticks:day:None:None")
+
+        response = client.get(reverse("ticks") + "?period=day")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(response.json()[0]["num_ticks"], 1)
+        self.assertEqual(response.json()[0]["premium"], 2.0)
+
+        # Served from the cache without querying the ticks
+        with self.assertNumQueries(0):
+            response = client.get(reverse("ticks") + "?period=day")
+        self.assertEqual(response.json()[0]["num_ticks"], 1)
+
+        response = client.get(reverse("ticks") + "?period=month")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error_code"], 1057)
+
+        # The raw ticks loaded to aggregate are bounded
+        with patch("api.views.MAX_AGGREGATED_TICKS", 0):
+            response = client.get(reverse("ticks") + "?period=week")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()["error_code"], 1058)
+
+
+@skipUnless(RUN_BENCHMARKS, "Benchmarks run with RUN_BENCHMARKS=True")
+class BenchmarkTickAnalytics(TestCase):
+    """
+    Benchmark over 1M synthetic ticks: daily weighted median premium per
+    currency computed by grouping rows in Python and calling
+    api.utils.weighted_median per group (the previous approach) versus
+    the vectorized Ticks.periods. Opt-in, timings depend on the machine.
+    """
+
+    NUM_TICKS = 1_000_000
+
+    def test_periods_over_1m_ticks(self):
+        columns = _synthetic_ticks(self.NUM_TICKS)
+
+        t0 = time.perf_counter()
+        looped = _looped_daily_premiums(columns)
+        python_loop = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        rows = Ticks(*columns).periods("day")
+        vectorized = time.perf_counter() - t0
+
+        print("\nticks      python loop(s)  vectorized(s)  groups")
+        print(
+            f"{self.NUM_TICKS:>9}  {python_loop:>14.3f}  {vectorized:>13.3f}  {len(rows)}"
+        )
+
+        self.assertEqual(len(rows), len(looped))
+        self.assertLess(vectorized, python_loop)
@@ -15,10 +15,14 @@ cln.py module scope never touch the filesystem.
 import hashlib
 import sys
 from io import BytesIO
+from unittest import skipUnless
 from unittest.mock import MagicMock, patch
 
+from decouple import config
 from django.test import TestCase
 
+RUN_BENCHMARKS = config("RUN_BENCHMARKS", default=False, cast=bool)
+
 
 # ---------------------------------------------------------------------------
 # Helper constants mirroring the proto enums (integer values)
@@ -403,3 +407,319 @@ class TestLNDCancelReturnHoldInvoice(TestCase, _LNDInvoicesStubPatcher):
 
             LNDNode.cancel_return_hold_invoice(PAYMENT_HASH_HEX)
         stub.CancelInvoice.assert_called_once()
+
+
+class TestLNDInvoiceStatusFromResponse(TestCase):
+    """
+    LNDNode.invoice_status_from_response maps a lnrpc.Invoice (from
+    LookupInvoiceV2 or a SubscribeSingleInvoice stream) to an LNPayment status
+    and the highest HTLC expiry height.
+    """
+
+    @staticmethod
+    def _invoice(state, expiry_heights=()):
+        invoice = MagicMock()
+        invoice.state = state
+        invoice.htlcs = [MagicMock(expiry_height=height) for height in expiry_heights]
+        return invoice
+
+    def test_maps_every_invoice_state(self):
+        from api.lightning.lnd import LNDNode
+        from api.models import LNPayment
+
+        expected = {
+            LND_STATE_OPEN: LNPayment.Status.INVGEN,
+            LND_STATE_SETTLED: LNPayment.Status.SETLED,
+            LND_STATE_CANCELED: LNPayment.Status.CANCEL,
+            LND_STATE_ACCEPTED: LNPayment.Status.LOCKED,
+        }
+        for state, status in expected.items():
+            result, _ = LNDNode.invoice_status_from_response(self._invoice(state))
+            self.assertEqual(result, status)
+
+    def test_returns_highest_htlc_expiry_height(self):
+        from api.lightning.lnd import LNDNode
+
+        _, expiry_height = LNDNode.invoice_status_from_response(
+            self._invoice(LND_STATE_ACCEPTED, expiry_heights=(800_100, 800_144))
+        )
+        self.assertEqual(expiry_height, 800_144)
+
+
+class TestLNDSubscribeHoldInvoice(TestCase, _LNDInvoicesStubPatcher):
+    """
+    LNDNode.subscribe_hold_invoice opens a SubscribeSingleInvoice stream for
+    the hold invoice hash and hands back the cancellable call.
+    """
+
+    def test_returns_subscribe_single_invoice_call(self):
+        patcher, stub = self._make_stub()
+        with patcher:
+            from api.lightning.lnd import LNDNode
+
+            call = LNDNode.subscribe_hold_invoice(PAYMENT_HASH_HEX)
+        stub.SubscribeSingleInvoice.assert_called_once()
+        request = stub.SubscribeSingleInvoice.call_args[0][0]
+        self.assertEqual(request.r_hash, bytes.fromhex(PAYMENT_HASH_HEX))
+        self.assertIs(call, stub.SubscribeSingleInvoice.return_value)
+
+
+class _SlowLookupStub:
+    """
+    Fake InvoicesStub whose LookupInvoiceV2 takes `latency` seconds, like a
+    round-trip to a remote node, and records the peak number of concurrent calls.
+    With `wait_for`, calls are held until that many have been in flight at once.
+    """
+
+    def __init__(self, latency=0.0, state=LND_STATE_ACCEPTED, wait_for=None):
+        import threading
+
+        self.latency = latency
+        self.state = state
+        self.wait_for = wait_for
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Condition()
+
+    def LookupInvoiceV2(self, request):
+        import time
+
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.lock.notify_all()
+            if self.wait_for is not None:
+                self.lock.wait_for(
+                    lambda: self.max_in_flight >= self.wait_for, timeout=5
+                )
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+        response = MagicMock()
+        response.state = self.state
+        response.htlcs = [MagicMock(expiry_height=int(request.payment_hash[0]))]
+        return response
+
+
+def _hold_lnpayments(count):
+    """Stand-ins for hold LNPayments with distinct payment hashes."""
+    lnpayments = []
+    for i in range(count):
+        lnpayment = MagicMock()
+        lnpayment.payment_hash = bytes([i % 256]).hex() + f"{i:062x}"
+        lnpayment.status = 0
+        lnpayments.append(lnpayment)
+    return lnpayments
+
+
+class TestLNDLookupInvoiceStatuses(TestCase):
+    """
+    LNDNode.lookup_invoice_statuses looks up many hold invoices concurrently,
+    never exceeding LOOKUP_INVOICE_CONCURRENCY calls in flight, and returns
+    the results keyed by payment hash.
+    """
+
+    def _run(self, stub, lnpayments, concurrency):
+        with (
+            patch(
+                "api.lightning.lnd.invoices_pb2_grpc.InvoicesStub",
+                MagicMock(return_value=stub),
+            ),
+            patch("api.lightning.lnd.LOOKUP_INVOICE_CONCURRENCY", concurrency),
+        ):
+            from api.lightning.lnd import LNDNode
+
+            return LNDNode.lookup_invoice_statuses(lnpayments)
+
+    def test_returns_statuses_keyed_by_payment_hash(self):
+        from api.models import LNPayment
+
+        lnpayments = _hold_lnpayments(20)
+        result = self._run(_SlowLookupStub(), lnpayments, concurrency=4)
+
+        self.assertEqual(
+            set(result.keys()), {lnpayment.payment_hash for lnpayment in lnpayments}
+        )
+        for lnpayment in lnpayments:
+            status, expiry_height = result[lnpayment.payment_hash]
+            self.assertEqual(status, LNPayment.Status.LOCKED)
+            self.assertEqual(
+                expiry_height, int(bytes.fromhex(lnpayment.payment_hash)[0])
+            )
+
+    def test_concurrency_is_capped(self):
+        stub = _SlowLookupStub(latency=0.01)
+        self._run(stub, _hold_lnpayments(40), concurrency=4)
+        self.assertGreater(stub.max_in_flight, 1)
+        self.assertLessEqual(stub.max_in_flight, 4)
+
+    def test_lookups_run_in_parallel(self):
+        # Each call is held until 16 are in flight, a sequential lookup never gets there
+        stub = _SlowLookupStub(wait_for=16)
+        self._run(stub, _hold_lnpayments(64), concurrency=16)
+        self.assertEqual(stub.max_in_flight, 16)
+
+    def test_empty_input_makes_no_calls(self):
+        stub = MagicMock()
+        self.assertEqual(self._run(stub, [], concurrency=4), {})
+        stub.LookupInvoiceV2.assert_not_called()
+
+
+class TestCLNLookupInvoiceStatuses(TestCase, _CLNHoldStubPatcher):
+    """CLNNode.lookup_invoice_statuses returns HoldInvoiceLookup results by hash."""
+
+    def test_returns_statuses_keyed_by_payment_hash(self):
+        from api.models import LNPayment
+
+        lnpayments = _hold_lnpayments(3)
+        patcher, stub = self._make_stub(lookup_states=[CLN_STATE_SETTLED] * 3)
+        import_patches = _make_cln_import_patches()
+        original_cln = sys.modules.get("api.lightning.cln")
+        sys.modules.pop("api.lightning.cln", None)
+        try:
+            with import_patches[0], import_patches[1], import_patches[2]:
+                with patcher:
+                    from api.lightning.cln import CLNNode
+
+                    result = CLNNode.lookup_invoice_statuses(lnpayments)
+        finally:
+            if original_cln is not None:
+                sys.modules["api.lightning.cln"] = original_cln
+            else:
+                sys.modules.pop("api.lightning.cln", None)
+
+        self.assertEqual(stub.HoldInvoiceLookup.call_count, 3)
+        self.assertEqual(
+            {status for status, _ in result.values()}, {LNPayment.Status.SETLED}
+        )
+        self.assertEqual(len(result), 3)
+
+
+@skipUnless(RUN_BENCHMARKS, "Benchmarks run with RUN_BENCHMARKS=True")
+class BenchmarkLookupInvoiceStatuses(TestCase):
+    """
+    Regtest-free benchmark: time to look up N hold invoices against a fake stub
+    with a 10 ms round-trip, sequentially (the old follow_hold_invoices loop)
+    versus LNDNode.lookup_invoice_statuses. Opt-in, timings depend on the machine.
+    """
+
+    LATENCY = 0.01
+    COUNTS = (10, 50, 200)
+
+    def test_bulk_lookup_scales_with_concurrency(self):
+        import time
+
+        from api.lightning.lnd import LNDNode
+
+        stub = _SlowLookupStub(latency=self.LATENCY)
+        rows = []
+        with (
+            patch(
+                "api.lightning.lnd.invoices_pb2_grpc.InvoicesStub",
+                MagicMock(return_value=stub),
+            ),
+            patch("api.lightning.lnd.LOOKUP_INVOICE_CONCURRENCY", 16),
+        ):
+            for count in self.COUNTS:
+                lnpayments = _hold_lnpayments(count)
+
+                t0 = time.perf_counter()
+                for lnpayment in lnpayments:
+                    LNDNode.lookup_invoice_status(lnpayment)
+                sequential = time.perf_counter() - t0
+
+                t0 = time.perf_counter()
+                LNDNode.lookup_invoice_statuses(lnpayments)
+                bulk = time.perf_counter() - t0
+
+                rows.append((count, sequential, bulk))
+
+        print("\ninvoices  sequential(s)  bulk(s)")
+        for count, sequential, bulk in rows:
+            print(f"{count:>8}  {sequential:>13.3f}  {bulk:>7.3f}")
+
+        count, sequential, bulk = rows[-1]
+        self.assertLess(bulk, sequential / 4)
+
+
+class _FakeInvoiceStream:
+    """Stands in for a server-streaming gRPC call."""
+
+    def __init__(self, responses):
+        self.responses = responses
+        self._cancelled = False
+
+    def __iter__(self):
+        for response in self.responses:
+            if self._cancelled:
+                raise RuntimeError("Locally cancelled by application!")
+            yield response
+
+    def cancel(self):
+        self._cancelled = True
+
+    def cancelled(self):
+        return self._cancelled
+
+
+class TestFollowInvoicesHoldInvoiceStream(TestCase):
+    """
+    follow_invoices forwards streamed hold invoice updates into its queue and
+    closes the stream once the invoice leaves INVGEN.
+    """
+
+    def _run(self, stream):
+        import queue
+        import threading
+
+        from api.management.commands.follow_invoices import Command
+
+        command = Command()
+        command.updates = queue.Queue()
+        command.subscriptions_lock = threading.Lock()
+        command.subscriptions = {PAYMENT_HASH_HEX: stream}
+
+        with patch("api.management.commands.follow_invoices.LNNode") as node:
+            node.invoice_status_from_response.side_effect = lambda status: (
+                status,
+                0,
+            )
+            command.read_hold_invoice_stream(PAYMENT_HASH_HEX, stream)
+
+        updates = []
+        while not command.updates.empty():
+            updates.append(command.updates.get())
+        return command, updates
+
+    def test_stream_is_closed_once_invoice_is_locked(self):
+        from api.models import LNPayment
+
+        stream = _FakeInvoiceStream(
+            [
+                LNPayment.Status.INVGEN,
+                LNPayment.Status.LOCKED,
+                LNPayment.Status.SETLED,
+            ]
+        )
+        command, updates = self._run(stream)
+        self.assertEqual(
+            updates,
+            [
+                (PAYMENT_HASH_HEX, LNPayment.Status.INVGEN, 0),
+                (PAYMENT_HASH_HEX, LNPayment.Status.LOCKED, 0),
+            ],
+        )
+        self.assertTrue(stream.cancelled())
+        self.assertEqual(command.subscriptions, {})
+
+    def test_broken_stream_is_dropped_for_resubscription(self):
+        from api.models import LNPayment
+
+        class _BrokenStream(_FakeInvoiceStream):
+            def __iter__(self):
+                yield LNPayment.Status.INVGEN
+                raise RuntimeError("Socket closed")
+
+        command, updates = self._run(_BrokenStream([]))
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(command.subscriptions, {})
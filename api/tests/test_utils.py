@@ -1,33 +1,54 @@
+import json
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import skipUnless
 from unittest.mock import MagicMock, Mock, mock_open, patch
 
 import numpy as np
+import requests
 from decouple import config
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.test import TestCase
 from django.utils import timezone
 
 from api.models import Robot
 from api.utils import (
+    MARKET_PRICE_MAX_FAILURES,
+    MARKET_PRICE_TIMEOUT,
+    MINING_FEE_RATES_KEY,
+    BitcoindRPCError,
     base91_to_hex,
     bitcoind_rpc,
+    bitcoind_rpc_batch,
+    countries_index_cache,
+    get_bitcoind_session,
     get_cln_version,
     get_exchange_rates,
     get_lnd_version,
+    get_minning_fee,
     get_robosats_commit,
     get_session,
     hex_to_base91,
     is_valid_token,
+    location_country,
+    market_cache,
+    market_price_api_health,
     objects_to_hyperlinks,
     validate_onchain_address,
+    validate_onchain_addresses,
     validate_pgp_keys,
     verify_signed_message,
     weighted_median,
 )
 
+RUN_BENCHMARKS = config("RUN_BENCHMARKS", default=False, cast=bool)
+
 
 def _read_robot_key(name: str) -> str:
     with open(f"tests/robots/1/{name}") as file:
@@ -87,11 +108,12 @@ class TestUtils(TestCase):
         session = get_session()
         self.assertEqual(session, mock_session.return_value)
 
-    @patch("api.utils.config")
-    @patch("api.utils.requests.post")
-    def test_bitcoind_rpc(self, mock_post, mock_config):
-        mock_config.side_effect = ["url", "user", "password"]
-        mock_post.return_value.json.return_value = {"result": "response"}
+    @patch("api.utils.get_bitcoind_session")
+    def test_bitcoind_rpc(self, mock_session):
+        mock_session.return_value.post.return_value.json.return_value = {
+            "result": "response",
+            "error": None,
+        }
         response = bitcoind_rpc("method", ["params"])
         self.assertEqual(response, "response")
 
@@ -117,7 +139,12 @@ class TestUtils(TestCase):
         # Mock the get method of the session object to return a mock response
         mock_response_blockchain = Mock()
         mock_response_yadio = Mock()
-        mock_session.get.side_effect = [mock_response_yadio, mock_response_blockchain]
+        # APIs are queried concurrently, so responses are matched by url
+        responses = {
+            "https://api.yadio.io/exrates/BTC": mock_response_yadio,
+            "https://blockchain.info/ticker": mock_response_blockchain,
+        }
+        mock_session.get.side_effect = lambda url, **kwargs: responses[url]
 
         # Mock the json method of the response object to return a dictionary of exchange rates
         mock_response_blockchain.json.return_value = {
@@ -143,8 +170,12 @@ class TestUtils(TestCase):
         )  # Check if the median is correctly calculated
 
         # Assert that the get method of the session object was called with the correct arguments
-        mock_session.get.assert_any_call("https://blockchain.info/ticker")
-        mock_session.get.assert_any_call("https://api.yadio.io/exrates/BTC")
+        mock_session.get.assert_any_call(
+            "https://blockchain.info/ticker", timeout=MARKET_PRICE_TIMEOUT
+        )
+        mock_session.get.assert_any_call(
+            "https://api.yadio.io/exrates/BTC", timeout=MARKET_PRICE_TIMEOUT
+        )
 
         # Assert that the json method of the response object was called
         mock_response_blockchain.json.assert_called_once()
@@ -418,3 +449,348 @@ class TestUtils(TestCase):
         self.assertEqual(
             linked_logs, '<b><a href="/coordinator/api/robot/1">robot_name</a></b>'
         )
+
+    def test_location_country(self):
+        self.assertEqual(location_country(-3.7, 40.4), "ESP")
+        self.assertEqual(location_country(2.35, 48.85), "FRA")
+        # Gulf of Guinea, in the middle of the sea
+        self.assertEqual(location_country(0, 0), "unknown")
+
+    def test_location_country_index_is_built_once(self):
+        countries_index_cache.clear()
+        with patch("api.utils.json.load", wraps=json.load) as load:
+            location_country(-3.7, 40.4)
+            with patch("builtins.open") as mock_file:
+                for lon, lat in [(2.35, 48.85), (0, 0), (-3.7, 40.4)]:
+                    location_country(lon, lat)
+        mock_file.assert_not_called()
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual(len(countries_index_cache), 1)
+
+
+@skipUnless(RUN_BENCHMARKS, "Benchmarks run with RUN_BENCHMARKS=True")
+class BenchmarkLocationCountry(TestCase):
+    """
+    Benchmark of location_country: a cold lookup (loads the GeoJSON and
+    builds the spatial index, as every call used to) versus warm lookups
+    against the cached STRtree of prepared geometries. Opt-in, timings
+    depend on the machine.
+    """
+
+    LOOKUPS = 1000
+
+    def test_cold_vs_warm_lookups(self):
+        import random
+
+        rng = random.Random(0)
+        points = [
+            (rng.uniform(-180, 180), rng.uniform(-60, 75)) for _ in range(self.LOOKUPS)
+        ]
+
+        countries_index_cache.clear()
+        t0 = time.perf_counter()
+        location_country(*points[0])
+        cold = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        for lon, lat in points:
+            location_country(lon, lat)
+        warm = (time.perf_counter() - t0) / self.LOOKUPS
+
+        self.assertLess(warm * 100, cold)
+
+
+class _PriceAPIHandler(BaseHTTPRequestHandler):
+    """Serves blockchain.info and yadio.io like responses. Paths starting
+    with /slow are delayed and paths starting with /fail return a 500."""
+
+    delay = 0.3
+    hits = {}
+
+    def do_GET(self):
+        _PriceAPIHandler.hits[self.path] = _PriceAPIHandler.hits.get(self.path, 0) + 1
+        if self.path.startswith("/slow"):
+            time.sleep(self.delay)
+        if self.path.startswith("/fail"):
+            self.send_response(500)
+            self.end_headers()
+            self.wfile.write(b"Internal Server Error")
+            return
+
+        if "blockchain.info" in self.path:
+            body = {"USD": {"last": 10001}, "EUR": {"last": 9001}}
+        else:
+            body = {"BTC": {"USD": 10000, "EUR": 9000}}
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@patch("api.utils.USE_TOR", False)
+@patch("api.utils.MARKET_PRICE_TIMEOUT", 1)
+class TestGetExchangeRatesStubServers(TestCase):
+    """get_exchange_rates against local HTTP servers standing in for the price APIs"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _PriceAPIHandler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        _PriceAPIHandler.hits = {}
+        _PriceAPIHandler.delay = 0.3
+
+    def _get_exchange_rates(self, paths, currencies=("USD", "EUR")):
+        apis = [f"{self.url}{path}" for path in paths]
+        for api_url in apis:
+            cache.delete(f"market_price_api_health:{api_url}")
+        market_cache.clear()
+        with patch("api.utils.config", return_value=apis):
+            t0 = time.perf_counter()
+            rates = get_exchange_rates(list(currencies))
+            return rates, time.perf_counter() - t0
+
+    def test_apis_are_fetched_concurrently(self):
+        rates, elapsed = self._get_exchange_rates(
+            ["/slow/blockchain.info/ticker", "/slow/yadio.io/exrates/BTC"]
+        )
+
+        self.assertEqual(rates, [10000.5, 9000.5])
+        # Sequentially this would take at least 2 * 0.3 seconds
+        self.assertLess(elapsed, 0.55)
+
+    def test_slow_api_times_out(self):
+        _PriceAPIHandler.delay = 3
+        slow_api = f"{self.url}/slow/blockchain.info/ticker"
+
+        rates, elapsed = self._get_exchange_rates(
+            ["/slow/blockchain.info/ticker", "/yadio.io/exrates/BTC"]
+        )
+
+        self.assertEqual(rates, [10000, 9000])
+        self.assertLess(elapsed, 2.5)
+        health = market_price_api_health(slow_api)
+        self.assertEqual(health["errors"], 1)
+        self.assertEqual(health["consecutive_failures"], 1)
+
+    def test_failing_api_is_excluded(self):
+        failing_api = f"{self.url}/fail/blockchain.info/ticker"
+        healthy_api = f"{self.url}/yadio.io/exrates/BTC"
+        for api_url in (failing_api, healthy_api):
+            cache.delete(f"market_price_api_health:{api_url}")
+
+        with patch("api.utils.config", return_value=[failing_api, healthy_api]):
+            for _ in range(MARKET_PRICE_MAX_FAILURES + 2):
+                market_cache.clear()
+                rates = get_exchange_rates(["USD", "EUR"])
+                self.assertEqual(rates, [10000, 9000])
+
+        # Once excluded, the failing API is not requested anymore
+        self.assertEqual(
+            _PriceAPIHandler.hits["/fail/blockchain.info/ticker"],
+            MARKET_PRICE_MAX_FAILURES,
+        )
+        self.assertEqual(
+            _PriceAPIHandler.hits["/yadio.io/exrates/BTC"],
+            MARKET_PRICE_MAX_FAILURES + 2,
+        )
+        failing = market_price_api_health(failing_api)
+        self.assertGreater(failing["excluded_until"], time.time())
+        healthy = market_price_api_health(healthy_api)
+        self.assertEqual(healthy["errors"], 0)
+        self.assertIsNotNone(healthy["latency"])
+
+
+class _BitcoindRPCHandler(BaseHTTPRequestHandler):
+    """Serves bitcoind like JSON-RPC responses, single and batched, over
+    keep-alive connections. Records the client port of every request."""
+
+    protocol_version = "HTTP/1.1"
+    delay = 0.3
+    clients = []
+
+    def call(self, request):
+        method, params = request["method"], request["params"]
+        if method == "validateaddress":
+            result = {"isvalid": params[0].startswith("bcrt1")}
+        elif method == "getblockcount":
+            result = 100
+        elif method == "slow":
+            time.sleep(self.delay)
+            result = None
+        else:
+            return {
+                "jsonrpc": "2.0",
+                "id": request["id"],
+                "result": None,
+                "error": {"code": -32601, "message": "Method not found"},
+            }
+        return {"jsonrpc": "2.0", "id": request["id"], "result": result, "error": None}
+
+    def do_POST(self):
+        _BitcoindRPCHandler.clients.append(self.client_address[1])
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if self.headers.get("Authorization") is None:
+            self.send_response(401)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if isinstance(body, list):
+            response = [self.call(request) for request in body]
+        else:
+            response = self.call(body)
+        payload = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@patch("api.utils.BITCOIND_RPCUSER", "robodev")
+@patch("api.utils.BITCOIND_RPCPASSWORD", "robodev")
+@patch("api.utils.BITCOIND_RPC_TIMEOUT", 1)
+class TestBitcoindRPCStubServer(TestCase):
+    """bitcoind_rpc and bitcoind_rpc_batch against a local stub RPC server"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), _BitcoindRPCHandler)
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        _BitcoindRPCHandler.clients = []
+        _BitcoindRPCHandler.delay = 0.3
+        get_bitcoind_session.cache_clear()
+        patcher = patch("api.utils.BITCOIND_RPCURL", self.url)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(get_bitcoind_session.cache_clear)
+
+    def test_rpc(self):
+        self.assertEqual(bitcoind_rpc("getblockcount"), 100)
+        with self.assertRaises(BitcoindRPCError) as error:
+            bitcoind_rpc("unknown")
+        self.assertEqual(error.exception.code, -32601)
+
+    def test_connections_are_reused(self):
+        for _ in range(5):
+            bitcoind_rpc("getblockcount")
+
+        self.assertEqual(len(_BitcoindRPCHandler.clients), 5)
+        self.assertEqual(len(set(_BitcoindRPCHandler.clients)), 1)
+
+    def test_batch(self):
+        results = bitcoind_rpc_batch(
+            [
+                ("getblockcount", None),
+                ("unknown", []),
+                ("validateaddress", ["bcrt1qvalid"]),
+            ]
+        )
+
+        # A single round trip
+        self.assertEqual(len(_BitcoindRPCHandler.clients), 1)
+        self.assertEqual(results[0], 100)
+        self.assertIsInstance(results[1], BitcoindRPCError)
+        self.assertEqual(results[2], {"isvalid": True})
+        self.assertEqual(bitcoind_rpc_batch([]), [])
+
+    def test_validate_onchain_addresses(self):
+        results = validate_onchain_addresses(["bcrt1qvalid", "invalid"])
+
+        self.assertEqual(len(_BitcoindRPCHandler.clients), 1)
+        self.assertEqual(results[0], (True, None))
+        self.assertEqual(results[1], (False, {"bad_address": "Invalid address"}))
+        self.assertEqual(validate_onchain_address("bcrt1qvalid"), (True, None))
+
+    def test_timeout(self):
+        _BitcoindRPCHandler.delay = 2
+
+        t0 = time.perf_counter()
+        with self.assertRaises(requests.exceptions.Timeout):
+            bitcoind_rpc("slow")
+        self.assertLess(time.perf_counter() - t0, 1.5)
+
+
+class TestMiningFeeRates(TestCase):
+    """Mining fee rates are cached for every worker and served stale-while-revalidate"""
+
+    def setUp(self):
+        cache.delete_many([MINING_FEE_RATES_KEY, f"{MINING_FEE_RATES_KEY}:refreshing"])
+        self.addCleanup(
+            cache.delete_many,
+            [MINING_FEE_RATES_KEY, f"{MINING_FEE_RATES_KEY}:refreshing"],
+        )
+
+    @patch("api.utils.fetch_mining_fee_rates")
+    def test_fetched_once_when_cold(self, mock_fetch):
+        mock_fetch.side_effect = lambda: {"suggested": 20, "minimum": 3}
+
+        self.assertEqual(get_minning_fee("suggested"), 20)
+        self.assertEqual(get_minning_fee("minimum"), 3)
+        mock_fetch.assert_called_once()
+
+    @patch("api.utils.fetch_mining_fee_rates")
+    def test_cold_fetch_keeps_the_refresh_lock(self, mock_fetch):
+        mock_fetch.side_effect = lambda: {"suggested": 20, "minimum": 3}
+        # Held by a background refresh
+        cache.set(f"{MINING_FEE_RATES_KEY}:refreshing", 1)
+
+        self.assertEqual(get_minning_fee("suggested"), 20)
+        self.assertEqual(cache.get(f"{MINING_FEE_RATES_KEY}:refreshing"), 1)
+
+    @patch("api.tasks.cache_mining_fee_rates.delay")
+    @patch("api.utils.fetch_mining_fee_rates")
+    def test_stale_rates_are_served_while_refreshed(self, mock_fetch, mock_delay):
+        cache.set(
+            MINING_FEE_RATES_KEY,
+            {"suggested": 20, "minimum": 3, "fetched_at": time.time() - 600},
+        )
+
+        self.assertEqual(get_minning_fee("suggested"), 20)
+        self.assertEqual(get_minning_fee("suggested"), 20)
+
+        # A single background refresh, nothing fetched on the request path
+        mock_delay.assert_called_once_with(release_lock=True)
+        mock_fetch.assert_not_called()
+
+    @patch("api.utils.USE_TOR", False)
+    @patch("api.lightning.node.LNNode.estimate_fee")
+    @patch("api.utils.get_session")
+    def test_node_fallback(self, mock_get_session, mock_estimate_fee):
+        mock_get_session.return_value.get.side_effect = Exception("Tor is down")
+        mock_estimate_fee.side_effect = lambda amount_sats, target_conf: {
+            "mining_fee_rate": 100 / target_conf
+        }
+
+        suggested_target = config("SUGGESTED_TARGET_CONF", cast=int, default=2)
+        minimum_target = config("MINIMUM_TARGET_CONF", cast=int, default=24)
+        self.assertEqual(get_minning_fee("minimum"), 100 / minimum_target)
+        self.assertEqual(get_minning_fee("suggested"), 100 / suggested_target)
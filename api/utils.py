@@ -1,8 +1,12 @@
 import json
 import logging
 import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
 from datetime import timezone as datetime_timezone
+from functools import lru_cache
 
 import gnupg
 import numpy as np
@@ -10,7 +14,9 @@ import requests
 import ring
 from base91 import decode, encode
 from decouple import config
+from django.db import transaction
 from django.utils import timezone
+from requests.adapters import HTTPAdapter
 
 from api.errors import new_error
 from api.models import Robot
@@ -22,7 +28,7 @@ USE_TOR = config("USE_TOR", cast=bool, default=True)
 LNVENDOR = config("LNVENDOR", cast=str, default="LND")
 
 
-def get_session():
+def get_session(pool_maxsize=None):
     session = requests.session()
     # Tor uses the 9050 port as the default socks port
     if USE_TOR:
@@ -30,30 +36,105 @@ def get_session():
             "http": "socks5h://" + TOR_PROXY,
             "https": "socks5h://" + TOR_PROXY,
         }
+    # Keeps up to pool_maxsize connections alive per host, for concurrent use
+    if pool_maxsize is not None:
+        adapter = HTTPAdapter(pool_maxsize=pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
     return session
 
 
+BITCOIND_RPCURL = config("BITCOIND_RPCURL", default=None)
+BITCOIND_RPCUSER = config("BITCOIND_RPCUSER", default=None)
+BITCOIND_RPCPASSWORD = config("BITCOIND_RPCPASSWORD", default=None)
+BITCOIND_RPC_TIMEOUT = config("BITCOIND_RPC_TIMEOUT", cast=float, default=10)
+BITCOIND_RPC_POOL_SIZE = config("BITCOIND_RPC_POOL_SIZE", cast=int, default=10)
+
+
+class BitcoindRPCError(Exception):
+    """Error returned by bitcoin core daemon for a RPC call"""
+
+    def __init__(self, error):
+        self.code = error.get("code")
+        self.message = error.get("message")
+        super().__init__(f"bitcoind RPC error {self.code}: {self.message}")
+
+
+@lru_cache(maxsize=1)
+def get_bitcoind_session():
+    """
+    Session shared by every RPC call to bitcoin core daemon, so connections
+    are kept alive and pooled instead of opened for every call.
+    """
+    session = requests.Session()
+    session.auth = (BITCOIND_RPCUSER, BITCOIND_RPCPASSWORD)
+    session.headers["Content-Type"] = "application/json"
+    adapter = HTTPAdapter(pool_maxsize=BITCOIND_RPC_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def bitcoind_post(payload):
+    """POSTs a JSON-RPC request (or batch) to bitcoin core daemon"""
+    response = get_bitcoind_session().post(
+        BITCOIND_RPCURL, data=json.dumps(payload), timeout=BITCOIND_RPC_TIMEOUT
+    )
+    # bitcoind answers failed calls with an error status and a JSON-RPC error
+    try:
+        return response.json()
+    except ValueError:
+        response.raise_for_status()
+        raise
+
+
 def bitcoind_rpc(method, params=None):
     """
     Makes a RPC call to bitcoin core daemon
     :param method: RPC method to call
     :param params: list of params required by the calling RPC method
-    :return:
+    :return: result of the call, raises BitcoindRPCError if it failed
     """
-
-    BITCOIND_RPCURL = config("BITCOIND_RPCURL")
-    BITCOIND_RPCUSER = config("BITCOIND_RPCUSER")
-    BITCOIND_RPCPASSWORD = config("BITCOIND_RPCPASSWORD")
-
     if params is None:
         params = []
 
-    payload = json.dumps(
+    response = bitcoind_post(
         {"jsonrpc": "2.0", "id": "robosats", "method": method, "params": params}
     )
-    return requests.post(
-        BITCOIND_RPCURL, auth=(BITCOIND_RPCUSER, BITCOIND_RPCPASSWORD), data=payload
-    ).json()["result"]
+    if response.get("error"):
+        raise BitcoindRPCError(response["error"])
+    return response["result"]
+
+
+def bitcoind_rpc_batch(calls):
+    """
+    Makes several RPC calls to bitcoin core daemon in a single round trip
+    (JSON-RPC batch).
+    :param calls: list of (method, params) tuples
+    :return: list with the result of each call, in the same order. Failed
+    calls have a BitcoindRPCError in place of their result.
+    """
+    if not calls:
+        return []
+
+    payload = [
+        {"jsonrpc": "2.0", "id": id, "method": method, "params": params or []}
+        for id, (method, params) in enumerate(calls)
+    ]
+    response = bitcoind_post(payload)
+    if isinstance(response, dict):
+        # The whole batch was rejected
+        raise BitcoindRPCError(response.get("error") or {})
+
+    responses = {item["id"]: item for item in response}
+    results = []
+    for id in range(len(calls)):
+        item = responses.get(id, {"error": {"message": "Missing from batch response"}})
+        if item.get("error"):
+            results.append(BitcoindRPCError(item["error"]))
+        else:
+            results.append(item["result"])
+    return results
 
 
 def validate_onchain_address(address):
@@ -74,13 +155,51 @@ def validate_onchain_address(address):
     return True, None
 
 
-mining_fee = {}
+def validate_onchain_addresses(addresses):
+    """
+    Validates many onchain addresses with a single batch call.
+    Returns a list of (valid, context), like validate_onchain_address
+    """
+    unavailable = (
+        False,
+        {"bad_address": "Unable to validate address, check bitcoind backend"},
+    )
+
+    try:
+        validations = bitcoind_rpc_batch(
+            [("validateaddress", [address]) for address in addresses]
+        )
+    except Exception as e:
+        logger.error(e)
+        return [unavailable for _ in addresses]
+
+    results = []
+    for validation in validations:
+        if isinstance(validation, BitcoindRPCError):
+            logger.error(validation)
+            results.append(unavailable)
+        elif not validation["isvalid"]:
+            results.append((False, {"bad_address": "Invalid address"}))
+        else:
+            results.append((True, None))
+    return results
 
 
-@ring.dict(mining_fee, expire=60)  # keeps in cache for 60 seconds
-def get_minning_fee(priority: str, preliminary_amount: int) -> int:
+MINING_FEE_RATES_KEY = "mining_fee_rates"
+# Rates older than MINING_FEE_MAX_AGE are served while they are refreshed in the
+# background, rates older than MINING_FEE_MAX_STALE are not served at all.
+# MINING_FEE_MAX_AGE outlasts the 60s beat refresh, so readers right after a
+# beat tick do not schedule a second refresh.
+MINING_FEE_MAX_AGE = config("MINING_FEE_MAX_AGE", cast=int, default=90)
+MINING_FEE_MAX_STALE = config("MINING_FEE_MAX_STALE", cast=int, default=3600)
+MINING_FEE_TIMEOUT = config("MINING_FEE_TIMEOUT", cast=float, default=10)
+# Amount of the dummy payout used to estimate fee rates with the LN node
+# (small, so the onchain wallet can always fund it)
+MINING_FEE_ESTIMATE_SATS = 20_000
+
+
+def fetch_mining_fee_rates():
     """
-    priority: (str) 'suggested' | 'minimum'
     Fetches suggested and minimum mining fee rates from mempool.space
     uses LND/CLN fee estimator as fallback.
 
@@ -102,35 +221,85 @@ def get_minning_fee(priority: str, preliminary_amount: int) -> int:
     api_path = "/api/v1/fees/recommended"
 
     try:
-        response = session.get(mempool_url + api_path)
+        response = session.get(mempool_url + api_path, timeout=MINING_FEE_TIMEOUT)
         response.raise_for_status()  # Raises stored HTTPError, if one occurred
         data = response.json()
-
-        if priority == "suggested":
-            value = data.get("fastestFee")
-        elif priority == "minimum":
-            value = data.get("economyFee")
-        else:
-            raise Exception(
-                "an error occurred",
-                "unexpected value for mining fee priority",
-                priority,
-            )
+        return {"suggested": data["fastestFee"], "minimum": data["economyFee"]}
 
     except Exception as e:
-        print(e)
-        # Fetch mining fee from LND/CLN instance
-        if priority == "suggested":
-            target_conf = config("SUGGESTED_TARGET_CONF", cast=int, default=2)
-        if priority == "minimum":
-            target_conf = config("MINIMUM_TARGET_CONF", cast=int, default=24)
-
-        value = LNNode.estimate_fee(
-            amount_sats=preliminary_amount,
+        logger.warning(f"Could not fetch mining fee rates from mempool.space: {e}")
+
+    # Fetch mining fee from LND/CLN instance
+    return {
+        priority: LNNode.estimate_fee(
+            amount_sats=MINING_FEE_ESTIMATE_SATS,
             target_conf=target_conf,
         )["mining_fee_rate"]
+        for priority, target_conf in (
+            ("suggested", config("SUGGESTED_TARGET_CONF", cast=int, default=2)),
+            ("minimum", config("MINIMUM_TARGET_CONF", cast=int, default=24)),
+        )
+    }
 
-    return value
+
+def refresh_mining_fee_rates(release_lock=False):
+    """
+    Fetches the mining fee rates and caches them for every worker.
+    release_lock is set by the refresh that get_mining_fee_rates scheduled,
+    which holds the refreshing lock.
+    """
+    from django.core.cache import cache
+
+    try:
+        rates = fetch_mining_fee_rates()
+        rates["fetched_at"] = time.time()
+        cache.set(MINING_FEE_RATES_KEY, rates, timeout=MINING_FEE_MAX_STALE)
+        return rates
+    finally:
+        if release_lock:
+            cache.delete(f"{MINING_FEE_RATES_KEY}:refreshing")
+
+
+def get_mining_fee_rates():
+    """
+    Cached mining fee rates, stale-while-revalidate: once older than
+    MINING_FEE_MAX_AGE they are still served, while a single background
+    task refreshes them. They are only fetched on the spot if there are none.
+    """
+    from django.core.cache import cache
+
+    rates = cache.get(MINING_FEE_RATES_KEY)
+    if rates is None:
+        return refresh_mining_fee_rates()
+
+    is_stale = time.time() - rates["fetched_at"] > MINING_FEE_MAX_AGE
+    if is_stale and cache.add(
+        f"{MINING_FEE_RATES_KEY}:refreshing", 1, timeout=MINING_FEE_TIMEOUT * 3
+    ):
+        from api.tasks import cache_mining_fee_rates
+
+        try:
+            cache_mining_fee_rates.delay(release_lock=True)
+        except Exception as e:
+            cache.delete(f"{MINING_FEE_RATES_KEY}:refreshing")
+            logger.error(f"Could not schedule a refresh of the mining fee rates: {e}")
+
+    return rates
+
+
+def get_minning_fee(priority: str) -> float:
+    """
+    priority: (str) 'suggested' | 'minimum'
+    Current mining fee rate in Sats/vbyte, from the cached rates.
+    """
+    if priority not in ("suggested", "minimum"):
+        raise Exception(
+            "an error occurred",
+            "unexpected value for mining fee priority",
+            priority,
+        )
+
+    return get_mining_fee_rates()[priority]
 
 
 devfund_pubkey = {}
@@ -162,6 +331,146 @@ def get_devfund_pubkey(network: str) -> str:
     return value
 
 
+MARKET_PRICE_TIMEOUT = config("MARKET_PRICE_TIMEOUT", cast=float, default=10)
+MARKET_PRICE_DEADLINE = config("MARKET_PRICE_DEADLINE", cast=float, default=30)
+MARKET_PRICE_MAX_FAILURES = config("MARKET_PRICE_MAX_FAILURES", cast=int, default=3)
+MARKET_PRICE_EXCLUSION_SECONDS = config(
+    "MARKET_PRICE_EXCLUSION_SECONDS", cast=int, default=300
+)
+
+CRIPTOYA_SUPPORTED_CURRENCIES = ["ARS", "COP", "MXN", "BRL", "PEN", "CLP", "USD", "VES"]
+
+
+def blockchain_rates(session, api_url, currencies):
+    blockchain_prices = session.get(api_url, timeout=MARKET_PRICE_TIMEOUT).json()
+    blockchain_rates = []
+    for currency in currencies:
+        # Do not include ARS from Blockchain.info . This pricing is estimated wrongly.
+        if currency == "ARS":
+            blockchain_rates.append(np.nan)
+        else:
+            try:  # If a currency is missing place a None
+                blockchain_rates.append(float(blockchain_prices[currency]["last"]))
+            except Exception:
+                blockchain_rates.append(np.nan)
+    return blockchain_rates
+
+
+def yadio_rates(session, api_url, currencies):
+    yadio_prices = session.get(api_url, timeout=MARKET_PRICE_TIMEOUT).json()
+    yadio_rates = []
+    for currency in currencies:
+        try:
+            yadio_rates.append(float(yadio_prices["BTC"][currency]))
+        except Exception:
+            yadio_rates.append(np.nan)
+    return yadio_rates
+
+
+def bitpay_rates(session, api_url, currencies):
+    headers = {
+        "X-Accept-Version": "2.0.0",
+        "Content-type": "application/json",
+    }
+    bitpay_prices = session.get(
+        api_url, headers=headers, timeout=MARKET_PRICE_TIMEOUT
+    ).json()
+    bitpay_prices = {item["code"]: item["rate"] for item in bitpay_prices["data"]}
+    bitpay_rates = []
+    for currency in currencies:
+        try:
+            bitpay_rates.append(float(bitpay_prices[currency]))
+        except Exception:
+            bitpay_rates.append(np.nan)
+    return bitpay_rates
+
+
+def criptoya_rates(session, api_url, currencies):
+    def currency_rate(currency):
+        if currency not in CRIPTOYA_SUPPORTED_CURRENCIES:
+            return np.nan
+        criptoya_exchanges = session.get(
+            f"{api_url}/{currency}", timeout=MARKET_PRICE_TIMEOUT
+        ).json()
+        exchange_medians = [
+            np.median([exchange["ask"], exchange["ask"]])
+            for exchange in criptoya_exchanges.values()
+            if exchange["ask"] > 0 and exchange["bid"] > 0
+        ]
+        return round(np.median(exchange_medians), 2)
+
+    # criptoya has one endpoint per currency, these are fetched concurrently too
+    with ThreadPoolExecutor(max_workers=len(CRIPTOYA_SUPPORTED_CURRENCIES)) as pool:
+        return list(pool.map(currency_rate, currencies))
+
+
+def market_price_source(api_url):
+    """Returns the rates fetcher of a MARKET_PRICE_APIS url, None if unsupported"""
+    if "blockchain.info" in api_url:
+        return blockchain_rates
+    elif "yadio.io" in api_url:
+        return yadio_rates
+    # Tor proxied requests to bitpay.com will fail. Skip if USE_TOR is enabled.
+    elif "bitpay.com" in api_url and not USE_TOR:
+        return bitpay_rates
+    # Tor proxied requests to criptoya.com will fail. Skip if USE_TOR is enabled.
+    elif "criptoya.com" in api_url and not USE_TOR:
+        return criptoya_rates
+    return None
+
+
+def market_price_api_health(api_url):
+    """Latency and error stats of a market price API, shared by all workers"""
+    from django.core.cache import cache
+
+    return cache.get(
+        f"market_price_api_health:{api_url}",
+        {
+            "requests": 0,
+            "errors": 0,
+            "consecutive_failures": 0,
+            "latency": None,
+            "last_error": None,
+            "excluded_until": 0,
+        },
+    )
+
+
+def record_market_price_api(api_url, latency, error=None):
+    """
+    Updates the health stats of a market price API. After MARKET_PRICE_MAX_FAILURES
+    consecutive failures the API is excluded for MARKET_PRICE_EXCLUSION_SECONDS,
+    doubling with every further failure (up to one day).
+    """
+    from django.core.cache import cache
+
+    health = market_price_api_health(api_url)
+    health["requests"] += 1
+    if error is None:
+        health["consecutive_failures"] = 0
+        health["excluded_until"] = 0
+        # Exponentially weighted moving average of the latency
+        if health["latency"] is None:
+            health["latency"] = latency
+        else:
+            health["latency"] = round(0.8 * health["latency"] + 0.2 * latency, 3)
+    else:
+        health["errors"] += 1
+        health["consecutive_failures"] += 1
+        health["last_error"] = error
+        excess_failures = health["consecutive_failures"] - MARKET_PRICE_MAX_FAILURES
+        if excess_failures >= 0:
+            exclusion = min(MARKET_PRICE_EXCLUSION_SECONDS * 2**excess_failures, 86400)
+            health["excluded_until"] = time.time() + exclusion
+            logger.warning(
+                f"Excluding market price API {api_url} for {exclusion} seconds after "
+                f"{health['consecutive_failures']} consecutive failures: {error}"
+            )
+
+    cache.set(f"market_price_api_health:{api_url}", health, timeout=None)
+    return health
+
+
 market_cache = {}
 
 
@@ -169,90 +478,69 @@ market_cache = {}
 def get_exchange_rates(currencies):
     """
     Params: list of currency codes.
-    Checks for exchange rates in several public APIs.
+    Checks for exchange rates in several public APIs concurrently.
     Returns the median price list.
     """
 
-    session = get_session()
-
     APIS = config("MARKET_PRICE_APIS", cast=lambda v: [s.strip() for s in v.split(",")])
+    sources = {
+        api_url: market_price_source(api_url)
+        for api_url in APIS
+        if market_price_source(api_url) is not None
+    }
+    if not sources:
+        return None
+
+    # Skip temporarily excluded APIs, unless all of them are excluded
+    now = time.time()
+    healthy = {
+        api_url: fetcher
+        for api_url, fetcher in sources.items()
+        if market_price_api_health(api_url)["excluded_until"] <= now
+    }
+    sources = healthy or sources
+
+    # One session (connection pool) for all APIs
+    session = get_session()
+    adapter = HTTPAdapter(
+        pool_connections=len(sources),
+        pool_maxsize=len(CRIPTOYA_SUPPORTED_CURRENCIES),
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    def fetch(api_url, fetcher):
+        start = time.perf_counter()
+        rates = fetcher(session, api_url, currencies)
+        return rates, time.perf_counter() - start
+
+    pool = ThreadPoolExecutor(max_workers=len(sources))
+    futures = {
+        pool.submit(fetch, api_url, fetcher): api_url
+        for api_url, fetcher in sources.items()
+    }
+    # No API can hold the refresh for longer than MARKET_PRICE_DEADLINE
+    _, not_done = wait(futures, timeout=MARKET_PRICE_DEADLINE)
+    pool.shutdown(wait=False, cancel_futures=True)
 
     api_rates = []
-    for api_url in APIS:
+    for future, api_url in futures.items():
+        if future in not_done:
+            record_market_price_api(
+                api_url, MARKET_PRICE_DEADLINE, error="Deadline exceeded"
+            )
+            logger.error(
+                f"Could not fetch BTC prices from {api_url}: deadline exceeded"
+            )
+            continue
         try:  # If one API is unavailable pass
-            if "blockchain.info" in api_url:
-                blockchain_prices = session.get(api_url).json()
-                blockchain_rates = []
-                for currency in currencies:
-                    # Do not include ARS from Blockchain.info . This pricing is estimated wrongly.
-                    if currency == "ARS":
-                        blockchain_rates.append(np.nan)
-                    else:
-                        try:  # If a currency is missing place a None
-                            blockchain_rates.append(
-                                float(blockchain_prices[currency]["last"])
-                            )
-                        except Exception:
-                            blockchain_rates.append(np.nan)
-                api_rates.append(blockchain_rates)
-
-            elif "yadio.io" in api_url:
-                yadio_prices = session.get(api_url).json()
-                yadio_rates = []
-                for currency in currencies:
-                    try:
-                        yadio_rates.append(float(yadio_prices["BTC"][currency]))
-                    except Exception:
-                        yadio_rates.append(np.nan)
-                api_rates.append(yadio_rates)
-
-            # Tor proxied requests to bitpay.com will fail. Skip if USE_TOR is enabled.
-            elif "bitpay.com" in api_url and not USE_TOR:
-                headers = {
-                    "X-Accept-Version": "2.0.0",
-                    "Content-type": "application/json",
-                }
-                bitpay_prices = session.get(api_url, headers=headers).json()
-                bitpay_prices = {
-                    item["code"]: item["rate"] for item in bitpay_prices["data"]
-                }
-                bitpay_rates = []
-                for currency in currencies:
-                    try:
-                        bitpay_rates.append(float(bitpay_prices[currency]))
-                    except Exception:
-                        bitpay_rates.append(np.nan)
-                api_rates.append(bitpay_rates)
-
-            # Tor proxied requests to criptoya.com will fail. Skip if USE_TOR is enabled.
-            elif "criptoya.com" in api_url and not USE_TOR:
-                criptoya_supported_currencies = [
-                    "ARS",
-                    "COP",
-                    "MXN",
-                    "BRL",
-                    "PEN",
-                    "CLP",
-                    "USD",
-                    "VES",
-                ]
-                criptoya_rates = []
-                for currency in currencies:
-                    if currency in criptoya_supported_currencies:
-                        criptoya_exchanges = session.get(f"{api_url}/{currency}").json()
-                        exchange_medians = [
-                            np.median([exchange["ask"], exchange["ask"]])
-                            for exchange in criptoya_exchanges.values()
-                            if exchange["ask"] > 0 and exchange["bid"] > 0
-                        ]
-                        criptoya_rates.append(round(np.median(exchange_medians), 2))
-                    else:
-                        criptoya_rates.append(np.nan)
-                api_rates.append(criptoya_rates)
-
+            rates, latency = future.result()
         except Exception as e:
-            print(f"Could not fetch BTC prices from {api_url}: {str(e)}")
-            pass
+            record_market_price_api(api_url, None, error=str(e))
+            logger.error(f"Could not fetch BTC prices from {api_url}: {str(e)}")
+            continue
+        record_market_price_api(api_url, latency)
+        api_rates.append(rates)
 
     if len(api_rates) == 0:
         return None  # Wops there is not API available!
@@ -339,25 +627,10 @@ def weighted_median(values, sample_weight=None, quantiles=0.5, values_sorted=Fal
 
 
 def compute_avg_premium(queryset):
-    premiums = []
-    volumes = []
+    """Volume weighted median premium and total volume of the FIAT ticks of a queryset"""
+    from api.analytics import Ticks
 
-    # We exclude BTC, as LN <-> BTC swap premiums should not be  mixed with FIAT.
-
-    for tick in queryset.exclude(currency=1000):
-        premiums.append(float(tick.premium))
-        volumes.append(float(tick.volume))
-
-    total_volume = sum(volumes)
-
-    # weighted_median_premium is the weighted median of the premiums by volume
-    if len(premiums) > 0 and len(volumes) > 0:
-        weighted_median_premium = weighted_median(
-            values=premiums, sample_weight=volumes, quantiles=0.5, values_sorted=False
-        )
-    else:
-        weighted_median_premium = 0.0
-    return weighted_median_premium, total_volume
+    return Ticks.load(queryset).avg_premium()
 
 
 _ARMOR_BODY_LINE = re.compile(r"^[A-Za-z0-9+/]+={0,2}$")
@@ -515,6 +788,70 @@ def verify_signed_message(pub_key, signed_message):
         return False, None
 
 
+def delete_gpg_keys(armored_keys, secret=False):
+    """
+    Deletes from the keyring the keys in a batch of armored keys, with a
+    handful of gpg calls instead of two per key. Secret keys must be deleted
+    before their public keys. Returns the number of keys deleted.
+    """
+    armored = "\n".join(str(key) for key in armored_keys if key)
+    if not armored:
+        return 0
+
+    gpg = gnupg.GPG(gnupghome=config("GNUPG_DIR", default=None))
+
+    scanned = [key["fingerprint"] for key in gpg.scan_keys_mem(armored)]
+    if not scanned:
+        return 0
+
+    # A single missing key aborts the whole deletion, so only delete those in the keyring
+    fingerprints = sorted(
+        {key["fingerprint"] for key in gpg.list_keys(secret=secret, keys=scanned)}
+    )
+    if not fingerprints:
+        return 0
+
+    kwargs = {"secret": True, "expect_passphrase": False} if secret else {}
+    if gpg.delete_keys(fingerprints, **kwargs).status == "ok":
+        return len(fingerprints)
+
+    # Fall back to deleting key by key
+    deleted = 0
+    for fingerprint in fingerprints:
+        if gpg.delete_keys(fingerprint, **kwargs).status == "ok":
+            deleted += 1
+    return deleted
+
+
+def delete_in_chunks(queryset, chunk_size):
+    """
+    Deletes the rows of a queryset by ascending pk in chunks of chunk_size,
+    each in its own transaction, so no transaction grows with the table.
+    Returns the rows deleted per model (cascades included), the number of
+    chunks and the seconds it took.
+    """
+    started_at = time.monotonic()
+    model = queryset.model
+    deleted = Counter()
+    num_chunks = 0
+    last_pk = None
+
+    while True:
+        chunk = queryset.order_by("pk")
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        with transaction.atomic():
+            pks = list(chunk.values_list("pk", flat=True)[:chunk_size])
+            if not pks:
+                break
+            _, per_model = model.objects.filter(pk__in=pks).delete()
+        deleted.update(per_model)
+        num_chunks += 1
+        last_pk = pks[-1]
+
+    return dict(deleted), num_chunks, round(time.monotonic() - started_at, 3)
+
+
 def base91_to_hex(base91_str: str) -> str:
     bytes_data = decode(base91_str)
     return bytes_data.hex()
@@ -536,31 +873,50 @@ def is_valid_token(token: str) -> bool:
     return all(c in charset for c in token)
 
 
+countries_index_cache = {}
+
+
+@ring.dict(countries_index_cache)  # built once per process
+def get_countries_index():
+    """
+    Loads the countries GeoJSON into a spatial index of prepared geometries.
+    Returns the country codes and an STRtree over their geometries.
+    """
+    import shapely
+    from shapely.geometry import shape
+    from shapely.strtree import STRtree
+
+    with open("frontend/static/assets/geo/countries-coastline-10km.geo.json") as f:
+        countries_geojson = json.load(f)
+
+    country_codes = []
+    geometries = []
+    for feature in countries_geojson["features"]:
+        country_codes.append(feature["properties"]["A3"])
+        geometries.append(shape(feature["geometry"]))
+
+    # Prepared geometries make the containment test after the bounding box prefilter fast
+    shapely.prepare(geometries)
+
+    return country_codes, STRtree(geometries)
+
+
 def location_country(lon: float, lat: float) -> str:
     """
     Returns the country code of a lon/lat location
     """
 
-    from shapely.geometry import shape, Point
-    from shapely.prepared import prep
-
-    # Load the GeoJSON data from a local file
-    with open("frontend/static/assets/geo/countries-coastline-10km.geo.json") as f:
-        countries_geojeson = json.load(f)
+    from shapely.geometry import Point
 
-    # Prepare the countries for reverse geocoding
-    countries = {}
-    for feature in countries_geojeson["features"]:
-        geom = feature["geometry"]
-        country_code = feature["properties"]["A3"]
-        countries[country_code] = prep(shape(geom))
+    country_codes, tree = get_countries_index()
 
-    point = Point(lon, lat)
-    for country_code, geom in countries.items():
-        if geom.contains(point):
-            return country_code
+    # The tree only tests containment for countries whose bounding box has the point
+    matches = tree.query(Point(lon, lat), predicate="within")
+    if len(matches) == 0:
+        return "unknown"
 
-    return "unknown"
+    # Same result as testing the countries in file order
+    return country_codes[min(matches)]
 
 
 def objects_to_hyperlinks(logs: str) -> str:
@@ -5,7 +5,7 @@ from decouple import config
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.db.models import Q, Sum
+from django.db.models import Count, Exists, OuterRef, Q, Subquery, Sum
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from django.http import HttpResponseBadRequest
@@ -17,12 +17,15 @@ from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from api.analytics import PERIODS, Ticks, latest_ticks
+from api.book import get_book
 from api.errors import new_error
 from api.logics import Logics
 from api.tasks import cache_market
 from api.models import (
     Currency,
     LNPayment,
+    MarketStats,
     MarketTick,
     OnchainPayment,
     Order,
@@ -60,7 +63,6 @@ from api.serializers import (
     UpdateRobotSerializer,
 )
 from api.utils import (
-    compute_avg_premium,
     get_cln_version,
     get_lnd_version,
     get_robosats_commit,
@@ -74,9 +76,12 @@ EXP_MAKER_BOND_INVOICE = int(config("EXP_MAKER_BOND_INVOICE"))
 RETRY_TIME = int(config("RETRY_TIME"))
 
 # Redis response cache TTLs (seconds) for the hot public endpoints
-BOOK_CACHE_TTL = 10
 INFO_CACHE_TTL = 30
 PRICE_CACHE_TTL = 30
+TICKS_CACHE_TTL = 300
+
+# Raw ticks loaded to aggregate a ?period= request of TickView
+MAX_AGGREGATED_TICKS = 200_000
 
 
 class MakerView(CreateAPIView):
@@ -218,23 +223,41 @@ class OrderView(viewsets.ViewSet):
         if order_id is None:
             return Response(new_error(1041), status=status.HTTP_400_BAD_REQUEST)
 
-        order = Order.objects.filter(id=order_id)
+        # A single query fetches the order with its robots, hold invoices and payouts.
+        # Whether the user is pretaking the order and the last chat index are annotated.
+        take_order = TakeOrder.objects.filter(
+            order=OuterRef("pk"), taker=request.user, expires_at__gt=timezone.now()
+        )
+        last_message = Message.objects.filter(order=OuterRef("pk")).order_by("-index")
+        order = (
+            Order.objects.select_related(
+                "currency",
+                "maker__robot",
+                "taker__robot",
+                "maker_bond",
+                "taker_bond",
+                "trade_escrow",
+                "payout",
+                "payout_tx",
+            )
+            .annotate(
+                is_pretaker=Exists(take_order),
+                pretaker_amount=Subquery(take_order.values("amount")[:1]),
+                chat_last_index=Subquery(last_message.values("index")[:1]),
+            )
+            .filter(id=order_id)
+            .first()
+        )
 
-        # check if exactly one order is found in the db
-        if len(order) != 1:
+        # check if the order is found in the db
+        if order is None:
             return Response(new_error(1042), status.HTTP_404_NOT_FOUND)
 
-        # This is our order.
-        order = order[0]
-
         data = ListOrderSerializer(order).data
-        take_order = TakeOrder.objects.filter(
-            taker=request.user, order=order, expires_at__gt=timezone.now()
-        )
 
         # Add booleans if user is maker, taker, partipant, buyer or seller
         data["is_maker"] = order.maker == request.user
-        data["is_taker"] = order.taker == request.user or take_order.exists()
+        data["is_taker"] = order.taker == request.user or order.is_pretaker
         data["is_participant"] = data["is_maker"] or data["is_taker"]
         data["has_password"] = order.password is not None
 
@@ -276,10 +299,8 @@ class OrderView(viewsets.ViewSet):
         # 4) If order is between public and WF2
         if order.status >= Order.Status.PUB and order.status < Order.Status.WF2:
             data["price_now"], data["premium_now"] = Logics.price_and_premium_now(order)
-            if take_order.exists():
-                data["satoshis_now"] = Logics.satoshis_now(
-                    order, take_order.first().amount
-                )
+            if order.is_pretaker:
+                data["satoshis_now"] = Logics.satoshis_now(order, order.pretaker_amount)
             else:
                 data["satoshis_now"] = Logics.satoshis_now(order)
 
@@ -356,12 +377,12 @@ class OrderView(viewsets.ViewSet):
         # 6)  If status is 'Public' and user is PRETAKER, reply with a TAKER hold invoice.
         elif (
             order.status == Order.Status.PUB
-            and take_order.exists()
+            and order.is_pretaker
             and order.taker != request.user
         ):
             data["status"] = Order.Status.TAK
             data["total_secs_exp"] = order.t_to_expire(Order.Status.TAK)
-            data["amount"] = str(take_order.first().amount)
+            data["amount"] = str(order.pretaker_amount)
 
             valid, context = Logics.gen_taker_hold_invoice(order, request.user)
 
@@ -424,11 +445,7 @@ class OrderView(viewsets.ViewSet):
                     data["asked_for_cancel"] = False
 
             # Add index of last chat message. To be used by client on Chat endpoint to fetch latest messages
-            messages = Message.objects.filter(order=order)
-            if len(messages) == 0:
-                data["chat_last_index"] = 0
-            else:
-                data["chat_last_index"] = messages.latest().index
+            data["chat_last_index"] = order.chat_last_index or 0
 
         # 9) If status is 'DIS' and all HTLCS are in LOCKED
         elif order.status == Order.Status.DIS:
@@ -743,54 +760,17 @@ class BookView(ListAPIView):
 
     @extend_schema(**BookViewSchema.get)
     def get(self, request, format=None):
-        currency = request.GET.get("currency", 0)
-        type = request.GET.get("type", 2)
-
-        cache_key = f"book:{currency}:{type}"
-        book_data = cache.get(cache_key)
-        if book_data is None:
-            queryset = Order.objects.filter(status=Order.Status.PUB, password=None)
-
-            # Currency 0 and type 2 are special cases treated as "ANY". (These are not really possible choices)
-            if int(currency) == 0 and int(type) != 2:
-                queryset = Order.objects.filter(type=type, status=Order.Status.PUB)
-            elif int(type) == 2 and int(currency) != 0:
-                queryset = Order.objects.filter(
-                    currency=currency, status=Order.Status.PUB
-                )
-            elif not (int(currency) == 0 and int(type) == 2):
-                queryset = Order.objects.filter(
-                    currency=currency, type=type, status=Order.Status.PUB
-                )
+        currency = int(request.GET.get("currency", 0))
+        type = int(request.GET.get("type", 2))
 
-            if len(queryset) == 0:
-                return Response(
-                    {"not_found": "No orders found, be the first to make one"},
-                    status=status.HTTP_404_NOT_FOUND,
-                )
+        # Currency 0 and type 2 are special cases treated as "ANY". (These are not really possible choices)
+        book_data = get_book(currency, type)
 
-            book_data = []
-            for order in queryset:
-                data = ListOrderSerializer(order).data
-                data["maker_nick"] = str(order.maker)
-                data["maker_hash_id"] = str(order.maker.robot.hash_id)
-
-                data["satoshis_now"] = Logics.satoshis_now(order)
-                # Compute current premium for those orders that are explicitly priced.
-                price, premium = Logics.price_and_premium_now(order)
-                data["price"], data["premium"] = price, str(premium)
-                data["maker_status"] = Logics.user_activity_status(
-                    order.maker.last_login
-                )
-                for key in (
-                    "status",
-                    "taker",
-                ):  # Non participants should not see the status or who is the taker
-                    del data[key]
-
-                book_data.append(data)
-
-            cache.set(cache_key, book_data, timeout=BOOK_CACHE_TTL)
+        if len(book_data) == 0:
+            return Response(
+                {"not_found": "No orders found, be the first to make one"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
 
         return Response(book_data, status=status.HTTP_200_OK)
 
@@ -832,48 +812,33 @@ class InfoView(viewsets.ViewSet):
 
         context = {}
 
-        context["num_public_buy_orders"] = len(
-            Order.objects.filter(type=Order.Types.BUY, status=Order.Status.PUB)
-        )
-        context["num_public_sell_orders"] = len(
-            Order.objects.filter(type=Order.Types.SELL, status=Order.Status.PUB)
-        )
-        context["book_liquidity"] = Order.objects.filter(
-            status=Order.Status.PUB
-        ).aggregate(Sum("last_satoshis"))["last_satoshis__sum"]
-        context["book_liquidity"] = (
-            0 if context["book_liquidity"] is None else context["book_liquidity"]
+        book = Order.objects.filter(status=Order.Status.PUB).aggregate(
+            num_public_buy_orders=Count("id", filter=Q(type=Order.Types.BUY)),
+            num_public_sell_orders=Count("id", filter=Q(type=Order.Types.SELL)),
+            book_liquidity=Sum("last_satoshis"),
         )
+        context["num_public_buy_orders"] = book["num_public_buy_orders"]
+        context["num_public_sell_orders"] = book["num_public_sell_orders"]
+        context["book_liquidity"] = book["book_liquidity"] or 0
 
-        # Number of active users (logged in in last 30 minutes)
-        today = datetime.today()
-        context["active_robots_today"] = len(
-            User.objects.filter(last_login__day=today.day)
-        )
+        # Number of active robots (logged in in the last day)
+        last_day = timezone.now() - timedelta(days=1)
+        context["active_robots_today"] = User.objects.filter(
+            last_login__gt=last_day
+        ).count()
 
         # Compute average premium and volume of today
-        last_day = timezone.now() - timedelta(days=1)
-        queryset = MarketTick.objects.filter(timestamp__gt=last_day)
-        if not len(queryset) == 0:
-            avg_premium, total_volume = compute_avg_premium(queryset)
-        # If no contracts, fallback to lifetime avg premium
-        else:
-            queryset = MarketTick.objects.all()
-            avg_premium, _ = compute_avg_premium(queryset)
-            total_volume = 0
-
-        queryset = MarketTick.objects.all()
-        if not len(queryset) == 0:
-            volume_contracted = []
-            for tick in queryset:
-                volume_contracted.append(tick.volume if tick.volume else 0)
-            lifetime_volume = sum(volume_contracted)
-        else:
-            lifetime_volume = 0
+        avg_premium, total_volume = Ticks.load(
+            MarketTick.objects.filter(timestamp__gt=last_day)
+        ).avg_premium()
+        # If no contracts, fallback to the last known daily premium
+        market_stats = MarketStats.get()
+        if total_volume == 0:
+            avg_premium = float(market_stats.last_day_premium)
 
         context["last_day_nonkyc_btc_premium"] = round(avg_premium, 2)
         context["last_day_volume"] = round(total_volume, 8)
-        context["lifetime_volume"] = round(lifetime_volume, 8)
+        context["lifetime_volume"] = round(float(market_stats.lifetime_volume), 8)
         context["lnd_version"] = get_lnd_version()
         context["cln_version"] = get_cln_version()
         context["robosats_running_commit_hash"] = get_robosats_commit()
@@ -955,21 +920,20 @@ class PriceView(ListAPIView):
 
         payload = {}
         queryset = Currency.objects.all().order_by("currency")
+        last_ticks = latest_ticks()
 
         for currency in queryset:
             code = Currency.currency_dict[str(currency.currency)]
-            try:
-                last_tick = MarketTick.objects.filter(currency=currency).latest(
-                    "timestamp"
-                )
-                payload[code] = {
-                    "price": last_tick.price,
-                    "volume": last_tick.volume,
-                    "premium": last_tick.premium,
-                    "timestamp": last_tick.timestamp,
-                }
-            except Exception:
+            last_tick = last_ticks.get(currency.id)
+            if last_tick is None:
                 payload[code] = None
+                continue
+            payload[code] = {
+                "price": last_tick["price"],
+                "volume": last_tick["volume"],
+                "premium": last_tick["premium"],
+                "timestamp": last_tick["timestamp"],
+            }
 
         cache.set("price", payload, timeout=PRICE_CACHE_TTL)
 
@@ -1002,6 +966,23 @@ class TickView(ListAPIView):
         except ValueError:
             return Response(new_error(1050), status=status.HTTP_400_BAD_REQUEST)
 
+        # Aggregated ticks are small, but every raw tick is loaded to aggregate them
+        period = request.query_params.get("period")
+        if period is not None:
+            if period not in PERIODS:
+                return Response(new_error(1057), status=status.HTTP_400_BAD_REQUEST)
+            cache_key = f"ticks:{period}:{start_date_str}:{end_date_str}"
+            data = cache.get(cache_key)
+            if data is None:
+                if self.queryset.count() > MAX_AGGREGATED_TICKS:
+                    return Response(
+                        new_error(1058, {"max_ticks": MAX_AGGREGATED_TICKS}),
+                        status=status.HTTP_400_BAD_REQUEST,
+                    )
+                data = Ticks.load(self.queryset).periods(period)
+                cache.set(cache_key, data, timeout=TICKS_CACHE_TTL)
+            return Response(data, status=status.HTTP_200_OK)
+
         # Check if the number of ticks exceeds the limit
         if self.queryset.count() > 5000:
             return Response(new_error(1051), status=status.HTTP_400_BAD_REQUEST)
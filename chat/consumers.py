@@ -1,17 +1,44 @@
+import asyncio
 import json
 
+from asgiref.sync import sync_to_async
 from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from decouple import config
 
 from api.models import Order
 from api.tasks import send_notification
 from chat.models import ChatRoom, Message
+from chat.state import (
+    CHAT_PRESENCE_HEARTBEAT,
+    connect_user,
+    disconnect_user,
+    is_connected,
+)
+
+# Stored messages read per query when serving the chat history
+CHAT_HISTORY_BATCH = config("CHAT_HISTORY_BATCH", cast=int, default=100)
 
 
 class ChatRoomConsumer(AsyncWebsocketConsumer):
+    """
+    Relays the messages of an order chat. The order, the peer and its PGP
+    public key are loaded once on connect and presence is tracked in Redis
+    with a heartbeat per connection, so only storing a PGP message touches
+    the database.
+    """
+
     @database_sync_to_async
-    def allow_in_chatroom(self):
-        order = Order.objects.get(id=self.order_id)
+    def load_chatroom(self):
+        """Loads the state of the chat, returns whether the user is allowed in it"""
+        order = (
+            Order.objects.select_related("maker__robot", "taker__robot")
+            .filter(id=self.order_id)
+            .first()
+        )
+        if order is None:
+            print("Order does not exist")
+            return False
 
         if order.status not in [
             Order.Status.CHA,
@@ -22,165 +49,127 @@ class ChatRoomConsumer(AsyncWebsocketConsumer):
             print("Order is not in chat status")
             return False
 
-        if not (order.maker == self.user or order.taker == self.user):
+        if order.maker_id == self.user.id:
+            self.peer = order.taker
+        elif order.taker_id == self.user.id:
+            self.peer = order.maker
+        else:
             print("Not allowed in this chat")
             return False
-        return True
-
-    @database_sync_to_async
-    def save_connect_user(self):
-        """Creates or updates the ChatRoom object"""
-
-        order = Order.objects.get(id=self.order_id)
-
-        if order.maker == self.user:
-            ChatRoom.objects.update_or_create(
-                id=self.order_id,
-                order=order,
-                room_group_name=self.room_group_name,
-                defaults={
-                    "maker": self.user,
-                    "maker_connected": True,
-                    "taker": order.taker,
-                    "taker_connected": True,
-                },
-            )
-
-        elif order.taker == self.user:
-            ChatRoom.objects.update_or_create(
-                id=self.order_id,
-                order=order,
-                room_group_name=self.room_group_name,
-                defaults={
-                    "taker": self.user,
-                    "taker_connected": True,
-                    "maker": order.maker,
-                    "maker_connected": False,
-                },
-            )
 
-        return None
+        self.peer_public_key = self.peer.robot.public_key
+        self.chatroom, _ = ChatRoom.objects.get_or_create(
+            id=order.id,
+            defaults={
+                "order": order,
+                "room_group_name": self.room_group_name,
+                "maker": order.maker,
+                "taker": order.taker,
+            },
+        )
+        return True
 
     @database_sync_to_async
     def save_new_PGP_message(self, PGP_message):
         """Creates a Message object"""
 
-        order = Order.objects.get(id=self.order_id)
-        chatroom = ChatRoom.objects.get(order=order)
-
-        try:
-            last_message = Message.objects.filter(order=order).latest()
-            index = last_message.index + 1
-        except Exception:
-            index = 1
-
-        sender = self.scope["user"]
-        if order.taker == sender:
-            receiver = order.maker
-        elif order.maker == sender:
-            receiver = order.taker
-
-        msg_obj = Message.objects.create(
-            order=order,
-            chatroom=chatroom,
-            index=index,
-            sender=sender,
-            receiver=receiver,
-            PGP_message=PGP_message,
+        msg_obj = self.chatroom.add_message(
+            sender=self.user, receiver=self.peer, PGP_message=PGP_message
         )
 
         # send Telegram notification for new message (if conditions apply)
         send_notification.delay(chat_message_id=msg_obj.id, message="new_chat_message")
         return msg_obj
 
-    @database_sync_to_async
-    def save_disconnect_user(self):
-        """Creates or updates the ChatRoom object"""
-
-        order = Order.objects.get(id=self.order_id)
-        if order.maker == self.user:
-            ChatRoom.objects.update_or_create(
-                id=self.order_id, defaults={"maker_connected": False}
-            )
-        elif order.taker == self.user:
-            ChatRoom.objects.update_or_create(
-                id=self.order_id, defaults={"taker_connected": False}
-            )
-        return None
-
-    @database_sync_to_async
-    def is_peer_connected(self):
+    async def is_peer_connected(self):
         """Returns whether the consumer's peer is connected"""
-
-        chatroom = ChatRoom.objects.get(id=self.order_id)
-
-        if chatroom.maker == self.user:
-            return chatroom.taker_connected
-
-        if chatroom.taker == self.user:
-            return chatroom.maker_connected
-
-    @database_sync_to_async
-    def get_peer_PGP_public_key(self):
-        """Returns peer PGP public key"""
-
-        order = Order.objects.get(id=self.order_id)
-
-        if order.maker == self.user:
-            return order.taker.robot.public_key
-
-        if order.taker == self.user:
-            return order.maker.robot.public_key
+        return await sync_to_async(is_connected, thread_sensitive=False)(
+            self.order_id, self.peer.id
+        )
 
     @database_sync_to_async
-    def get_all_PGP_messages(self):
-        """Returns all PGP messages"""
+    def get_PGP_messages(self, after_index, limit):
+        """Returns up to limit PGP messages with an index higher than after_index"""
 
-        order = Order.objects.get(id=self.order_id)
-        messages = Message.objects.filter(order=order)
-
-        msgs = []
-        for message in messages:
-            msgs.append(
-                {
-                    "index": message.index,
-                    "time": str(message.created_at),
-                    "message": message.PGP_message,
-                    "nick": str(message.sender),
-                }
-            )
+        messages = (
+            Message.objects.filter(order_id=self.order_id, index__gt=after_index)
+            .order_by("index")
+            .values("index", "created_at", "PGP_message", "sender__username")
+        )
+        return [
+            {
+                "index": message["index"],
+                "time": str(message["created_at"]),
+                "message": message["PGP_message"],
+                "nick": message["sender__username"],
+            }
+            for message in messages[:limit]
+        ]
+
+    async def mark_present(self):
+        await sync_to_async(connect_user, thread_sensitive=False)(
+            self.order_id, self.user.id, self.channel_name
+        )
 
-        return msgs
+    async def heartbeat(self):
+        """Keeps the presence of this connection alive while it is open"""
+        while True:
+            await asyncio.sleep(CHAT_PRESENCE_HEARTBEAT)
+            try:
+                await self.mark_present()
+            except Exception as e:
+                print(f"Could not refresh chat presence: {e}")
+
+    async def serve_history(self, offset, peer_connected):
+        """
+        Sends the stored messages after offset to this connection only, in
+        batches of CHAT_HISTORY_BATCH read with a cursor on the index.
+        """
+        cursor = offset
+        while True:
+            msgs = await self.get_PGP_messages(cursor, CHAT_HISTORY_BATCH)
+            for msg in msgs:
+                await self.PGP_message({**msg, "peer_connected": peer_connected})
+            if len(msgs) < CHAT_HISTORY_BATCH:
+                return
+            cursor = msgs[-1]["index"]
 
     async def connect(self):
-        self.order_id = self.scope["url_route"]["kwargs"]["order_id"]
+        self.joined = False
+        self.order_id = int(self.scope["url_route"]["kwargs"]["order_id"])
         self.room_group_name = f"chat_order_{self.order_id}"
         self.user = self.scope["user"]
         self.user_nick = str(self.user)
 
-        allowed = await self.allow_in_chatroom()
+        allowed = await self.load_chatroom()
 
         if allowed:
-            await self.save_connect_user()
+            await self.mark_present()
+            self.joined = True
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
 
             await self.accept()
 
             # Send peer PGP public keys
-            peer_public_key = await self.get_peer_PGP_public_key()
             peer_connected = await self.is_peer_connected()
             await self.channel_layer.group_send(
                 self.room_group_name,
                 {
                     "type": "chatroom_message",
-                    "message": peer_public_key,
+                    "message": self.peer_public_key,
                     "nick": self.scope["user"].username,
                     "peer_connected": peer_connected,
                 },
             )
 
     async def disconnect(self, close_code):
-        await self.save_disconnect_user()
+        if not self.joined:
+            return
+        self.heartbeat_task.cancel()
+        await sync_to_async(disconnect_user, thread_sensitive=False)(
+            self.order_id, self.user.id, self.channel_name
+        )
         await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
         await self.channel_layer.group_send(
             self.room_group_name,
@@ -220,21 +209,11 @@ class ChatRoomConsumer(AsyncWebsocketConsumer):
 
         # Encrypted messages are served when the user requests them
         elif message[0:23] == "-----SERVE HISTORY-----":
-            # If there is any stored message, serve them.
-            msgs = await self.get_all_PGP_messages()
-            peer_connected = await self.is_peer_connected()
-            for msg in msgs:
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "PGP_message",
-                        "index": msg["index"],
-                        "time": msg["time"],
-                        "message": msg["message"],
-                        "nick": msg["nick"],
-                        "peer_connected": peer_connected,
-                    },
-                )
+            # If there is any stored message, serve them. Clients that reconnect
+            # may ask only for the messages after the last index they have.
+            await self.serve_history(
+                int(text_data_json.get("offset") or 0), peer_connected
+            )
         # Unencrypted messages are not stored, just echoed.
         else:
             await self.channel_layer.group_send(
@@ -0,0 +1,56 @@
+from django.db import migrations, models
+from django.db.models import Count, Max, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def renumber_duplicates(apps, schema_editor):
+    """Renumbers the messages of the orders that have repeated indices"""
+    Message = apps.get_model("chat", "Message")
+
+    duplicated_orders = (
+        Message.objects.filter(order__isnull=False)
+        .values("order_id", "index")
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+        .values_list("order_id", flat=True)
+        .distinct()
+    )
+    for order_id in duplicated_orders:
+        messages = list(
+            Message.objects.filter(order_id=order_id).order_by(
+                "index", "created_at", "id"
+            )
+        )
+        for index, message in enumerate(messages, start=1):
+            message.index = index
+        Message.objects.bulk_update(messages, ["index"])
+
+
+def backfill_last_index(apps, schema_editor):
+    ChatRoom = apps.get_model("chat", "ChatRoom")
+    Message = apps.get_model("chat", "Message")
+
+    last_index = (
+        Message.objects.filter(chatroom=OuterRef("pk"))
+        .values("chatroom")
+        .annotate(last_index=Max("index"))
+        .values("last_index")
+    )
+    ChatRoom.objects.update(last_index=Coalesce(Subquery(last_index), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_message_order_index_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_index',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(renumber_duplicates, migrations.RunPython.noop),
+        migrations.RunPython(backfill_last_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_chatroom_last_index'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_order_index_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('order', 'index'), name='message_order_index_unique'),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.utils import timezone
 
 from api.models import Order
@@ -49,13 +50,46 @@ class ChatRoom(models.Model):
         blank=True,
     )
 
+    # Index of the last message, the counter of Message.index
+    last_index = models.PositiveIntegerField(null=False, default=0)
+
     def __str__(self):
         return f"Chat:{str(self.id)}"
 
+    def add_message(self, sender, receiver, PGP_message):
+        """
+        Stores a new message with the next index of the room. Incrementing
+        the counter locks the room until the message is committed, so
+        concurrent messages get consecutive indices and become visible in
+        index order (clients poll for the messages after an index).
+        """
+        with transaction.atomic():
+            ChatRoom.objects.filter(id=self.id).update(last_index=F("last_index") + 1)
+            self.last_index = (
+                ChatRoom.objects.filter(id=self.id)
+                .values_list("last_index", flat=True)
+                .get()
+            )
+            return Message.objects.create(
+                order_id=self.order_id,
+                chatroom=self,
+                index=self.last_index,
+                sender=sender,
+                receiver=receiver,
+                PGP_message=PGP_message,
+            )
+
 
 class Message(models.Model):
     class Meta:
         get_latest_by = "index"
+        constraints = [
+            # Also the index of the messages of an order after an index
+            # (ChatView, ChatRoomConsumer)
+            models.UniqueConstraint(
+                fields=["order", "index"], name="message_order_index_unique"
+            ),
+        ]
 
     # id = models.PositiveBigIntegerField(primary_key=True, default=uuid.uuid4, editable=False)
     order = models.ForeignKey(
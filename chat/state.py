@@ -0,0 +1,46 @@
+import time
+
+from decouple import config
+from django_redis import get_redis_connection
+
+# A WebSocket connection counts as present for this long after its last
+# heartbeat, so connections of a crashed worker stop counting on their own
+CHAT_PRESENCE_TTL = config("CHAT_PRESENCE_TTL", cast=int, default=60)
+# Open connections refresh their presence this often
+CHAT_PRESENCE_HEARTBEAT = CHAT_PRESENCE_TTL / 3
+
+
+def presence_key(order_id):
+    return f"chat:{order_id}:connections"
+
+
+def connection_member(user_id, channel_name):
+    return f"{user_id}:{channel_name}"
+
+
+def connect_user(order_id, user_id, channel_name):
+    """Marks a WebSocket connection of a user to an order chat as present now"""
+    now = time.time()
+    key = presence_key(order_id)
+    pipe = get_redis_connection("default").pipeline()
+    pipe.zadd(key, {connection_member(user_id, channel_name): now})
+    pipe.zremrangebyscore(key, "-inf", now - CHAT_PRESENCE_TTL)
+    pipe.expire(key, CHAT_PRESENCE_TTL)
+    pipe.execute()
+
+
+def disconnect_user(order_id, user_id, channel_name):
+    get_redis_connection("default").zrem(
+        presence_key(order_id), connection_member(user_id, channel_name)
+    )
+
+
+def is_connected(order_id, user_id):
+    """Whether a user has any live WebSocket connection to an order chat"""
+    if user_id is None:
+        return False
+    connections = get_redis_connection("default").zrangebyscore(
+        presence_key(order_id), time.time() - CHAT_PRESENCE_TTL, "+inf"
+    )
+    prefix = f"{user_id}:".encode()
+    return any(connection.startswith(prefix) for connection in connections)
@@ -1,4 +1,5 @@
 from celery import shared_task
+from decouple import config
 
 
 @shared_task(name="chatrooms_cleansing")
@@ -13,8 +14,11 @@ def chatrooms_cleansing():
     from django.utils import timezone
 
     from api.models import Order
+    from api.utils import delete_in_chunks
     from chat.models import ChatRoom
 
+    chunk_size = config("CLEANSING_CHUNK", cast=int, default=1000)
+
     finished_states = [
         Order.Status.SUC,
         Order.Status.TLD,
@@ -31,19 +35,15 @@ def chatrooms_cleansing():
         status__in=finished_states, expires_at__lt=finished_time
     )
 
-    # And do not have an active trade, any past contract or any reward.
-    deleted_chatrooms = []
-    for order in queryset:
-        # Try an except. In case some chatroom is already missing.
-        try:
-            chatroom = ChatRoom.objects.get(id=order.id)
-            deleted_chatrooms.append(str(chatroom))
-            chatroom.delete()
-        except Exception:
-            pass
+    # Chatrooms share the id of their order. Messages are deleted with them.
+    deleted, num_chunks, seconds = delete_in_chunks(
+        ChatRoom.objects.filter(id__in=queryset.values("id")), chunk_size
+    )
 
     results = {
-        "num_deleted": len(deleted_chatrooms),
-        "deleted_chatrooms": deleted_chatrooms,
+        "num_deleted": deleted.get("chat.ChatRoom", 0),
+        "num_messages_deleted": deleted.get("chat.Message", 0),
+        "chunks": num_chunks,
+        "seconds": seconds,
     }
     return results
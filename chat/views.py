@@ -2,7 +2,6 @@ from datetime import timedelta
 
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
-from django.contrib.auth.models import User
 from django.utils import timezone
 from drf_spectacular.utils import OpenApiParameter, extend_schema
 from rest_framework import status, viewsets
@@ -15,6 +14,23 @@ from api.models import Order
 from api.tasks import send_notification
 from chat.models import ChatRoom, Message
 from chat.serializers import ChatSerializer, InMessageSerializer, PostMessageSerializer
+from chat.state import is_connected
+
+
+def serialize_messages(queryset):
+    """Messages of a chat with the nick of their sender, fetched in the same query"""
+    messages = []
+    for message in queryset.select_related("sender").order_by("index"):
+        d = InMessageSerializer(message).data
+        # Re-serialize so the response is identical to the consumer message
+        data = {
+            "index": d["index"],
+            "time": d["created_at"],
+            "message": d["PGP_message"],
+            "nick": message.sender.username if message.sender else None,
+        }
+        messages.append(data)
+    return messages
 
 
 class ChatView(viewsets.ViewSet):
@@ -40,6 +56,8 @@ class ChatView(viewsets.ViewSet):
     def get(self, request, format=None):
         """
         Returns chat messages for an order with an index higher than `offset`.
+        Responses carry an ETag: polling with `If-None-Match` returns 304 Not
+        Modified until there are new messages or the peer connects or leaves.
         """
 
         order_id = request.GET.get("order_id", None)
@@ -48,7 +66,9 @@ class ChatView(viewsets.ViewSet):
         if order_id is None:
             return Response(new_error(6000), status.HTTP_400_BAD_REQUEST)
 
-        order = Order.objects.get(id=order_id)
+        order = Order.objects.select_related("maker__robot", "taker__robot").get(
+            id=order_id
+        )
 
         if not (request.user == order.maker or request.user == order.taker):
             return Response(new_error(6001), status.HTTP_400_BAD_REQUEST)
@@ -74,35 +94,34 @@ class ChatView(viewsets.ViewSet):
             },
         )
 
-        # is_peer_connected() mockup. Update connection status based on last time a GET request was sent
-        if chatroom.maker == request.user:
+        # is_peer_connected() mockup. Update connection status based on last time a GET request
+        # was sent, or on an open WebSocket connection
+        connected = (chatroom.maker_connected, chatroom.taker_connected)
+        if chatroom.maker_id == request.user.id:
             chatroom.taker_connected = order.taker.last_login > (
                 timezone.now() - timedelta(minutes=1)
-            )
+            ) or is_connected(order.id, order.taker_id)
             chatroom.maker_connected = True
             peer_connected = chatroom.taker_connected
             peer_public_key = order.taker.robot.public_key
-        elif chatroom.taker == request.user:
+        elif chatroom.taker_id == request.user.id:
             chatroom.maker_connected = order.maker.last_login > (
                 timezone.now() - timedelta(minutes=1)
-            )
+            ) or is_connected(order.id, order.maker_id)
             chatroom.taker_connected = True
             peer_connected = chatroom.maker_connected
             peer_public_key = order.maker.robot.public_key
 
-        chatroom.save(update_fields=["maker_connected", "taker_connected"])
-
-        messages = []
-        for message in queryset:
-            d = InMessageSerializer(message).data
-            # Re-serialize so the response is identical to the consumer message
-            data = {
-                "index": d["index"],
-                "time": d["created_at"],
-                "message": d["PGP_message"],
-                "nick": User.objects.get(id=d["sender"]).username,
-            }
-            messages.append(data)
+        if connected != (chatroom.maker_connected, chatroom.taker_connected):
+            chatroom.save(update_fields=["maker_connected", "taker_connected"])
+
+        # Messages are committed in index order, so the last index tells
+        # whether there is anything new after the offset
+        etag = f'W/"{chatroom.last_index}-{offset}-{int(peer_connected)}"'
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+        messages = serialize_messages(queryset)
 
         response = {
             "peer_connected": peer_connected,
@@ -110,7 +129,7 @@ class ChatView(viewsets.ViewSet):
             "peer_pubkey": peer_public_key,
         }
 
-        return Response(response, status.HTTP_200_OK)
+        return Response(response, status.HTTP_200_OK, headers={"ETag": etag})
 
     @extend_schema(request=PostMessageSerializer, responses=ChatSerializer)
     def post(self, request, format=None):
@@ -155,14 +174,10 @@ class ChatView(viewsets.ViewSet):
             },
         )
 
-        last_index = Message.objects.filter(order=order, chatroom=chatroom).count()
-        new_message = Message.objects.create(
-            index=last_index + 1,
-            PGP_message=serializer.data.get("PGP_message"),
-            order=order,
-            chatroom=chatroom,
+        new_message = chatroom.add_message(
             sender=sender,
             receiver=receiver,
+            PGP_message=serializer.data.get("PGP_message"),
         )
 
         # send Telegram notification for new message (if conditions apply)
@@ -172,10 +187,14 @@ class ChatView(viewsets.ViewSet):
 
         # Send websocket message
         if chatroom.maker == request.user:
-            peer_connected = chatroom.taker_connected
+            peer_connected = chatroom.taker_connected or is_connected(
+                order.id, order.taker_id
+            )
             peer_public_key = order.taker.robot.public_key
         elif chatroom.taker == request.user:
-            peer_connected = chatroom.maker_connected
+            peer_connected = chatroom.maker_connected or is_connected(
+                order.id, order.maker_id
+            )
             peer_public_key = order.maker.robot.public_key
 
         channel_layer = get_channel_layer()
@@ -195,17 +214,7 @@ class ChatView(viewsets.ViewSet):
         offset = serializer.data.get("offset", None)
         if offset or offset == 0:
             queryset = Message.objects.filter(order=order, index__gt=offset)
-            messages = []
-            for message in queryset:
-                d = InMessageSerializer(message).data
-                # Re-serialize so the response is identical to the consumer message
-                data = {
-                    "index": d["index"],
-                    "time": d["created_at"],
-                    "message": d["PGP_message"],
-                    "nick": User.objects.get(id=d["sender"]).username,
-                }
-                messages.append(data)
+            messages = serialize_messages(queryset)
 
             response = {
                 "peer_connected": peer_connected,
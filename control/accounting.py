@@ -0,0 +1,206 @@
+from datetime import datetime, time, timedelta
+
+from decouple import config
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from api.models import LNPayment, MarketTick, OnchainPayment, Order, Robot
+from control.models import AccountingDay
+
+# Days accounted per transaction by do_accounting
+ACCOUNTING_CHUNK_DAYS = config("ACCOUNTING_CHUNK_DAYS", cast=int, default=31)
+
+ACCOUNTING_FIELDS = [
+    "contracted",
+    "num_contracts",
+    "inflow",
+    "outflow",
+    "routing_fees",
+    "mining_fees",
+    "cashflow",
+    "rewards_claimed",
+    "net_settled",
+    "net_paid",
+    "net_balance",
+    "outstanding_earned_rewards",
+    "outstanding_pending_disputes",
+    "lifetime_rewards_claimed",
+    "earned_rewards",
+    "disputes",
+]
+
+
+def day_start(day):
+    """Aware datetime of the midnight that starts a day"""
+    return timezone.make_aware(datetime.combine(day, time.min))
+
+
+def group_by_day(queryset, field, **aggregates):
+    """{day: {aggregate: value}} of a queryset grouped by the day of a datetime field"""
+    rows = (
+        queryset.annotate(day=TruncDate(field))
+        .values("day")
+        .annotate(**aggregates)
+        .order_by("day")
+    )
+    return {row.pop("day"): row for row in rows}
+
+
+def aggregate_days(first_day, last_day):
+    """
+    Sums of payments and market ticks for each day between first_day and
+    last_day (both included): one GROUP BY day query per table, with
+    conditional aggregates for every figure and the escrows of the payouts
+    summed through a join.
+    """
+    start, end = day_start(first_day), day_start(last_day + timedelta(days=1))
+
+    inflow = Q(type=LNPayment.Types.HOLD, status=LNPayment.Status.SETLED)
+    paid = Q(type=LNPayment.Types.NORM, status=LNPayment.Status.SUCCED)
+    rewards = paid & Q(concept=LNPayment.Concepts.WITHREWA)
+    payouts = paid & Q(concept=LNPayment.Concepts.PAYBUYER)
+    bonds = inflow & Q(
+        concept__in=[LNPayment.Concepts.TAKEBOND, LNPayment.Concepts.MAKEBOND]
+    )
+    ln = group_by_day(
+        LNPayment.objects.filter(created_at__gte=start, created_at__lt=end),
+        "created_at",
+        inflow=Sum("num_satoshis", filter=inflow),
+        offchain_outflow=Sum("num_satoshis", filter=paid),
+        routing_fees=Sum("fee", filter=paid),
+        rewards_claimed=Sum("num_satoshis", filter=rewards),
+        payouts_paid=Sum("num_satoshis", filter=payouts),
+        payouts_costs=Sum("fee", filter=payouts),
+        escrows_settled=Sum(
+            "order_paid_LN__trade_escrow__num_satoshis", filter=payouts
+        ),
+        bonds_settled=Sum("num_satoshis", filter=bonds),
+    )
+
+    sent = Q(status__in=[OnchainPayment.Status.MEMPO, OnchainPayment.Status.CONFI])
+    onchain = group_by_day(
+        OnchainPayment.objects.filter(created_at__gte=start, created_at__lt=end),
+        "created_at",
+        onchain_outflow=Sum("sent_satoshis", filter=sent),
+        mining_fees=Sum("mining_fee_sats", filter=sent),
+        escrows_settled=Sum("order_paid_TX__trade_escrow__num_satoshis", filter=sent),
+    )
+
+    ticks = group_by_day(
+        MarketTick.objects.filter(timestamp__gte=start, timestamp__lt=end),
+        "timestamp",
+        contracted=Sum("volume"),
+        num_contracts=Count("id"),
+    )
+
+    days = {}
+    day = first_day
+    while day <= last_day:
+        day_ln = ln.get(day, {})
+        day_onchain = onchain.get(day, {})
+        day_ticks = ticks.get(day, {})
+        days[day] = {
+            name: value or 0
+            for name, value in {
+                "contracted": day_ticks.get("contracted"),
+                "num_contracts": day_ticks.get("num_contracts"),
+                "inflow": day_ln.get("inflow"),
+                "offchain_outflow": day_ln.get("offchain_outflow"),
+                "onchain_outflow": day_onchain.get("onchain_outflow"),
+                "routing_fees": day_ln.get("routing_fees"),
+                "mining_fees": day_onchain.get("mining_fees"),
+                "rewards_claimed": day_ln.get("rewards_claimed"),
+                "escrows_settled": (day_ln.get("escrows_settled") or 0)
+                + (day_onchain.get("escrows_settled") or 0),
+                "payouts_paid": (day_ln.get("payouts_paid") or 0)
+                + (day_onchain.get("onchain_outflow") or 0),
+                "costs": (day_ln.get("payouts_costs") or 0)
+                + (day_onchain.get("mining_fees") or 0),
+                "bonds_settled": day_ln.get("bonds_settled"),
+            }.items()
+        }
+        day += timedelta(days=1)
+    return days
+
+
+def account_days(first_day, last_day):
+    """
+    Accounts every day between first_day and last_day (both included) and
+    upserts their AccountingDay in a single statement, so accounting the
+    same days again replaces them. Returns the accounted days.
+    """
+    slashed_bond_split = float(config("SLASHED_BOND_REWARD_SPLIT"))
+    today = timezone.now().date()
+
+    accounted_days = []
+    for day, sums in aggregate_days(first_day, last_day).items():
+        # Coarse accounting based on LNpayment and OnchainPayment objects
+        outflow = int(sums["offchain_outflow"]) + int(sums["onchain_outflow"])
+        accounted_day = AccountingDay(
+            day=day_start(day),
+            contracted=sums["contracted"],
+            num_contracts=sums["num_contracts"],
+            inflow=sums["inflow"],
+            outflow=outflow,
+            routing_fees=sums["routing_fees"],
+            mining_fees=sums["mining_fees"],
+            cashflow=sums["inflow"] - outflow - sums["routing_fees"],
+            rewards_claimed=sums["rewards_claimed"],
+        )
+
+        # Fine Net Daily accounting based on orders where everything worked
+        # out right, plus the share of settled bonds kept by the coordinator
+        accounted_day.net_settled = (
+            int(sums["escrows_settled"]) + sums["bonds_settled"] * slashed_bond_split
+        )
+        accounted_day.net_paid = int(sums["payouts_paid"]) + int(sums["costs"])
+        accounted_day.net_balance = float(accounted_day.net_settled) - float(
+            accounted_day.net_paid
+        )
+
+        # Differential accounting based on change of outstanding states and disputes unreslved
+        if day == today:
+            if accounted_days:
+                accounted_yesterday = accounted_days[-1]
+            else:
+                accounted_yesterday = (
+                    AccountingDay.objects.filter(day__lt=day_start(day))
+                    .order_by("-day")
+                    .first()
+                )
+            account_outstanding(accounted_day, accounted_yesterday)
+
+        accounted_days.append(accounted_day)
+
+    AccountingDay.objects.bulk_create(
+        accounted_days,
+        update_conflicts=True,
+        unique_fields=["day"],
+        update_fields=ACCOUNTING_FIELDS,
+    )
+    return accounted_days
+
+
+def account_outstanding(accounted_day, accounted_yesterday):
+    """Rewards and pending disputes outstanding today, and their change since yesterday"""
+    outstanding_pending_disputes = (
+        Order.objects.filter(status__in=[Order.Status.DIS, Order.Status.WFR]).aggregate(
+            Sum("payout__num_satoshis")
+        )["payout__num_satoshis__sum"]
+        or 0
+    )
+    rewards = Robot.objects.aggregate(Sum("earned_rewards"), Sum("claimed_rewards"))
+
+    accounted_day.outstanding_earned_rewards = rewards["earned_rewards__sum"] or 0
+    accounted_day.outstanding_pending_disputes = outstanding_pending_disputes
+    accounted_day.lifetime_rewards_claimed = rewards["claimed_rewards__sum"] or 0
+    if accounted_yesterday is not None:
+        accounted_day.earned_rewards = (
+            accounted_day.outstanding_earned_rewards
+            - accounted_yesterday.outstanding_earned_rewards
+        )
+        accounted_day.disputes = (
+            outstanding_pending_disputes
+            - accounted_yesterday.outstanding_pending_disputes
+        )
@@ -52,6 +52,10 @@ app.conf.beat_schedule = {
         "task": "cache_external_market_prices",
         "schedule": timedelta(seconds=60),
     },
+    "cache-mining-fee-rates": {  # Refresh mining fee rates every minute
+        "task": "cache_mining_fee_rates",
+        "schedule": timedelta(seconds=60),
+    },
     "compute-node-balance": {  # Logs LND channel and wallet balance
         "task": "compute_node_balance",
         "schedule": timedelta(minutes=60),
@@ -5,6 +5,7 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from decouple import config
 from django.core.asgi import get_asgi_application
 
+import api.routing
 import chat.routing
 from robosats.middleware import TokenAuthMiddleware
 
@@ -17,8 +18,7 @@ protocols = {}
 protocols["websocket"] = AuthMiddlewareStack(
     TokenAuthMiddleware(
         URLRouter(
-            chat.routing.websocket_urlpatterns,
-            # add api.routing.websocket_urlpatterns when Order page works with websocket
+            chat.routing.websocket_urlpatterns + api.routing.websocket_urlpatterns,
         )
     )
 )
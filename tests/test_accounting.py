@@ -0,0 +1,241 @@
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import skipUnless
+from unittest.mock import patch
+
+from decouple import config
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from api.models import Currency, LNPayment, MarketTick, OnchainPayment, Order
+from control.accounting import account_days, day_start
+from control.models import AccountingDay
+from control.tasks import do_accounting
+
+RUN_BENCHMARKS = config("RUN_BENCHMARKS", default=False, cast=bool)
+
+
+def lnpayment(payment_hash, created_at, type, concept, status, num_satoshis, fee=0):
+    return LNPayment(
+        payment_hash=payment_hash,
+        type=type,
+        concept=concept,
+        status=status,
+        num_satoshis=num_satoshis,
+        fee=fee,
+        created_at=created_at,
+        expires_at=created_at,
+    )
+
+
+class AccountingTest(TestCase):
+    """
+    do_accounting sums every day with one GROUP BY day query per table,
+    and backfills in chunks that can be accounted again safely.
+    """
+
+    def setUp(self):
+        self.currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        self.maker = User.objects.create(username="accounting-maker")
+        self.today = timezone.now().date()
+        self.day = self.today - timedelta(days=3)
+        self.noon = day_start(self.day) + timedelta(hours=12)
+
+    def _trade(self, i, escrow_sats, payout_sats, fee):
+        """A finished trade: settled escrow and maker bond, and a paid payout"""
+        escrow, bond, payout = LNPayment.objects.bulk_create(
+            [
+                lnpayment(
+                    f"escrow-{i}",
+                    self.noon,
+                    LNPayment.Types.HOLD,
+                    LNPayment.Concepts.TRESCROW,
+                    LNPayment.Status.SETLED,
+                    escrow_sats,
+                ),
+                lnpayment(
+                    f"bond-{i}",
+                    self.noon,
+                    LNPayment.Types.HOLD,
+                    LNPayment.Concepts.MAKEBOND,
+                    LNPayment.Status.SETLED,
+                    1000,
+                ),
+                lnpayment(
+                    f"payout-{i}",
+                    self.noon,
+                    LNPayment.Types.NORM,
+                    LNPayment.Concepts.PAYBUYER,
+                    LNPayment.Status.SUCCED,
+                    payout_sats,
+                    fee,
+                ),
+            ]
+        )
+        Order.objects.create(
+            maker=self.maker,
+            type=Order.Types.SELL,
+            currency=self.currency,
+            status=Order.Status.SUC,
+            amount=Decimal("100"),
+            has_range=False,
+            expires_at=self.noon,
+            public_duration=60 * 60,
+            escrow_duration=60 * 30,
+            trade_escrow=escrow,
+            payout=payout,
+        )
+        MarketTick.objects.create(
+            price=Decimal("30000"),
+            volume=Decimal("0.001"),
+            premium=Decimal("1"),
+            currency=self.currency,
+            timestamp=self.noon,
+        )
+
+    @patch("control.accounting.ACCOUNTING_CHUNK_DAYS", 2)
+    @patch.dict("os.environ", {"SLASHED_BOND_REWARD_SPLIT": "0.5"})
+    def test_do_accounting(self):
+        self._trade(0, escrow_sats=100_000, payout_sats=99_000, fee=10)
+        self._trade(1, escrow_sats=200_000, payout_sats=198_000, fee=20)
+        OnchainPayment.objects.create(
+            status=OnchainPayment.Status.CONFI,
+            num_satoshis=50_000,
+            sent_satoshis=49_000,
+            mining_fee_sats=500,
+            created_at=self.noon,
+            balance=None,
+        )
+
+        results = do_accounting()
+
+        self.assertEqual(results["num_days"], 4)
+        self.assertTrue(results["finished"])
+        self.assertEqual(AccountingDay.objects.count(), 4)
+        self.assertEqual(do_accounting(), {"message": "no days to account for"})
+
+        accounted = AccountingDay.objects.get(day=day_start(self.day))
+        self.assertEqual(accounted.num_contracts, 2)
+        self.assertEqual(accounted.contracted, Decimal("0.002"))
+        self.assertEqual(accounted.inflow, 300_000 + 2000)
+        self.assertEqual(accounted.outflow, 99_000 + 198_000 + 49_000)
+        self.assertEqual(accounted.routing_fees, 30)
+        self.assertEqual(accounted.mining_fees, 500)
+        self.assertEqual(accounted.net_settled, 300_000 + 2000 * 0.5)
+        self.assertEqual(accounted.net_paid, 99_000 + 198_000 + 30 + 49_000 + 500)
+
+        # Accounting the same days again replaces them
+        account_days(self.day, self.today)
+        self.assertEqual(AccountingDay.objects.count(), 4)
+        self.assertEqual(
+            AccountingDay.objects.get(day=day_start(self.day)).inflow, 302_000
+        )
+
+    def test_queries_do_not_grow_with_payments(self):
+        for i in range(10):
+            self._trade(i, escrow_sats=100_000, payout_sats=99_000, fee=10)
+
+        yesterday = self.today - timedelta(days=1)
+        with CaptureQueriesContext(connection) as queries:
+            account_days(self.day, yesterday)
+        # One GROUP BY query per table and the upsert
+        self.assertLessEqual(len(queries), 4)
+
+    @patch("control.accounting.ACCOUNTING_CHUNK_DAYS", 31)
+    @patch.dict("os.environ", {"SLASHED_BOND_REWARD_SPLIT": "0.5"})
+    def test_backfill_queries_do_not_grow_with_days(self):
+        first_day = self.today - timedelta(days=89)
+        LNPayment.objects.bulk_create(
+            lnpayment(
+                f"backfill-{i}",
+                day_start(first_day) + timedelta(days=i, hours=12),
+                LNPayment.Types.HOLD,
+                LNPayment.Concepts.TRESCROW,
+                LNPayment.Status.SETLED,
+                100_000,
+            )
+            for i in range(90)
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            results = do_accounting()
+
+        self.assertTrue(results["finished"])
+        self.assertEqual(AccountingDay.objects.count(), 90)
+        # A handful of queries per chunk of 31 days, not per day or payment
+        self.assertLess(len(queries), 30)
+
+
+@skipUnless(RUN_BENCHMARKS, "Benchmarks run with RUN_BENCHMARKS=True")
+class BenchmarkAccounting(TestCase):
+    """
+    Benchmark of a first do_accounting run (the backfill) over a year of
+    synthetic payments. Opt-in, timings depend on the machine.
+    """
+
+    DAYS = 365
+    PAYMENTS_PER_DAY = 100
+
+    @patch.dict("os.environ", {"SLASHED_BOND_REWARD_SPLIT": "0.5"})
+    def test_backfill_a_year(self):
+        rng = random.Random(0)
+        today = timezone.now().date()
+        first_day = today - timedelta(days=self.DAYS)
+        statuses = [
+            (
+                LNPayment.Types.HOLD,
+                LNPayment.Concepts.TRESCROW,
+                LNPayment.Status.SETLED,
+            ),
+            (
+                LNPayment.Types.HOLD,
+                LNPayment.Concepts.MAKEBOND,
+                LNPayment.Status.SETLED,
+            ),
+            (
+                LNPayment.Types.HOLD,
+                LNPayment.Concepts.TAKEBOND,
+                LNPayment.Status.CANCEL,
+            ),
+            (
+                LNPayment.Types.NORM,
+                LNPayment.Concepts.PAYBUYER,
+                LNPayment.Status.SUCCED,
+            ),
+            (
+                LNPayment.Types.NORM,
+                LNPayment.Concepts.WITHREWA,
+                LNPayment.Status.SUCCED,
+            ),
+        ]
+        LNPayment.objects.bulk_create(
+            (
+                lnpayment(
+                    f"{i:064x}",
+                    day_start(first_day)
+                    + timedelta(seconds=rng.randint(0, self.DAYS * 86400)),
+                    *rng.choice(statuses),
+                    rng.randint(20_000, 1_000_000),
+                    rng.randint(0, 100),
+                )
+                for i in range(self.DAYS * self.PAYMENTS_PER_DAY)
+            ),
+            batch_size=5000,
+        )
+        t0 = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            results = do_accounting()
+        elapsed = time.perf_counter() - t0
+
+        self.assertTrue(results["finished"])
+        self.assertEqual(AccountingDay.objects.count(), self.DAYS + 1)
+        # A handful of queries per chunk of days, not per day or payment
+        self.assertLess(len(queries), 100)
+        self.assertLess(elapsed, 30)
@@ -0,0 +1,134 @@
+from datetime import timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from api.logics import Logics
+from api.models import Currency, Order, Robot, TakeOrder
+
+
+class ActiveOrderTest(TestCase):
+    """
+    Logics.validate_already_maker_or_taker finds the order a robot is active
+    in with a single query, and Robot.active_order points to it.
+    """
+
+    def setUp(self):
+        self.currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        self.maker = User.objects.create(username="active-maker")
+        self.taker = User.objects.create(username="active-taker")
+
+    def _order(self, status=Order.Status.PUB, type=Order.Types.SELL, taker=None):
+        return Order.objects.create(
+            maker=self.maker,
+            taker=taker,
+            type=type,
+            currency=self.currency,
+            status=status,
+            amount=Decimal("100"),
+            has_range=False,
+            expires_at=timezone.now() + timedelta(hours=1),
+            public_duration=60 * 60,
+            escrow_duration=60 * 30,
+        )
+
+    def _validate(self, user):
+        return Logics.validate_already_maker_or_taker(User.objects.get(id=user.id))
+
+    def _pointer(self, user):
+        return Robot.objects.get(user=user).active_order_id
+
+    def test_single_query(self):
+        user = User.objects.get(id=self.maker.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                Logics.validate_already_maker_or_taker(user), (True, None, None)
+            )
+
+        order = self._order()
+        with self.assertNumQueries(1):
+            valid, context, active = Logics.validate_already_maker_or_taker(user)
+        self.assertFalse(valid)
+        self.assertEqual(context["error_code"], 1000)
+        self.assertEqual(active, order)
+
+    def test_maker_taker_and_pretaker(self):
+        order = self._order(Order.Status.TAK, taker=self.taker)
+        self.assertEqual(self._validate(self.maker)[2], order)
+        self.assertEqual(self._validate(self.taker)[2], order)
+        self.assertEqual(self._pointer(self.maker), order.id)
+        self.assertEqual(self._pointer(self.taker), order.id)
+
+        order.update_status(Order.Status.SUC)
+        self.assertTrue(self._validate(self.maker)[0])
+        self.assertIsNone(self._pointer(self.maker))
+        self.assertIsNone(self._pointer(self.taker))
+
+        public = self._order()
+        take_order = TakeOrder.objects.create(
+            order=public,
+            taker=self.taker,
+            amount=Decimal("100"),
+            expires_at=timezone.now() + timedelta(minutes=5),
+        )
+        valid, _, active = self._validate(self.taker)
+        self.assertFalse(valid)
+        self.assertEqual(active, public)
+        self.assertEqual(self._pointer(self.taker), public.id)
+
+        take_order.delete()
+        self.assertTrue(self._validate(self.taker)[0])
+        self.assertIsNone(self._pointer(self.taker))
+
+    def test_failing_payout_buyer(self):
+        # The taker of a SELL order is the buyer
+        order = self._order(Order.Status.FAI, taker=self.taker)
+
+        valid, _, active = self._validate(self.taker)
+        self.assertFalse(valid)
+        self.assertEqual(active, order)
+        self.assertTrue(self._validate(self.maker)[0])
+
+    def test_transition_status_updates_pointer(self):
+        order = self._order(Order.Status.WFB)
+        self.assertEqual(self._pointer(self.maker), order.id)
+
+        self.assertTrue(order.transition_status(Order.Status.UCA, [Order.Status.WFB]))
+        self.assertIsNone(self._pointer(self.maker))
+
+    @patch("api.active_orders.ROBOT_ACTIVE_ORDER", True)
+    def test_pointer_skips_the_search(self):
+        user = User.objects.select_related("robot").get(id=self.maker.id)
+        with self.assertNumQueries(0):
+            self.assertTrue(Logics.validate_already_maker_or_taker(user)[0])
+
+        order = self._order()
+        user = User.objects.select_related("robot__active_order").get(id=self.maker.id)
+        with self.assertNumQueries(0):
+            valid, context, active = Logics.validate_already_maker_or_taker(user)
+        self.assertFalse(valid)
+        self.assertEqual(context["error_code"], 1000)
+        self.assertEqual(active, order)
+
+    @patch("api.active_orders.ROBOT_ACTIVE_ORDER", True)
+    def test_stale_pretaker_pointer(self):
+        public = self._order()
+        TakeOrder.objects.create(
+            order=public,
+            taker=self.taker,
+            amount=Decimal("100"),
+            expires_at=timezone.now() + timedelta(minutes=5),
+        )
+        self.assertFalse(self._validate(self.taker)[0])
+
+        # Time runs out before clean_orders deletes the take order
+        TakeOrder.objects.filter(order=public).update(
+            expires_at=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertTrue(self._validate(self.taker)[0])
+        self.assertIsNone(self._pointer(self.taker))
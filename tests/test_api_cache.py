@@ -1,14 +1,19 @@
+import math
 from datetime import timedelta
 from decimal import Decimal
+from unittest.mock import patch
 
 from django.contrib.auth.models import User
 from django.core.cache import cache
-from django.test.utils import override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.urls import reverse
 from django.utils import timezone
 from rest_framework.test import APIClient
 
+from api.book import rebuild_book
 from api.models import Currency, Order
+from api.tasks import cache_market
 from tests.test_api import BaseAPITestCase
 
 LOCMEM_CACHES = {
@@ -49,50 +54,132 @@ class APICacheTest(BaseAPITestCase):
         self.assertEqual(second.json(), first.json())
         self.assertIsNotNone(cache.get("price"))
 
-    def test_book_empty_not_cached(self):
-        path = reverse("book")
 
-        response = self.client.get(path)
-        self.assertEqual(response.status_code, 404)
-        self.assertIsNone(cache.get("book:0:2"))
+class BookIndexTest(BaseAPITestCase):
+    """The book is read from an index that follows every order transition."""
 
-    def test_book_cached(self):
-        currency = Currency.objects.create(
+    def setUp(self):
+        self.client = APIClient()
+        # Orders of previous tests were rolled back, start from an index of this DB
+        rebuild_book()
+        self.currency = Currency.objects.create(
             currency=1, exchange_rate=Decimal("1.0"), timestamp=timezone.now()
         )
-        user = User.objects.create(
+        self.user = User.objects.create(
             username="book-maker-test", last_login=timezone.now()
         )
-        Order.objects.create(
-            maker=user,
-            type=Order.Types.BUY,
-            currency=currency,
-            status=Order.Status.PUB,
-            amount=Decimal("100000"),
-            has_range=False,
-            expires_at=timezone.now() + timedelta(hours=1),
-            public_duration=60 * 60 * 2,
-            escrow_duration=60 * 30,
-        )
 
+    def _public_order(self, **kwargs):
+        fields = {
+            "maker": self.user,
+            "type": Order.Types.BUY,
+            "currency": self.currency,
+            "status": Order.Status.PUB,
+            "amount": Decimal("100000"),
+            "has_range": False,
+            "expires_at": timezone.now() + timedelta(hours=1),
+            "public_duration": 60 * 60 * 2,
+            "escrow_duration": 60 * 30,
+        }
+        fields.update(kwargs)
+        return Order.objects.create(**fields)
+
+    def test_book_empty(self):
+        response = self.client.get(reverse("book"))
+        self.assertEqual(response.status_code, 404)
+
+    def test_book_follows_new_orders(self):
         path = reverse("book")
+        first_order = self._public_order()
+
         first = self.client.get(path)
         self.assertEqual(first.status_code, 200)
+        self.assertEqual([order["id"] for order in first.json()], [first_order.id])
+        self.assertEqual(first.json()[0]["maker_status"], "Active")
 
-        # A new public order must not be visible until the cached copy expires
-        Order.objects.create(
-            maker=user,
-            type=Order.Types.SELL,
-            currency=currency,
-            status=Order.Status.PUB,
-            amount=Decimal("200000"),
-            has_range=False,
-            expires_at=timezone.now() + timedelta(hours=1),
-            public_duration=60 * 60,
-            escrow_duration=60 * 30,
+        # A new public order is visible right away
+        second_order = self._public_order(type=Order.Types.SELL)
+        second = self.client.get(path)
+        self.assertEqual(
+            [order["id"] for order in second.json()], [first_order.id, second_order.id]
         )
 
-        second = self.client.get(path)
-        self.assertEqual(second.status_code, 200)
-        self.assertEqual(second.json(), first.json())
-        self.assertIsNotNone(cache.get("book:0:2"))
+    def test_book_filters_currency_and_type(self):
+        self._public_order(type=Order.Types.BUY)
+        sell_order = self._public_order(type=Order.Types.SELL)
+
+        response = self.client.get(reverse("book") + "?currency=1&type=1")
+        self.assertEqual([order["id"] for order in response.json()], [sell_order.id])
+
+        response = self.client.get(reverse("book") + "?currency=2&type=2")
+        self.assertEqual(response.status_code, 404)
+
+    def test_book_follows_status_transitions(self):
+        path = reverse("book")
+        order = self._public_order()
+        self.assertEqual(self.client.get(path).status_code, 200)
+
+        order.update_status(Order.Status.PAU)
+        self.assertEqual(self.client.get(path).status_code, 404)
+
+        order.transition_status(Order.Status.PUB, from_statuses=[Order.Status.PAU])
+        self.assertEqual(self.client.get(path).status_code, 200)
+
+        order.delete()
+        self.assertEqual(self.client.get(path).status_code, 404)
+
+    def test_book_hides_password_orders(self):
+        self._public_order(password="secret")
+        self.assertEqual(self.client.get(reverse("book")).status_code, 404)
+
+    def test_book_reprices_on_rebuild(self):
+        path = reverse("book")
+        self._public_order()
+        before = self.client.get(path).json()[0]["satoshis_now"]
+
+        Currency.objects.filter(id=self.currency.id).update(
+            exchange_rate=Decimal("2.0")
+        )
+        rebuild_book()
+
+        after = self.client.get(path).json()[0]["satoshis_now"]
+        self.assertAlmostEqual(after, before / 2, delta=1)
+
+
+class CacheMarketTest(BaseAPITestCase):
+    """Exchange rates are upserted in one query and dependent caches are dropped."""
+
+    def setUp(self):
+        rebuild_book()
+        Currency.objects.create(
+            currency=1, exchange_rate=Decimal("1.0"), timestamp=timezone.now()
+        )
+
+    def test_rates_upserted_in_one_query(self):
+        num_currencies = len(Currency.currency_dict)
+        rates = [1000.0 + i for i in range(num_currencies)]
+        rates[1] = math.nan  # No rate found for the second currency
+        cache.set("price", {"stale": True})
+        cache.set("info", {"stale": True})
+
+        with (
+            patch("api.utils.get_exchange_rates", return_value=rates),
+            CaptureQueriesContext(connection) as queries,
+        ):
+            cache_market()
+
+        currency_writes = [
+            query["sql"]
+            for query in queries.captured_queries
+            if query["sql"].startswith(
+                ('INSERT INTO "api_currency"', 'UPDATE "api_currency"')
+            )
+        ]
+        self.assertEqual(len(currency_writes), 1)
+        self.assertIn("ON CONFLICT", currency_writes[0])
+
+        self.assertEqual(Currency.objects.count(), num_currencies - 1)
+        self.assertEqual(Currency.objects.get(id=1).exchange_rate, Decimal("1000"))
+        self.assertFalse(Currency.objects.filter(id=2).exists())
+        self.assertIsNone(cache.get("price"))
+        self.assertIsNone(cache.get("info"))
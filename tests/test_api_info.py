@@ -1,9 +1,17 @@
+from datetime import timedelta
+from decimal import Decimal
+
 from decouple import config
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
 from django.test import Client
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
+from api.models import Currency, MarketTick
 from tests.test_api import BaseAPITestCase
 
 FEE = config("FEE", cast=float, default=0.2)
@@ -60,3 +68,79 @@ class APIInfoTest(BaseAPITestCase):
         self.assertEqual(data["notice_severity"], NOTICE_SEVERITY)
         self.assertEqual(data["notice_message"], NOTICE_MESSAGE)
         self.assertEqual(data["current_swap_fee_rate"], 0)
+
+
+class APIInfoStatsTest(BaseAPITestCase):
+    """
+    /api/info/ aggregates in the database and reads the lifetime stats from
+    the MarketStats row, so its cost does not grow with the tick history.
+    """
+
+    def setUp(self):
+        self.client = Client()
+        cache.delete("info")
+        self.currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+
+    def _tick(self, volume, premium, timestamp=None):
+        tick = MarketTick.objects.create(
+            price=Decimal("30000"),
+            volume=Decimal(volume),
+            premium=Decimal(premium),
+            currency=self.currency,
+            timestamp=timestamp or timezone.now(),
+        )
+        MarketTick.update_stats(tick)
+        return tick
+
+    def _get_info(self):
+        cache.delete("info")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("info"))
+        self.assertEqual(response.status_code, 200)
+        return response.json(), len(queries.captured_queries)
+
+    def test_volumes_and_premium(self):
+        last_month = timezone.now() - timedelta(days=30)
+        self._tick("0.01", "5.00", last_month)
+        self._tick("0.02", "3.00")
+
+        data, _ = self._get_info()
+
+        self.assertAlmostEqual(data["lifetime_volume"], 0.03)
+        self.assertAlmostEqual(data["last_day_volume"], 0.02)
+        self.assertAlmostEqual(data["last_day_nonkyc_btc_premium"], 3.00)
+
+    def test_premium_fallback_without_recent_ticks(self):
+        self._tick("0.01", "4.50", timezone.now() - timedelta(days=2))
+
+        data, _ = self._get_info()
+
+        self.assertEqual(data["last_day_volume"], 0)
+        self.assertAlmostEqual(data["last_day_nonkyc_btc_premium"], 4.50)
+        self.assertAlmostEqual(data["lifetime_volume"], 0.01)
+
+    def test_active_robots_today(self):
+        now = timezone.now()
+        User.objects.create(username="info-active", last_login=now)
+        # Same day of the month, but a month ago
+        User.objects.create(
+            username="info-inactive", last_login=now - timedelta(days=31)
+        )
+
+        data, _ = self._get_info()
+
+        self.assertEqual(data["active_robots_today"], 1)
+
+    def test_queries_do_not_grow_with_ticks(self):
+        self._tick("0.01", "2.00")
+        _, num_queries = self._get_info()
+
+        old = timezone.now() - timedelta(days=10)
+        for _ in range(50):
+            self._tick("0.01", "2.00", old)
+        data, more_ticks_queries = self._get_info()
+
+        self.assertEqual(more_ticks_queries, num_queries)
+        self.assertAlmostEqual(data["lifetime_volume"], 0.51)
@@ -0,0 +1,166 @@
+import hashlib
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from api.models import Currency, LNPayment, Order, TakeOrder
+from chat.models import Message
+from tests.test_api import BaseAPITestCase
+
+
+class OrderViewQueriesTest(BaseAPITestCase):
+    """
+    OrderView.get is polled by every participant. It must serve any order
+    status in a small number of queries that does not grow with the number
+    of chat messages or take orders.
+    """
+
+    MAX_QUERIES = 8
+
+    def setUp(self):
+        self.client = APIClient()
+        self.currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        self.maker = User.objects.create(
+            username="order-queries-maker", last_login=timezone.now()
+        )
+        self.taker = User.objects.create(
+            username="order-queries-taker", last_login=timezone.now()
+        )
+        self.third = User.objects.create(
+            username="order-queries-third", last_login=timezone.now()
+        )
+
+    def _lnpayment(self, name, status=LNPayment.Status.LOCKED):
+        return LNPayment.objects.create(
+            payment_hash=hashlib.sha256(name.encode()).hexdigest(),
+            invoice=f"lnbcrt-{name}",
+            num_satoshis=10_000,
+            status=status,
+            created_at=timezone.now(),
+            expires_at=timezone.now() + timedelta(hours=1),
+        )
+
+    def _order(self, status, **kwargs):
+        return Order.objects.create(
+            maker=self.maker,
+            type=Order.Types.SELL,
+            currency=self.currency,
+            status=status,
+            amount=Decimal("100"),
+            has_range=False,
+            last_satoshis=300_000,
+            expires_at=timezone.now() + timedelta(hours=1),
+            public_duration=60 * 60,
+            escrow_duration=60 * 30,
+            maker_bond=self._lnpayment(f"maker-bond-{status}"),
+            **kwargs,
+        )
+
+    def _contract(self, status, **kwargs):
+        return self._order(
+            status,
+            taker=self.taker,
+            taker_bond=self._lnpayment(f"taker-bond-{status}"),
+            trade_escrow=self._lnpayment(f"escrow-{status}"),
+            **kwargs,
+        )
+
+    def _get_order(self, order, user):
+        self.client.force_authenticate(user=user)
+        path = reverse("order") + f"?order_id={order.id}"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        return response, len(queries.captured_queries)
+
+    def _take(self, order, user, name):
+        return TakeOrder.objects.create(
+            order=order,
+            taker=user,
+            amount=Decimal("100"),
+            expires_at=timezone.now() + timedelta(minutes=5),
+            taker_bond=self._lnpayment(name, status=LNPayment.Status.INVGEN),
+        )
+
+    def test_order_not_found(self):
+        self.client.force_authenticate(user=self.third)
+        response = self.client.get(reverse("order") + "?order_id=999999")
+        self.assertEqual(response.status_code, 404)
+
+    def test_public_order_non_participant(self):
+        order = self._order(Order.Status.PUB)
+
+        response, num_queries = self._get_order(order, self.third)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()["is_participant"])
+        self.assertLessEqual(num_queries, self.MAX_QUERIES)
+
+    def test_public_order_pretaker(self):
+        order = self._order(Order.Status.PUB)
+        self._take(order, self.third, "taker-bond-third")
+
+        response, num_queries = self._get_order(order, self.third)
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertTrue(data["is_taker"])
+        self.assertEqual(data["status"], Order.Status.TAK)
+        self.assertEqual(data["bond_invoice"], "lnbcrt-taker-bond-third")
+        self.assertLessEqual(num_queries, self.MAX_QUERIES)
+
+        # Other robots pretaking the same order do not add queries
+        self._take(order, self.taker, "taker-bond-other")
+        _, more_take_orders_queries = self._get_order(order, self.third)
+        self.assertEqual(more_take_orders_queries, num_queries)
+
+    def test_chat_order_does_not_depend_on_messages(self):
+        order = self._contract(Order.Status.CHA)
+
+        response, num_queries = self._get_order(order, self.maker)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["chat_last_index"], 0)
+        self.assertLessEqual(num_queries, self.MAX_QUERIES)
+
+        Message.objects.bulk_create(
+            Message(
+                order=order,
+                index=index,
+                sender=self.maker,
+                receiver=self.taker,
+                PGP_message="-----BEGIN PGP MESSAGE-----",
+            )
+            for index in range(1, 31)
+        )
+
+        response, with_messages_queries = self._get_order(order, self.maker)
+        self.assertEqual(response.json()["chat_last_index"], 30)
+        self.assertEqual(with_messages_queries, num_queries)
+
+    def test_dispute_order(self):
+        order = self._contract(Order.Status.DIS, maker_statement="Statement")
+
+        response, num_queries = self._get_order(order, self.maker)
+
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertTrue(data["statement_submitted"])
+        self.assertTrue(data["is_seller"])
+        self.assertTrue(data["escrow_locked"])
+        self.assertLessEqual(num_queries, self.MAX_QUERIES)
+
+    def test_expired_order(self):
+        order = self._order(Order.Status.EXP, expiry_reason=Order.ExpiryReasons.NTAKEN)
+
+        response, num_queries = self._get_order(order, self.maker)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["expiry_reason"], Order.ExpiryReasons.NTAKEN)
+        self.assertLessEqual(num_queries, self.MAX_QUERIES)
@@ -0,0 +1,263 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.db import IntegrityError, connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from django_redis import get_redis_connection
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+import chat.routing
+from api.models import Currency, Order, Robot
+from chat.models import ChatRoom, Message
+from chat.state import (
+    CHAT_PRESENCE_TTL,
+    connect_user,
+    disconnect_user,
+    is_connected,
+    presence_key,
+)
+from chat.views import ChatView
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+}
+
+PGP_MESSAGE = "-----BEGIN PGP MESSAGE-----\nhello\n-----END PGP MESSAGE-----"
+
+
+def chat_order(name):
+    currency, _ = Currency.objects.get_or_create(
+        currency=1,
+        defaults={"exchange_rate": Decimal("30000"), "timestamp": timezone.now()},
+    )
+    maker = User.objects.create(username=f"{name}-maker", last_login=timezone.now())
+    taker = User.objects.create(username=f"{name}-taker", last_login=timezone.now())
+    Robot.objects.filter(user=maker).update(public_key="maker-key")
+    Robot.objects.filter(user=taker).update(public_key="taker-key")
+    order = Order.objects.create(
+        maker=maker,
+        taker=taker,
+        type=Order.Types.SELL,
+        currency=currency,
+        status=Order.Status.CHA,
+        amount=Decimal("100"),
+        has_range=False,
+        expires_at=timezone.now() + timedelta(hours=1),
+        public_duration=60 * 60,
+        escrow_duration=60 * 30,
+    )
+    # Chat state of orders with the same id in earlier test runs
+    get_redis_connection("default").delete(presence_key(order.id))
+    return order
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+@patch("chat.consumers.send_notification")
+class ChatRoomConsumerTest(TransactionTestCase):
+    """
+    ChatRoomConsumer loads the order once on connect, tracks presence in
+    Redis and stores messages with consecutive indices.
+    """
+
+    application = URLRouter(chat.routing.websocket_urlpatterns)
+
+    def setUp(self):
+        self.order = chat_order("consumer")
+
+    async def _connect(self, user):
+        communicator = WebsocketCommunicator(
+            self.application, f"ws/chat/{self.order.id}/"
+        )
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_presence_and_messages(self, send_notification):
+        maker, taker = self.order.maker, self.order.taker
+
+        maker_ws, connected = await self._connect(maker)
+        self.assertTrue(connected)
+        greeting = await maker_ws.receive_json_from()
+        self.assertEqual(greeting["message"], "taker-key")
+        self.assertFalse(greeting["peer_connected"])
+        self.assertTrue(
+            await database_sync_to_async(
+                ChatRoom.objects.filter(id=self.order.id).exists
+            )()
+        )
+
+        taker_ws, _ = await self._connect(taker)
+        self.assertTrue((await taker_ws.receive_json_from())["peer_connected"])
+        self.assertEqual((await maker_ws.receive_json_from())["message"], "maker-key")
+
+        await maker_ws.send_json_to({"message": PGP_MESSAGE})
+        await taker_ws.send_json_to({"message": PGP_MESSAGE})
+        for communicator in (maker_ws, taker_ws):
+            received = [await communicator.receive_json_from() for _ in range(2)]
+            self.assertEqual(sorted(m["index"] for m in received), [1, 2])
+            self.assertTrue(all(m["peer_connected"] for m in received))
+        self.assertEqual(send_notification.delay.call_count, 2)
+
+        await taker_ws.disconnect()
+        left = await maker_ws.receive_json_from()
+        self.assertEqual(left["message"], "peer-disconnected")
+        self.assertFalse(is_connected(self.order.id, taker.id))
+        self.assertTrue(is_connected(self.order.id, maker.id))
+
+        await maker_ws.disconnect()
+
+    @patch("chat.consumers.CHAT_HISTORY_BATCH", 2)
+    async def test_serve_history_to_requester_only(self, send_notification):
+        def store_messages():
+            chatroom = ChatRoom.objects.create(id=self.order.id, order=self.order)
+            for index in range(1, 6):
+                Message.objects.create(
+                    order=self.order,
+                    chatroom=chatroom,
+                    index=index,
+                    sender=self.order.maker if index % 2 else self.order.taker,
+                    PGP_message=f"{PGP_MESSAGE} {index}",
+                )
+
+        await database_sync_to_async(store_messages)()
+        maker_ws, _ = await self._connect(self.order.maker)
+        taker_ws, _ = await self._connect(self.order.taker)
+        await maker_ws.receive_json_from()
+        await maker_ws.receive_json_from()
+        await taker_ws.receive_json_from()
+
+        await maker_ws.send_json_to({"message": "-----SERVE HISTORY-----"})
+        history = [await maker_ws.receive_json_from() for _ in range(5)]
+        self.assertEqual([m["index"] for m in history], [1, 2, 3, 4, 5])
+        self.assertEqual(history[0]["user_nick"], "consumer-maker")
+        self.assertEqual(history[1]["user_nick"], "consumer-taker")
+        self.assertTrue(await maker_ws.receive_nothing())
+        self.assertTrue(await taker_ws.receive_nothing())
+
+        # Reconnecting clients ask only for the messages they miss
+        await taker_ws.send_json_to({"message": "-----SERVE HISTORY-----", "offset": 3})
+        history = [await taker_ws.receive_json_from() for _ in range(2)]
+        self.assertEqual([m["index"] for m in history], [4, 5])
+        self.assertTrue(await taker_ws.receive_nothing())
+
+        await maker_ws.disconnect()
+        await taker_ws.disconnect()
+
+    async def test_rejects_non_participant(self, send_notification):
+        other = await database_sync_to_async(User.objects.create)(username="intruder")
+        _, connected = await self._connect(other)
+        self.assertFalse(connected)
+        self.assertFalse(is_connected(self.order.id, other.id))
+
+
+class PresenceTest(TestCase):
+    """
+    Presence is tracked per connection and expires without heartbeats, so
+    the connections of a crashed worker stop counting on their own.
+    """
+
+    def setUp(self):
+        self.order_id = 10**9
+        get_redis_connection("default").delete(presence_key(self.order_id))
+        self.addCleanup(
+            get_redis_connection("default").delete, presence_key(self.order_id)
+        )
+
+    def test_connections_of_a_user(self):
+        connect_user(self.order_id, 1, "channel-a")
+        connect_user(self.order_id, 1, "channel-b")
+        self.assertTrue(is_connected(self.order_id, 1))
+        self.assertFalse(is_connected(self.order_id, 11))
+
+        disconnect_user(self.order_id, 1, "channel-a")
+        self.assertTrue(is_connected(self.order_id, 1))
+        disconnect_user(self.order_id, 1, "channel-b")
+        self.assertFalse(is_connected(self.order_id, 1))
+
+    def test_presence_expires_without_heartbeat(self):
+        connect_user(self.order_id, 1, "channel-a")
+        later = time.time() + CHAT_PRESENCE_TTL + 1
+        with patch("chat.state.time") as clock:
+            clock.time.return_value = later
+            self.assertFalse(is_connected(self.order_id, 1))
+            # A heartbeat marks the connection present again
+            connect_user(self.order_id, 1, "channel-a")
+            self.assertTrue(is_connected(self.order_id, 1))
+
+
+class MessageIndexTest(TransactionTestCase):
+    """Concurrent senders of an order chat get consecutive, unique indices"""
+
+    def setUp(self):
+        self.order = chat_order("index")
+        self.chatroom = ChatRoom.objects.create(id=self.order.id, order=self.order)
+
+    def test_concurrent_indices_are_consecutive(self):
+        def add_message(i):
+            try:
+                return self.chatroom.add_message(
+                    sender=self.order.maker,
+                    receiver=self.order.taker,
+                    PGP_message=f"{PGP_MESSAGE} {i}",
+                ).index
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            indices = list(executor.map(add_message, range(50)))
+
+        self.assertEqual(sorted(indices), list(range(1, 51)))
+        self.chatroom.refresh_from_db()
+        self.assertEqual(self.chatroom.last_index, 50)
+
+    def test_duplicate_index_is_rejected(self):
+        self.chatroom.add_message(self.order.maker, self.order.taker, PGP_MESSAGE)
+        with self.assertRaises(IntegrityError):
+            Message.objects.create(
+                order=self.order,
+                chatroom=self.chatroom,
+                index=1,
+                sender=self.order.taker,
+            )
+
+
+class ChatViewTest(TestCase):
+    """ChatView answers polls without new messages with 304 Not Modified"""
+
+    def setUp(self):
+        self.order = chat_order("view")
+        self.view = ChatView.as_view({"get": "get"})
+        self.factory = APIRequestFactory()
+
+    def _get(self, offset, etag=None):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        request = self.factory.get(
+            "/api/chat/", {"order_id": self.order.id, "offset": offset}, **headers
+        )
+        force_authenticate(request, user=self.order.maker)
+        return self.view(request)
+
+    def test_etag(self):
+        response = self._get(offset=0)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["messages"], [])
+        etag = response["ETag"]
+
+        self.assertEqual(self._get(offset=0, etag=etag).status_code, 304)
+
+        ChatRoom.objects.get(id=self.order.id).add_message(
+            self.order.taker, self.order.maker, PGP_MESSAGE
+        )
+        response = self._get(offset=0, etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m["index"] for m in response.data["messages"]], [1])
+        self.assertNotEqual(response["ETag"], etag)
+        self.assertEqual(self._get(offset=0, etag=response["ETag"]).status_code, 304)
@@ -0,0 +1,178 @@
+import os
+from datetime import timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+from celery.exceptions import SoftTimeLimitExceeded
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from api.models import Currency, LNPayment, OnchainPayment, Order, Robot
+from api.tasks import payments_cleansing, users_cleansing
+from chat.models import ChatRoom, Message
+from chat.tasks import chatrooms_cleansing
+
+
+class UsersCleansingTest(TestCase):
+    """
+    users_cleansing deletes abandoned users in chunked transactions, and a
+    run stopped by the time limit is resumed by the next one.
+    """
+
+    def setUp(self):
+        cache.delete("users_cleansing:cursor")
+        self.currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+
+    def tearDown(self):
+        cache.delete("users_cleansing:cursor")
+
+    def _users(self, n, prefix="abandoned"):
+        return [User.objects.create(username=f"{prefix}-{i}") for i in range(n)]
+
+    def test_deletes_only_abandoned_users(self):
+        abandoned = self._users(3)
+        staff = User.objects.create(username="staff", is_staff=True)
+        recent = User.objects.create(username="recent", last_login=timezone.now())
+        rewarded = User.objects.create(username="rewarded")
+        Robot.objects.filter(user=rewarded).update(earned_rewards=100)
+        with_contracts = User.objects.create(username="with-contracts")
+        Robot.objects.filter(user=with_contracts).update(total_contracts=1)
+        maker = User.objects.create(username="maker")
+        Order.objects.create(
+            maker=maker,
+            type=Order.Types.SELL,
+            currency=self.currency,
+            status=Order.Status.PUB,
+            amount=Decimal("100"),
+            has_range=False,
+            expires_at=timezone.now() + timedelta(hours=1),
+            public_duration=60 * 60,
+            escrow_duration=60 * 30,
+        )
+
+        results = users_cleansing()
+
+        self.assertEqual(results["num_deleted"], len(abandoned))
+        self.assertTrue(results["finished"])
+        self.assertFalse(
+            User.objects.filter(id__in=[user.id for user in abandoned]).exists()
+        )
+        kept = [staff, recent, rewarded, with_contracts, maker]
+        self.assertEqual(
+            User.objects.filter(id__in=[user.id for user in kept]).count(), len(kept)
+        )
+
+    @patch.dict(os.environ, {"USERS_CLEANSING_CHUNK": "2"})
+    def test_resumes_after_time_limit(self):
+        users = self._users(5)
+
+        # The time limit is hit while cleaning the keys of the first chunk
+        with patch(
+            "api.utils.delete_gpg_keys", side_effect=[0, SoftTimeLimitExceeded()]
+        ):
+            results = users_cleansing()
+
+        self.assertFalse(results["finished"])
+        self.assertEqual(results["num_deleted"], 2)
+        self.assertEqual(cache.get("users_cleansing:cursor"), users[1].id)
+
+        results = users_cleansing()
+
+        self.assertTrue(results["finished"])
+        self.assertEqual(results["num_deleted"], 3)
+        self.assertEqual(cache.get("users_cleansing:cursor"), 0)
+        self.assertFalse(User.objects.filter(username__startswith="abandoned").exists())
+
+
+@patch.dict(os.environ, {"CLEANSING_CHUNK": "2"})
+class FinishedOrdersCleansingTest(TestCase):
+    """
+    payments_cleansing and chatrooms_cleansing delete in chunks and
+    return counts and timings.
+    """
+
+    def setUp(self):
+        self.currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        self.maker = User.objects.create(username="cleansing-maker")
+
+    def _order(self, status, expired_ago, **kwargs):
+        return Order.objects.create(
+            maker=self.maker,
+            type=Order.Types.SELL,
+            currency=self.currency,
+            status=status,
+            amount=Decimal("100"),
+            has_range=False,
+            expires_at=timezone.now() - expired_ago,
+            public_duration=60 * 60,
+            escrow_duration=60 * 30,
+            **kwargs,
+        )
+
+    def _bond(self, i, status=LNPayment.Status.CANCEL):
+        return LNPayment.objects.create(
+            payment_hash=f"{i:064x}",
+            type=LNPayment.Types.HOLD,
+            concept=LNPayment.Concepts.MAKEBOND,
+            status=status,
+            num_satoshis=1000,
+            created_at=timezone.now(),
+            expires_at=timezone.now() + timedelta(hours=1),
+        )
+
+    def test_payments_cleansing(self):
+        old = [
+            self._order(Order.Status.EXP, timedelta(days=4), maker_bond=self._bond(i))
+            for i in range(5)
+        ]
+        recent = self._order(
+            Order.Status.EXP, timedelta(hours=1), maker_bond=self._bond(5)
+        )
+        locked = self._order(
+            Order.Status.SUC,
+            timedelta(days=4),
+            maker_bond=self._bond(6, LNPayment.Status.SETLED),
+        )
+        OnchainPayment.objects.create(
+            status=OnchainPayment.Status.CREAT, num_satoshis=1000, balance=None
+        )
+
+        results = payments_cleansing()
+
+        self.assertEqual(results["num_lnpayments_deleted"], len(old))
+        self.assertEqual(results["lnpayments_chunks"], 3)
+        self.assertEqual(results["num_onchainpayments_deleted"], 1)
+        self.assertNotIn("deleted_lnpayments", results)
+        self.assertTrue(LNPayment.objects.filter(order_made=recent).exists())
+        self.assertTrue(LNPayment.objects.filter(order_made=locked).exists())
+        self.assertEqual(LNPayment.objects.count(), 2)
+        # Orders stay, without their bond
+        self.assertTrue(
+            Order.objects.filter(id=old[0].id, maker_bond__isnull=True).exists()
+        )
+
+    def test_chatrooms_cleansing(self):
+        finished = [self._order(Order.Status.SUC, timedelta(days=4)) for _ in range(3)]
+        ongoing = self._order(Order.Status.CHA, timedelta(days=4))
+        for order in finished + [ongoing]:
+            chatroom = ChatRoom.objects.create(id=order.id, order=order)
+            Message.objects.bulk_create(
+                Message(order=order, chatroom=chatroom, index=index)
+                for index in range(1, 3)
+            )
+
+        results = chatrooms_cleansing()
+
+        self.assertEqual(results["num_deleted"], len(finished))
+        self.assertEqual(results["num_messages_deleted"], 2 * len(finished))
+        self.assertEqual(results["chunks"], 2)
+        self.assertEqual(
+            list(ChatRoom.objects.values_list("id", flat=True)), [ongoing.id]
+        )
+        self.assertEqual(Message.objects.count(), 2)
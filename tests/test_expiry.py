@@ -0,0 +1,149 @@
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from api.expiry import (
+    ORDERS_KEY,
+    TAKE_ORDERS_KEY,
+    next_deadline,
+    pop_due,
+    rebuild_expiry,
+    shard_key,
+)
+from api.management.commands.clean_orders import Command as CleanOrders
+from api.models import Currency, Order, TakeOrder
+from api.shards import NUM_SHARDS, shard_of
+
+
+class ExpiryScheduleTest(TestCase):
+    """
+    Orders are scheduled to expire in Redis sorted sets when saved, so
+    clean_orders only reads the orders that are due instead of scanning
+    every active order.
+    """
+
+    def setUp(self):
+        self.redis = get_redis_connection("default")
+        self.keys = [
+            shard_key(key, shard)
+            for key in (ORDERS_KEY, TAKE_ORDERS_KEY)
+            for shard in range(NUM_SHARDS)
+        ]
+        self.redis.delete(*self.keys)
+        self.currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        self.maker = User.objects.create(username="expiry-maker")
+        self.taker = User.objects.create(username="expiry-taker")
+
+    def tearDown(self):
+        self.redis.delete(*self.keys)
+
+    def _order(self, status=Order.Status.WFB, expires_in=timedelta(hours=1)):
+        return Order.objects.create(
+            maker=self.maker,
+            type=Order.Types.SELL,
+            currency=self.currency,
+            status=status,
+            amount=Decimal("100"),
+            has_range=False,
+            last_satoshis=300_000,
+            expires_at=timezone.now() + expires_in,
+            public_duration=60 * 60,
+            escrow_duration=60 * 30,
+        )
+
+    def _score(self, key, id, order_id=None):
+        shard = shard_of(order_id or id)
+        return self.redis.zscore(shard_key(key, shard), id)
+
+    def test_schedule_on_save(self):
+        order = self._order()
+        self.assertAlmostEqual(
+            self._score(ORDERS_KEY, order.id), order.expires_at.timestamp()
+        )
+
+        order.expires_at = timezone.now() + timedelta(hours=2)
+        order.save(update_fields=["expires_at"])
+        self.assertAlmostEqual(
+            self._score(ORDERS_KEY, order.id), order.expires_at.timestamp()
+        )
+
+        # Orders that can no longer expire leave the schedule
+        order.update_status(Order.Status.SUC)
+        self.assertIsNone(self._score(ORDERS_KEY, order.id))
+
+        other = self._order()
+        self.assertTrue(other.transition_status(Order.Status.CCA, [Order.Status.WFB]))
+        self.assertIsNone(self._score(ORDERS_KEY, other.id))
+
+        deleted = self._order()
+        deleted.delete()
+        self.assertIsNone(self._score(ORDERS_KEY, deleted.id))
+
+    @patch("api.shards.NUM_SHARDS", 1)
+    def test_pop_due(self):
+        due = [self._order(expires_in=-timedelta(minutes=i + 1)) for i in range(3)]
+        later = self._order()
+
+        self.assertAlmostEqual(next_deadline([0]), due[-1].expires_at.timestamp())
+        self.assertEqual(pop_due(ORDERS_KEY, 0, limit=2), [due[2].id, due[1].id])
+        self.assertEqual(pop_due(ORDERS_KEY, 0), [due[0].id])
+        self.assertEqual(pop_due(ORDERS_KEY, 0), [])
+        self.assertIsNotNone(self._score(ORDERS_KEY, later.id))
+
+    def test_rebuild_expiry(self):
+        order = self._order()
+        self._order(Order.Status.EXP)
+        self.redis.delete(*self.keys)
+
+        self.assertEqual(rebuild_expiry(), (1, 0))
+        self.assertIsNotNone(self._score(ORDERS_KEY, order.id))
+
+        # Replicas only rebuild the shards they own
+        self.redis.delete(*self.keys)
+        other_shards = set(range(NUM_SHARDS)) - {shard_of(order.id)}
+        self.assertEqual(rebuild_expiry(other_shards), (0, 0))
+
+    def test_clean_orders_expires_due_orders(self):
+        expired = self._order(expires_in=-timedelta(seconds=1))
+        public = self._order(Order.Status.PUB)
+        take_order = TakeOrder.objects.create(
+            order=public,
+            taker=self.taker,
+            amount=Decimal("100"),
+            expires_at=timezone.now() - timedelta(seconds=1),
+        )
+        self.assertIsNotNone(self._score(TAKE_ORDERS_KEY, take_order.id, public.id))
+
+        CleanOrders(stdout=StringIO()).clean_orders()
+
+        expired.refresh_from_db()
+        public.refresh_from_db()
+        self.assertEqual(expired.status, Order.Status.EXP)
+        self.assertEqual(expired.expiry_reason, Order.ExpiryReasons.NMBOND)
+        self.assertEqual(public.status, Order.Status.PUB)
+        self.assertFalse(TakeOrder.objects.filter(id=take_order.id).exists())
+        self.assertIsNone(self._score(ORDERS_KEY, expired.id))
+        self.assertIsNotNone(self._score(ORDERS_KEY, public.id))
+
+    def test_clean_orders_skips_extended_orders(self):
+        order = self._order(expires_in=-timedelta(seconds=1))
+        # Extended with a queryset update, which does not re-schedule it
+        Order.objects.filter(id=order.id).update(
+            expires_at=timezone.now() + timedelta(hours=1)
+        )
+
+        CleanOrders(stdout=StringIO()).clean_orders()
+
+        order.refresh_from_db()
+        self.assertEqual(order.status, Order.Status.WFB)
+        self.assertAlmostEqual(
+            self._score(ORDERS_KEY, order.id), order.expires_at.timestamp()
+        )
@@ -80,6 +80,7 @@ class TestGrpcProtoSymbols(unittest.TestCase):
         "invoices_pb2.CancelInvoiceMsg",
         "invoices_pb2.LookupInvoiceMsg",
         "invoices_pb2.SettleInvoiceMsg",
+        "invoices_pb2.SubscribeSingleInvoiceRequest",
         # lightning_pb2
         "lightning_pb2.ChannelBalanceRequest",
         "lightning_pb2.EstimateFeeRequest",
@@ -188,6 +189,7 @@ class TestGrpcStubRpcMethods(unittest.TestCase):
         "invoicesstub.CancelInvoice",
         "invoicesstub.LookupInvoiceV2",
         "invoicesstub.SettleInvoice",
+        "invoicesstub.SubscribeSingleInvoice",
         "lightningstub.ChannelBalance",
         "lightningstub.DecodePayReq",
         "lightningstub.EstimateFee",
@@ -0,0 +1,172 @@
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from api.models import Currency, Order
+from api.nostr import (
+    PENDING_ORDERS_KEY,
+    PROCESSING_KEY,
+    QUEUE_KEY,
+    RETRY_KEY,
+    NostrPublisher,
+    enqueue_notification_event,
+    enqueue_order_event,
+)
+from api.tasks import defer_nostr_event
+
+
+class FakeClient:
+    """Stands in for the relay connection, failing the first sends"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.sent = []
+
+    async def send_event(self, event):
+        if self.failures:
+            self.failures -= 1
+            raise Exception("Relay unavailable")
+        self.sent.append(event)
+        return SimpleNamespace(success=["ws://relay"], failed={})
+
+
+class NostrPublisherTest(TestCase):
+    """
+    Nostr events are queued in Redis and published in batches by
+    NostrPublisher over one client, with retries.
+    """
+
+    def setUp(self):
+        self.redis = get_redis_connection("default")
+        keys = (QUEUE_KEY, RETRY_KEY, PROCESSING_KEY, PENDING_ORDERS_KEY)
+        self.redis.delete(*keys)
+        self.addCleanup(self.redis.delete, *keys)
+        currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        maker = User.objects.create(username="nostr-maker")
+        self.orders = [
+            Order.objects.create(
+                maker=maker,
+                type=Order.Types.SELL,
+                currency=currency,
+                status=Order.Status.PUB,
+                amount=Decimal("100"),
+                has_range=False,
+                expires_at=timezone.now() + timedelta(hours=1),
+                public_duration=60 * 60,
+                escrow_duration=60 * 30,
+            )
+            for _ in range(3)
+        ]
+
+    def test_order_events_are_coalesced(self):
+        order = self.orders[0]
+        for _ in range(3):
+            self.assertTrue(enqueue_order_event(order.id))
+        self.assertEqual(self.redis.llen(QUEUE_KEY), 1)
+
+        publisher = NostrPublisher(client=FakeClient())
+        self.assertEqual(publisher.pop_batch(), [{"order_id": order.id}])
+
+        # Changes after the batch was popped are published again
+        enqueue_order_event(order.id)
+        self.assertEqual(self.redis.llen(QUEUE_KEY), 1)
+
+    @patch("api.nostr.NOSTR_QUEUE_MAX", 2)
+    def test_backpressure(self):
+        self.assertTrue(enqueue_order_event(self.orders[0].id))
+        self.assertTrue(enqueue_notification_event(1, self.orders[0].id, "Hi"))
+        self.assertFalse(enqueue_order_event(self.orders[1].id))
+        self.assertFalse(enqueue_notification_event(1, self.orders[0].id, "Hi"))
+        # Coalesced into the event already queued
+        self.assertTrue(enqueue_order_event(self.orders[0].id))
+        self.assertEqual(self.redis.llen(QUEUE_KEY), 2)
+
+    @patch("api.nostr.NOSTR_DEFER_SECONDS", 30)
+    @patch("api.nostr.NOSTR_MAX_ATTEMPTS", 3)
+    def test_full_queue_defers_the_task(self):
+        task = Mock()
+        task.retry.return_value = Exception("retry")
+        task.request.retries = 0
+        with self.assertRaisesMessage(Exception, "retry"):
+            defer_nostr_event(task, "order 1")
+        task.retry.assert_called_once_with(countdown=30, max_retries=None)
+
+        # Dropped once out of attempts
+        task.reset_mock()
+        task.request.retries = 2
+        defer_nostr_event(task, "order 1")
+        task.retry.assert_not_called()
+
+    def test_popped_events_survive_a_crash(self):
+        for order in self.orders:
+            enqueue_order_event(order.id)
+        crashed = NostrPublisher(client=FakeClient())
+        self.assertEqual(len(crashed.pop_batch()), 3)
+        self.assertEqual(self.redis.llen(QUEUE_KEY), 0)
+        self.assertEqual(self.redis.llen(PROCESSING_KEY), 3)
+
+        # A restarted publisher queues them again, in order
+        client = FakeClient()
+        publisher = NostrPublisher(client=client)
+        publisher.recover()
+        batch = publisher.pop_batch()
+        self.assertEqual(
+            [item["order_id"] for item in batch], [o.id for o in self.orders]
+        )
+        self.assertEqual(async_to_sync(publisher.publish_batch)(batch), 3)
+        self.assertEqual(self.redis.llen(PROCESSING_KEY), 0)
+
+    @patch("api.nostr.NOSTR_BATCH_SIZE", 2)
+    def test_publish_in_batches(self):
+        for order in self.orders:
+            enqueue_order_event(order.id)
+        client = FakeClient()
+        publisher = NostrPublisher(client=client)
+
+        first, second = publisher.pop_batch(), publisher.pop_batch()
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertEqual(async_to_sync(publisher.publish_batch)(first + second), 3)
+        self.assertEqual(len(client.sent), 3)
+        self.assertEqual(client.sent[0].kind().as_u16(), 38383)
+
+    @patch("api.nostr.NOSTR_RETRY_SECONDS", 0)
+    @patch("api.nostr.NOSTR_MAX_ATTEMPTS", 2)
+    def test_failed_events_are_retried(self):
+        client = FakeClient(failures=3)
+        publisher = NostrPublisher(client=client)
+        enqueue_order_event(self.orders[0].id)
+
+        self.assertEqual(
+            async_to_sync(publisher.publish_batch)(publisher.pop_batch()), 0
+        )
+        self.assertEqual(self.redis.zcard(RETRY_KEY), 1)
+        self.assertEqual(self.redis.llen(PROCESSING_KEY), 0)
+
+        # Retried once, then dropped
+        batch = publisher.pop_batch()
+        self.assertEqual(batch[0]["attempts"], 1)
+        self.assertEqual(async_to_sync(publisher.publish_batch)(batch), 0)
+        self.assertEqual(self.redis.zcard(RETRY_KEY), 0)
+        self.assertEqual(publisher.pop_batch(timeout=0.1), [])
+
+    def test_deleted_orders_are_skipped(self):
+        client = FakeClient()
+        publisher = NostrPublisher(client=client)
+        enqueue_order_event(self.orders[0].id)
+        self.orders[0].delete()
+
+        self.assertEqual(
+            async_to_sync(publisher.publish_batch)(publisher.pop_batch()), 0
+        )
+        self.assertEqual(client.sent, [])
+        self.assertEqual(self.redis.zcard(RETRY_KEY), 0)
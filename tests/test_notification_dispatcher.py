@@ -0,0 +1,240 @@
+import asyncio
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+
+from api.dispatcher import NotificationDispatcher
+from api.models import Currency, Notification, NotificationDelivery, Order, Robot
+from api.notifications import Notifications
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.text = str(self.body)
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+
+class FakeSession:
+    """Stands in for the pooled HTTP session, answering by destination host"""
+
+    def __init__(self, responses=None, delay=0):
+        self.responses = responses or {}
+        self.delay = delay
+        self.calls = []
+        self.concurrent = 0
+        self.max_concurrent = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, timeout, **kwargs):
+        with self.lock:
+            self.calls.append(url)
+            self.concurrent += 1
+            self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        time.sleep(self.delay)
+        with self.lock:
+            self.concurrent -= 1
+        for host, response in self.responses.items():
+            if host in url:
+                return response
+        return FakeResponse()
+
+
+class NotificationDispatcherTest(TestCase):
+    """
+    Notifications are written to the NotificationDelivery outbox and
+    delivered by NotificationDispatcher with retries, dead-lettering,
+    circuit breakers and a concurrency limit per channel.
+    """
+
+    def setUp(self):
+        currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        maker = User.objects.create(username="dispatcher-maker")
+        self.robot = Robot.objects.get(user=maker)
+        self.order = Order.objects.create(
+            maker=maker,
+            type=Order.Types.SELL,
+            currency=currency,
+            status=Order.Status.PUB,
+            amount=Decimal("100"),
+            has_range=False,
+            expires_at=timezone.now() + timedelta(hours=1),
+            public_duration=60 * 60,
+            escrow_duration=60 * 30,
+        )
+
+    def _delivery(self, channel=NotificationDelivery.Channels.WEBHOOK, url=None):
+        if channel == NotificationDelivery.Channels.TELEGRAM:
+            destination, payload = "1234", {"text": "Hi"}
+        else:
+            destination, payload = url or "http://alice.onion/hook", {"title": "Hi"}
+        return NotificationDelivery.objects.create(
+            channel=channel,
+            robot=self.robot,
+            order=self.order,
+            destination=destination,
+            payload=payload,
+        )
+
+    def _dispatch(self, dispatcher):
+        """Delivers every due delivery concurrently, returns the number delivered"""
+
+        async def deliver_all(deliveries):
+            results = await asyncio.gather(
+                *(dispatcher.deliver(delivery) for delivery in deliveries)
+            )
+            return sum(results)
+
+        return async_to_sync(deliver_all)(dispatcher.claim(100))
+
+    def _make_due(self):
+        NotificationDelivery.objects.update(next_attempt_at=timezone.now())
+
+    @patch("api.notifications.NOTIFICATION_DISPATCHER", True)
+    def test_send_message_writes_outbox(self):
+        self.robot.telegram_enabled = True
+        self.robot.telegram_chat_id = 1234
+        self.robot.webhook_enabled = True
+        self.robot.webhook_url = "http://alice.onion/hook"
+        self.robot.save()
+
+        Notifications().send_message(self.order, self.robot, "Hi", "there")
+
+        self.assertEqual(Notification.objects.count(), 1)
+        telegram = NotificationDelivery.objects.get(
+            channel=NotificationDelivery.Channels.TELEGRAM
+        )
+        self.assertEqual(telegram.destination, "1234")
+        self.assertEqual(telegram.payload, {"text": "Hi there"})
+        webhook = NotificationDelivery.objects.get(
+            channel=NotificationDelivery.Channels.WEBHOOK
+        )
+        self.assertEqual(webhook.payload["message"]["title"], "Hi")
+        self.assertIn("event_id", webhook.payload)
+
+    def test_delivered_are_deleted(self):
+        self._delivery(NotificationDelivery.Channels.TELEGRAM)
+        self._delivery()
+        session = FakeSession()
+
+        self.assertEqual(self._dispatch(NotificationDispatcher(session=session)), 2)
+        self.assertEqual(len(session.calls), 2)
+        self.assertFalse(NotificationDelivery.objects.exists())
+
+    @patch("api.dispatcher.NOTIFICATION_MAX_ATTEMPTS", 2)
+    def test_retry_then_dead_letter(self):
+        delivery = self._delivery()
+        dispatcher = NotificationDispatcher(
+            session=FakeSession({"alice.onion": FakeResponse(500)})
+        )
+
+        self.assertEqual(self._dispatch(dispatcher), 0)
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.status, NotificationDelivery.Status.PENDING)
+        self.assertEqual(delivery.attempts, 1)
+        self.assertGreater(delivery.next_attempt_at, timezone.now())
+        # Not due yet
+        self.assertEqual(dispatcher.claim(100), [])
+
+        self._make_due()
+        self.assertEqual(self._dispatch(dispatcher), 0)
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.status, NotificationDelivery.Status.DEAD)
+        self.assertEqual(delivery.attempts, 2)
+        self.assertIn("500", delivery.last_error)
+
+    def test_permanent_errors_dead_letter_at_once(self):
+        blocked = self._delivery(NotificationDelivery.Channels.TELEGRAM)
+        not_onion = self._delivery(url="http://example.com/hook")
+        session = FakeSession({"telegram": FakeResponse(403, {"ok": False})})
+
+        self._dispatch(NotificationDispatcher(session=session))
+
+        for delivery in (blocked, not_onion):
+            delivery.refresh_from_db()
+            self.assertEqual(delivery.status, NotificationDelivery.Status.DEAD)
+            self.assertEqual(delivery.attempts, 1)
+        # The webhook outside Tor was never called
+        self.assertEqual(len(session.calls), 1)
+
+    def test_telegram_retry_after(self):
+        delivery = self._delivery(NotificationDelivery.Channels.TELEGRAM)
+        session = FakeSession(
+            {"telegram": FakeResponse(429, {"parameters": {"retry_after": 600}})}
+        )
+
+        self._dispatch(NotificationDispatcher(session=session))
+
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.status, NotificationDelivery.Status.PENDING)
+        self.assertGreater(
+            delivery.next_attempt_at, timezone.now() + timedelta(seconds=590)
+        )
+
+    @patch("api.dispatcher.NOTIFICATION_BREAKER_FAILURES", 2)
+    def test_circuit_breaker(self):
+        session = FakeSession({"slow.onion": FakeResponse(503)})
+        dispatcher = NotificationDispatcher(session=session)
+        for _ in range(2):
+            self._delivery(url="http://slow.onion/hook")
+        self._dispatch(dispatcher)
+
+        # The circuit of slow.onion is open, other destinations are delivered
+        held = self._delivery(url="http://slow.onion/hook")
+        self._delivery(url="http://alice.onion/hook")
+        calls = len(session.calls)
+        self.assertEqual(self._dispatch(dispatcher), 1)
+        self.assertEqual(len(session.calls), calls + 1)
+
+        # Held without counting an attempt
+        held.refresh_from_db()
+        self.assertEqual(held.attempts, 0)
+        self.assertGreater(held.next_attempt_at, timezone.now())
+
+    @patch("api.dispatcher.NOTIFICATION_BREAKER_FAILURES", 1)
+    @patch("api.dispatcher.NOTIFICATION_BREAKER_SECONDS", 60)
+    def test_circuit_breaker_half_open(self):
+        session = FakeSession({"slow.onion": FakeResponse(503)})
+        dispatcher = NotificationDispatcher(session=session)
+        self._delivery(url="http://slow.onion/hook")
+        self._dispatch(dispatcher)
+
+        # The cooldown is over and a probe to slow.onion is in flight
+        breaker = dispatcher.breakers["slow.onion"]
+        breaker.opened_at -= 120
+        self.assertTrue(breaker.allow(time.time()))
+
+        # Held until the probe has had time to finish, not due right away
+        held = self._delivery(url="http://slow.onion/hook")
+        calls = len(session.calls)
+        self.assertEqual(self._dispatch(dispatcher), 0)
+        self.assertEqual(len(session.calls), calls)
+        held.refresh_from_db()
+        self.assertEqual(held.attempts, 0)
+        self.assertGreater(held.next_attempt_at, timezone.now() + timedelta(seconds=50))
+        self.assertNotIn(held, dispatcher.claim(100))
+
+    @patch("api.dispatcher.NOTIFICATION_WEBHOOK_CONCURRENCY", 2)
+    def test_channel_concurrency(self):
+        for i in range(6):
+            self._delivery(url=f"http://robot{i}.onion/hook")
+        session = FakeSession(delay=0.05)
+
+        self.assertEqual(self._dispatch(NotificationDispatcher(session=session)), 6)
+        self.assertEqual(session.max_concurrent, 2)
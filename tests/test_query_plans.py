@@ -0,0 +1,192 @@
+import random
+from datetime import timedelta
+from decimal import Decimal
+from unittest import skipUnless
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.utils import timezone
+
+from api.expiry import expiry_statuses
+from api.management.commands.follow_invoices import Command as FollowInvoices
+from api.models import Currency, LNPayment, Notification, Order, TakeOrder
+from api.shards import filter_shards
+from chat.models import Message
+
+ACTIVE_STATUSES = [
+    Order.Status.WFB,
+    Order.Status.PUB,
+    Order.Status.PAU,
+    Order.Status.TAK,
+    Order.Status.WF2,
+    Order.Status.WFE,
+    Order.Status.WFI,
+    Order.Status.CHA,
+    Order.Status.FSE,
+    Order.Status.DIS,
+    Order.Status.WFR,
+]
+
+
+@skipUnless(connection.vendor == "postgresql", "Query plans are PostgreSQL plans")
+class QueryPlansTest(TestCase):
+    """
+    Seeds large synthetic tables, where most rows are history (finished
+    orders, settled payments...), and asserts with EXPLAIN that the hot
+    queries of the daemons and views use an index instead of a full scan.
+    """
+
+    NUM_USERS = 200
+    NUM_ORDERS = 20_000
+    NUM_LNPAYMENTS = 20_000
+    NUM_TAKE_ORDERS = 2_000
+    NUM_NOTIFICATIONS = 20_000
+    NUM_MESSAGES = 20_000
+
+    @classmethod
+    def setUpTestData(cls):
+        rng = random.Random(0)
+        now = timezone.now()
+        currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=now
+        )
+        # Users are created one by one, so each gets its robot
+        cls.users = [
+            User.objects.create(username=f"plans-{i}") for i in range(cls.NUM_USERS)
+        ]
+
+        # 99% of the orders are finished trades
+        finished = [Order.Status.SUC, Order.Status.EXP, Order.Status.CCA]
+        Order.objects.bulk_create(
+            (
+                Order(
+                    maker=rng.choice(cls.users),
+                    taker=rng.choice(cls.users),
+                    type=Order.Types.SELL,
+                    currency=currency,
+                    status=rng.choice(
+                        ACTIVE_STATUSES if rng.random() < 0.01 else finished
+                    ),
+                    amount=Decimal("100"),
+                    has_range=False,
+                    expires_at=now + timedelta(minutes=rng.randint(-600, 600)),
+                    public_duration=60 * 60,
+                    escrow_duration=60 * 30,
+                )
+                for _ in range(cls.NUM_ORDERS)
+            ),
+            batch_size=2000,
+        )
+        orders = list(Order.objects.all()[:1000])
+        cls.order = orders[0]
+
+        def lnpayment(i):
+            hold = rng.random() < 0.5
+            pending = rng.random() < 0.01
+            if hold:
+                status = LNPayment.Status.LOCKED if pending else LNPayment.Status.SETLED
+            else:
+                status = LNPayment.Status.FLIGHT if pending else LNPayment.Status.SUCCED
+            return LNPayment(
+                payment_hash=f"{i:064x}",
+                type=LNPayment.Types.HOLD if hold else LNPayment.Types.NORM,
+                status=status,
+                num_satoshis=100_000,
+                created_at=now - timedelta(hours=rng.randint(0, 1000)),
+                expires_at=now,
+                routing_attempts=rng.randint(0, 3),
+                last_routing_time=now - timedelta(minutes=rng.randint(0, 60)),
+                in_flight=rng.random() < 0.5,
+            )
+
+        LNPayment.objects.bulk_create(
+            (lnpayment(i) for i in range(cls.NUM_LNPAYMENTS)), batch_size=2000
+        )
+        TakeOrder.objects.bulk_create(
+            TakeOrder(
+                order=rng.choice(orders),
+                taker=rng.choice(cls.users),
+                amount=Decimal("100"),
+                expires_at=now - timedelta(minutes=rng.randint(-10, 10_000)),
+            )
+            for _ in range(cls.NUM_TAKE_ORDERS)
+        )
+        robots = [user.robot for user in cls.users]
+        Notification.objects.bulk_create(
+            (
+                Notification(
+                    robot=rng.choice(robots),
+                    order=rng.choice(orders),
+                    title="Notification",
+                    description="",
+                    created_at=now - timedelta(minutes=rng.randint(0, 100_000)),
+                )
+                for _ in range(cls.NUM_NOTIFICATIONS)
+            ),
+            batch_size=2000,
+        )
+        Message.objects.bulk_create(
+            (
+                Message(order=orders[i % len(orders)], index=i // len(orders))
+                for i in range(cls.NUM_MESSAGES)
+            ),
+            batch_size=2000,
+        )
+
+        with connection.cursor() as cursor:
+            for model in (Order, LNPayment, TakeOrder, Notification, Message):
+                cursor.execute(f"ANALYZE {model._meta.db_table}")
+
+    def assertIndexScan(self, queryset, index=None):
+        plan = queryset.explain()
+        table = queryset.model._meta.db_table
+        self.assertNotIn(f"Seq Scan on {table}", plan, plan)
+        self.assertIn("Index", plan, plan)
+        if index:
+            self.assertIn(index, plan, plan)
+
+    def test_due_orders(self):
+        queryset = Order.objects.filter(
+            status__in=expiry_statuses(), expires_at__lt=timezone.now()
+        )
+        self.assertIndexScan(queryset, "order_status_expires_idx")
+
+    def test_due_orders_of_a_shard(self):
+        queryset = Order.objects.filter(
+            status__in=expiry_statuses(), expires_at__lt=timezone.now()
+        )
+        self.assertIndexScan(filter_shards(queryset, "id", [0]))
+
+    def test_active_orders_of_a_robot(self):
+        user = self.users[0]
+        self.assertIndexScan(
+            Order.objects.filter(maker=user, status__in=ACTIVE_STATUSES)
+        )
+        self.assertIndexScan(
+            Order.objects.filter(taker=user, status__in=ACTIVE_STATUSES)
+        )
+        self.assertIndexScan(
+            TakeOrder.objects.filter(taker=user, expires_at__gt=timezone.now())
+        )
+
+    def test_hold_invoices_to_lookup(self):
+        self.assertIndexScan(FollowInvoices().hold_invoices_to_lookup())
+
+    def test_ln_payments_to_pay(self):
+        self.assertIndexScan(
+            FollowInvoices().ln_payments_to_pay(), "lnpayment_pending_payout_idx"
+        )
+
+    def test_notifications_of_a_robot(self):
+        robot = self.users[0].robot
+        queryset = Notification.objects.filter(robot=robot).order_by("-created_at")
+        self.assertIndexScan(queryset)
+        self.assertIndexScan(
+            queryset.filter(created_at__gte=timezone.now() - timedelta(hours=1)),
+            "notification_robot_created_idx",
+        )
+
+    def test_messages_of_an_order(self):
+        queryset = Message.objects.filter(order=self.order, index__gt=10)
+        self.assertIndexScan(queryset, "message_order_index_idx")
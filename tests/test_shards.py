@@ -0,0 +1,116 @@
+import time
+from decimal import Decimal
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.utils import timezone
+from django_redis import get_redis_connection
+
+from api.models import Currency, Order
+from api.shards import NUM_SHARDS, ShardLeases, filter_shards, shard_of
+
+
+class ShardLeasesTest(TestCase):
+    """
+    Replicas of a worker claim disjoint shards with Redis leases, and take
+    over the shards of replicas that leave or stop heartbeating.
+    """
+
+    worker = "test_worker"
+
+    def setUp(self):
+        self.redis = get_redis_connection("default")
+        self._clear()
+
+    def tearDown(self):
+        self._clear()
+
+    def _clear(self):
+        keys = self.redis.keys(f"shards:{self.worker}:*")
+        if keys:
+            self.redis.delete(*keys)
+
+    def _replicas(self, n):
+        replicas = [ShardLeases(self.worker, sharding=True) for _ in range(n)]
+        # Replicas converge after every one has seen the others
+        for _ in range(3):
+            for replica in replicas:
+                replica.heartbeat()
+        return replicas
+
+    def assertPartition(self, replicas):
+        owned = [replica.shards for replica in replicas]
+        self.assertEqual(set().union(*owned), set(range(NUM_SHARDS)))
+        self.assertEqual(sum(len(shards) for shards in owned), NUM_SHARDS)
+        sizes = [len(shards) for shards in owned]
+        self.assertLessEqual(max(sizes) - min(sizes), 1)
+
+    def test_without_sharding_owns_every_shard(self):
+        replica = ShardLeases(self.worker, sharding=False)
+        self.assertEqual(replica.heartbeat(), set(range(NUM_SHARDS)))
+        self.assertEqual(self.redis.keys(f"shards:{self.worker}:*"), [])
+
+    def test_replicas_own_disjoint_shards(self):
+        replicas = self._replicas(3)
+        self.assertPartition(replicas)
+
+        order_id = 12345
+        owners = [replica for replica in replicas if replica.owns(order_id)]
+        self.assertEqual(len(owners), 1)
+
+    def test_rebalance_when_a_replica_joins_and_leaves(self):
+        first, second = self._replicas(2)
+        self.assertPartition([first, second])
+
+        third = ShardLeases(self.worker, sharding=True)
+        replicas = [first, second, third]
+        for _ in range(3):
+            for replica in replicas:
+                replica.heartbeat()
+        self.assertPartition(replicas)
+
+        second.release()
+        for _ in range(2):
+            for replica in (first, third):
+                replica.heartbeat()
+        self.assertPartition([first, third])
+
+    @patch("api.shards.WORKER_LEASE_SECONDS", 1)
+    def test_failover_after_lease_expiry(self):
+        alive, dead = self._replicas(2)
+
+        # The dead replica stops heartbeating, its leases expire
+        time.sleep(1.2)
+        alive.heartbeat()
+        self.assertEqual(alive.shards, set(range(NUM_SHARDS)))
+
+        # A late heartbeat of the dead replica finds its leases gone
+        self.assertTrue(dead.heartbeat().isdisjoint(alive.shards))
+
+    def test_filter_shards(self):
+        currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        maker = User.objects.create(username="shards-maker")
+        orders = [
+            Order.objects.create(
+                maker=maker,
+                type=Order.Types.SELL,
+                currency=currency,
+                amount=Decimal("100"),
+                has_range=False,
+                expires_at=timezone.now(),
+                public_duration=60 * 60,
+                escrow_duration=60 * 30,
+            )
+            for _ in range(4)
+        ]
+        shards = {shard_of(orders[0].id), shard_of(orders[1].id)}
+
+        filtered = filter_shards(Order.objects.all(), "id", shards)
+
+        self.assertEqual(
+            set(filtered.values_list("id", flat=True)),
+            {order.id for order in orders if shard_of(order.id) in shards},
+        )
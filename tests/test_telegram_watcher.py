@@ -0,0 +1,99 @@
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django_redis import get_redis_connection
+
+from api.models import Robot
+from api.telegram import NO_TOKEN_TEXT, OFFSET_KEY, TelegramWatcher
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    """Stands in for Telegram, answering getUpdates with the given updates"""
+
+    def __init__(self, updates):
+        self.updates = updates
+        self.params = []
+
+    def get(self, url, params, timeout):
+        self.params.append(params)
+        return FakeResponse({"ok": True, "result": self.updates})
+
+
+def start(update_id, chat_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "text": text,
+            "from": {"id": chat_id, "language_code": "es"},
+        },
+    }
+
+
+@patch("api.notifications.Notifications.send_telegram_message")
+class TelegramWatcherTest(TestCase):
+    """
+    TelegramWatcher enables the robots whose token is sent with /start,
+    resolving the tokens of a batch of updates in one query, and persists
+    the offset of the handled updates.
+    """
+
+    def setUp(self):
+        self.redis = get_redis_connection("default")
+        self.redis.delete(OFFSET_KEY)
+        self.addCleanup(self.redis.delete, OFFSET_KEY)
+        self.robots = []
+        for i in range(3):
+            robot = Robot.objects.get(user=User.objects.create(username=f"tg-{i}"))
+            robot.telegram_token = f"token{i}"
+            robot.save(update_fields=["telegram_token"])
+            self.robots.append(robot)
+
+    def test_enable_robots_in_batch(self, send_telegram_message):
+        updates = [start(10 + i, 100 + i, f"/start token{i}") for i in range(3)] + [
+            start(13, 200, "/start wrong"),
+            start(14, 201, "/start"),
+            {"update_id": 15, "message": {"text": "hello", "from": {"id": 202}}},
+        ]
+        watcher = TelegramWatcher(session=FakeSession(updates))
+
+        # One query resolves every token, another updates the robots
+        with self.assertNumQueries(2):
+            replies = watcher.enable_robots(updates)
+
+        for i, robot in enumerate(self.robots):
+            robot.refresh_from_db()
+            self.assertTrue(robot.telegram_enabled)
+            self.assertTrue(robot.telegram_welcomed)
+            self.assertEqual(robot.telegram_chat_id, 100 + i)
+            self.assertEqual(robot.telegram_lang_code, "es")
+        self.assertEqual(len(replies), 5)
+        self.assertIn("Hola tg-0", replies[0][1])
+        self.assertIn("invalid token", replies[3][1])
+        self.assertEqual(replies[4], (201, NO_TOKEN_TEXT))
+
+    def test_offset_is_persisted(self, send_telegram_message):
+        updates = [start(41, 100, "/start token0"), start(42, 101, "/start wrong")]
+        session = FakeSession(updates)
+        watcher = TelegramWatcher(session=session)
+
+        self.assertEqual(watcher.get_offset(), 0)
+        async_to_sync(watcher.handle_updates)(updates)
+        self.assertEqual(send_telegram_message.call_count, 2)
+
+        # A restarted watcher asks for the updates after the last one handled
+        restarted = TelegramWatcher(session=session)
+        restarted.get_updates(restarted.get_offset())
+        self.assertEqual(session.params[-1]["offset"], 43)
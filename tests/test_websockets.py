@@ -0,0 +1,111 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import TransactionTestCase, override_settings
+from django.utils import timezone
+
+import api.routing
+from api.book import rebuild_book
+from api.models import Currency, Order
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+}
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class WebsocketsTest(TransactionTestCase):
+    """
+    Book deltas and order status changes are pushed to WebSocket subscribers,
+    so clients do not need to poll /api/book/ and /api/order/.
+    """
+
+    application = URLRouter(api.routing.websocket_urlpatterns)
+
+    def setUp(self):
+        self.currency = Currency.objects.create(
+            currency=1, exchange_rate=Decimal("30000"), timestamp=timezone.now()
+        )
+        self.maker = User.objects.create(username="ws-maker", last_login=timezone.now())
+        self.other = User.objects.create(username="ws-other", last_login=timezone.now())
+        rebuild_book()
+
+    def _order(self, status=Order.Status.PUB):
+        return Order.objects.create(
+            maker=self.maker,
+            type=Order.Types.SELL,
+            currency=self.currency,
+            status=status,
+            amount=Decimal("100"),
+            has_range=False,
+            last_satoshis=300_000,
+            expires_at=timezone.now() + timedelta(hours=1),
+            public_duration=60 * 60,
+            escrow_duration=60 * 30,
+        )
+
+    async def _connect(self, path, user):
+        communicator = WebsocketCommunicator(self.application, path)
+        communicator.scope["user"] = user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_book_snapshot_and_deltas(self):
+        listed = await database_sync_to_async(self._order)()
+
+        communicator, connected = await self._connect("ws/book/", AnonymousUser())
+        self.assertTrue(connected)
+
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot["action"], "snapshot")
+        self.assertEqual([order["id"] for order in snapshot["orders"]], [listed.id])
+
+        added = await database_sync_to_async(self._order)()
+        delta = await communicator.receive_json_from()
+        self.assertEqual(delta["action"], "add")
+        self.assertEqual(delta["order"]["id"], added.id)
+        self.assertIn("maker_status", delta["order"])
+        self.assertNotIn("status", delta["order"])
+
+        await database_sync_to_async(added.update_status)(Order.Status.PAU)
+        delta = await communicator.receive_json_from()
+        self.assertEqual(delta, {"action": "remove", "order_id": added.id})
+
+        # Orders that never were in the book do not push deltas
+        await database_sync_to_async(self._order)(Order.Status.WFB)
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.disconnect()
+
+    async def test_order_rejects_non_participant(self):
+        order = await database_sync_to_async(self._order)(Order.Status.WFB)
+
+        _, connected = await self._connect(f"ws/order/{order.id}/", self.other)
+        self.assertFalse(connected)
+
+        _, connected = await self._connect(f"ws/order/{order.id}/", AnonymousUser())
+        self.assertFalse(connected)
+
+    async def test_order_pushes_status_changes(self):
+        order = await database_sync_to_async(self._order)(Order.Status.WFB)
+
+        communicator, connected = await self._connect(
+            f"ws/order/{order.id}/", self.maker
+        )
+        self.assertTrue(connected)
+
+        current = await communicator.receive_json_from()
+        self.assertEqual(current["status"], Order.Status.WFB)
+
+        await database_sync_to_async(order.update_status)(Order.Status.PUB)
+        pushed = await communicator.receive_json_from()
+        self.assertEqual(pushed["order_id"], order.id)
+        self.assertEqual(pushed["old_status"], Order.Status.WFB)
+        self.assertEqual(pushed["status"], Order.Status.PUB)
+        self.assertEqual(pushed["status_message"], Order.Status.PUB.label)
+
+        await communicator.disconnect()